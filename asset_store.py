@@ -0,0 +1,440 @@
+# vim: set fileencoding=utf-8 :
+
+# Copyright 2019 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Content-addressed store of the assets of every project.
+
+Each distinct asset is stored once, as projects/.assets/objects/ab/cdef...,
+named by the sha256 of its content, and the files in the projects' assets/
+dirs are hardlinks to it. The same logo or base video in many projects takes
+the disk space of one, and a new project only links the base project's
+assets instead of copying them.
+
+The link count of an object is its reference count: once no project links
+to it any more, it only has its name in the store, and collect_garbage()
+deletes it. Objects are never written in place; assets are replaced by
+linking a new object over them, so changing one project's asset leaves the
+others alone. Where hardlinks are not possible, like across file systems,
+assets are copied instead.
+
+Uploads are hashed as they are written to the store's temp dir, and renamed
+into it, so an uploaded asset is written once. Large files can be uploaded
+in parts, resuming after a failure from the last byte received: see
+start_upload().
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+
+import disk_usage
+
+STORE_DIR = os.path.join('projects', '.assets')
+OBJECTS_DIR = os.path.join(STORE_DIR, 'objects')
+TEMP_DIR = os.path.join(STORE_DIR, 'tmp')
+UPLOADS_DIR = os.path.join(STORE_DIR, 'uploads')
+LOCK_FILE = os.path.join(STORE_DIR, 'lock')
+BUFFER_SIZE = 2**20
+# resumable uploads not written to for this many seconds are dropped
+UPLOAD_EXPIRY = 24 * 60 * 60
+
+lock = threading.Lock()
+# digests of files outside the store, by (path, size, mtime), and of the
+# objects of the store, by (device, inode)
+source_digests = {}
+object_digests = {}
+# inodes of linked files the last scan found no object for; cleared when
+# objects are added, while the ones other processes add are only hashed
+missing_objects = set()
+# (offset, sha256 of the bytes up to it) of the uploads in progress, by id
+upload_hashes = {}
+
+
+@contextlib.contextmanager
+def store_lock():
+  """Keeps other threads and processes from collecting or linking objects.
+
+  Without it, an object could be collected between being found in the store
+  and being linked to a project.
+  """
+  os.makedirs(STORE_DIR, exist_ok=True)
+  with lock, open(LOCK_FILE, 'a') as lock_file:
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def object_path(digest):
+  return os.path.join(OBJECTS_DIR, digest[:2], digest[2:])
+
+
+def add_stream(stream, dest_path):
+  """Stores what is read from a file object and links it as dest_path.
+
+  The content is hashed while it is written to a temp file, which becomes
+  the object unless the store already has it. Returns the digest.
+  """
+  os.makedirs(TEMP_DIR, exist_ok=True)
+  digest = hashlib.sha256()
+  fd, temp_path = tempfile.mkstemp(dir=TEMP_DIR)
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      while True:
+        data = stream.read(BUFFER_SIZE)
+        if not data:
+          break
+        digest.update(data)
+        f.write(data)
+    digest = digest.hexdigest()
+    add_temp_file(temp_path, digest, dest_path)
+  finally:
+    if os.path.exists(temp_path):
+      os.unlink(temp_path)
+  return digest
+
+
+def add_temp_file(temp_path, digest, dest_path):
+  """Moves a file of the given digest into the store and links it.
+
+  The file is dropped if the store already has its content.
+  """
+  with store_lock():
+    path = object_path(digest)
+    if not os.path.exists(path):
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      # objects are shared by every project linking them, so read only
+      os.chmod(temp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+      os.replace(temp_path, path)
+      with lock:
+        missing_objects.clear()
+    link(digest, dest_path)
+  if os.path.exists(temp_path):
+    os.unlink(temp_path)
+
+
+def file_digest(file_path):
+  """Returns the sha256 of a file, cached by path, size and mtime."""
+  st = os.stat(file_path)
+  key = (os.path.abspath(file_path), st.st_size, st.st_mtime_ns)
+  with lock:
+    digest = (object_digests.get((st.st_dev, st.st_ino)) or
+              source_digests.get(key))
+  if digest is None:
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+      for data in iter(lambda: f.read(BUFFER_SIZE), b''):
+        sha.update(data)
+    digest = sha.hexdigest()
+    with lock:
+      source_digests[key] = digest
+  return digest
+
+
+def link(digest, dest_path):
+  """Points dest_path at a stored object, replacing what was there.
+
+  The change in size of dest_path is added to its project's disk usage.
+  Must be called holding store_lock().
+  """
+  os.makedirs(os.path.dirname(dest_path) or '.', exist_ok=True)
+  temp_path = '%s.%s.tmp' % (dest_path, os.getpid())
+  source = object_path(digest)
+  try:
+    os.link(source, temp_path)
+    st = os.stat(temp_path)
+    object_digests[(st.st_dev, st.st_ino)] = digest
+  except OSError:
+    # other file systems, or file systems without hardlinks
+    shutil.copyfile(source, temp_path)
+  with disk_usage.tracking(dest_path):
+    os.replace(temp_path, dest_path)
+
+
+def import_file(file_path, dest_path):
+  """Stores a file and links it as dest_path, returning its digest.
+
+  Files already in the store, like the base project's assets after the
+  first project, are only hashed, once per change, and linked.
+  """
+  digest = file_digest(file_path)
+  with store_lock():
+    if os.path.exists(object_path(digest)):
+      link(digest, dest_path)
+      return digest
+  with open(file_path, 'rb') as f:
+    return add_stream(f, dest_path)
+
+
+def import_zip(zip_file, dest_dir):
+  """Stores each file of a zip, linking it under dest_dir.
+
+  Members are streamed into the store one at a time, so nothing is
+  extracted to a temp dir first. zip_file is a path or a seekable file.
+  Returns the list of the asset paths, relative to dest_dir.
+  """
+  assets = []
+  with zipfile.ZipFile(zip_file, 'r') as zip_file:
+    for info in zip_file.infolist():
+      if info.is_dir():
+        continue
+      # the same paths ZipFile.extract would write to
+      name = os.path.normpath(info.filename.replace('\\', '/')).lstrip('/')
+      if name.startswith('..'):
+        continue
+      with zip_file.open(info) as member:
+        add_stream(member, os.path.join(dest_dir, name))
+      assets.append(name)
+  return assets
+
+
+def import_zip_stream(stream, dest_dir):
+  """Stores each file of a zip read from an unseekable stream.
+
+  Zips list their members at the end, so the stream is spooled to the
+  store's temp dir first.
+  """
+  os.makedirs(TEMP_DIR, exist_ok=True)
+  with tempfile.TemporaryFile(dir=TEMP_DIR) as f:
+    shutil.copyfileobj(stream, f, BUFFER_SIZE)
+    f.seek(0)
+    return import_zip(f, dest_dir)
+
+
+def import_tree(source_dir, dest_dir):
+  """Copies a directory, storing and linking the files of its assets/ dirs.
+
+  Other files, like the config and the feed, are plain copies, as they are
+  edited in place.
+  """
+  for root, dirnames, filenames in os.walk(source_dir):
+    relative = os.path.relpath(root, source_dir)
+    target = os.path.normpath(os.path.join(dest_dir, relative))
+    os.makedirs(target, exist_ok=True)
+    in_assets = 'assets' in relative.split(os.sep)
+    for filename in filenames:
+      if in_assets:
+        import_file(os.path.join(root, filename),
+                    os.path.join(target, filename))
+      else:
+        shutil.copy2(os.path.join(root, filename),
+                     os.path.join(target, filename))
+
+
+def asset_digest(asset_path):
+  """Returns the sha256 of a project asset, for fingerprints of renders.
+
+  Assets linked to the store are looked up by inode, without reading them.
+  """
+  st = os.stat(asset_path)
+  key = (st.st_dev, st.st_ino)
+  with lock:
+    digest = object_digests.get(key)
+    scan = digest is None and st.st_nlink > 1 and key not in missing_objects
+  if scan:
+    scan_objects()
+    with lock:
+      digest = object_digests.get(key)
+      if digest is None:
+        missing_objects.add(key)
+  return digest or file_digest(asset_path)
+
+
+def scan_objects():
+  """Records the inode of every object of the store."""
+  found = {}
+  for root, dirnames, filenames in os.walk(OBJECTS_DIR):
+    for filename in filenames:
+      try:
+        st = os.stat(os.path.join(root, filename))
+      except OSError:
+        continue
+      found[(st.st_dev, st.st_ino)] = os.path.basename(root) + filename
+  with lock:
+    object_digests.update(found)
+
+
+def collect_garbage():
+  """Deletes the objects no project links to, returning the bytes freed."""
+  freed = 0
+  with store_lock():
+    for root, dirnames, filenames in os.walk(OBJECTS_DIR):
+      for filename in filenames:
+        path = os.path.join(root, filename)
+        try:
+          st = os.stat(path)
+          if st.st_nlink == 1:
+            os.unlink(path)
+            freed += st.st_size
+            object_digests.pop((st.st_dev, st.st_ino), None)
+        except OSError as e:
+          logging.warning('Could not collect %s: %s', path, e)
+      if root != OBJECTS_DIR and not os.listdir(root):
+        os.rmdir(root)
+  return freed
+
+
+def upload_paths(upload_id):
+  if not re.match(r'^[0-9a-f]{32}$', upload_id):
+    raise KeyError(upload_id)
+  path = os.path.join(UPLOADS_DIR, upload_id)
+  return path + '.json', path + '.part'
+
+
+def start_upload(dest_path, size):
+  """Starts a resumable upload of size bytes to dest_path, returning its id.
+
+  The bytes are sent with append_upload(), in as many parts as needed, and
+  the upload is stored and linked, or extracted if dest_path is a zip, once
+  all of them arrived.
+  """
+  drop_expired_uploads()
+  os.makedirs(UPLOADS_DIR, exist_ok=True)
+  upload_id = uuid.uuid4().hex
+  info_path, part_path = upload_paths(upload_id)
+  open(part_path, 'wb').close()
+  with open(info_path, 'w') as f:
+    json.dump({'dest_path': dest_path, 'size': size}, f)
+    f.close()
+  return upload_id
+
+
+def upload_state(upload_id):
+  """Returns the dest_path, size and offset of an upload in progress.
+
+  Raises KeyError if there is no such upload, e.g. if it is complete.
+  """
+  info_path, part_path = upload_paths(upload_id)
+  try:
+    with open(info_path) as f:
+      state = json.load(f)
+      f.close()
+    state['offset'] = os.path.getsize(part_path)
+  except (OSError, ValueError):
+    raise KeyError(upload_id)
+  return state
+
+
+def append_upload(upload_id, offset, stream):
+  """Appends the bytes of a stream to an upload, from the given offset.
+
+  An offset below the upload's resends bytes that already arrived, which are
+  overwritten. Returns the upload state; 'complete' is True once every byte
+  arrived and the asset is in place.
+
+  Raises:
+    KeyError: there is no such upload.
+    ValueError: the offset is past the bytes received, or the stream has
+        more bytes than the size of the upload.
+  """
+  state = upload_state(upload_id)
+  info_path, part_path = upload_paths(upload_id)
+  with open(part_path, 'r+b') as f:
+    # a part is appended to by one request at a time
+    fcntl.flock(f, fcntl.LOCK_EX)
+    received = os.fstat(f.fileno()).st_size
+    if offset > received:
+      raise ValueError('Offset %d is past the %d bytes received' %
+                       (offset, received))
+    f.seek(offset)
+    f.truncate()
+    sha = hash_part(upload_id, f, offset)
+    while True:
+      data = stream.read(BUFFER_SIZE)
+      if not data:
+        break
+      offset += len(data)
+      if offset > state['size']:
+        raise ValueError('Upload is larger than its %d bytes' % state['size'])
+      sha.update(data)
+      f.write(data)
+    f.flush()
+    with lock:
+      upload_hashes[upload_id] = (offset, sha)
+    state['offset'] = offset
+    state['complete'] = offset == state['size']
+    if state['complete']:
+      finish_upload(upload_id, state['dest_path'], part_path,
+                    sha.hexdigest())
+  return state
+
+
+def hash_part(upload_id, f, offset):
+  """Returns the sha256 of the first offset bytes of an upload's part.
+
+  The hash of the previous append is reused, unless the append resent bytes
+  or was received by another process, in which case the part is read again.
+  """
+  with lock:
+    known_offset, sha = upload_hashes.pop(upload_id, (None, None))
+  if known_offset == offset:
+    return sha
+  sha = hashlib.sha256()
+  f.seek(0)
+  remaining = offset
+  while remaining:
+    data = f.read(min(BUFFER_SIZE, remaining))
+    if not data:
+      break
+    sha.update(data)
+    remaining -= len(data)
+  return sha
+
+
+def finish_upload(upload_id, dest_path, part_path, digest):
+  info_path, _ = upload_paths(upload_id)
+  with lock:
+    upload_hashes.pop(upload_id, None)
+  try:
+    if dest_path.lower().endswith('.zip'):
+      import_zip(part_path, os.path.dirname(dest_path))
+    else:
+      add_temp_file(part_path, digest, dest_path)
+  finally:
+    for path in (info_path, part_path):
+      if os.path.exists(path):
+        os.unlink(path)
+
+
+def drop_expired_uploads():
+  try:
+    filenames = os.listdir(UPLOADS_DIR)
+  except OSError:
+    return
+  now = time.time()
+  for filename in filenames:
+    upload_id, extension = os.path.splitext(filename)
+    if extension != '.part':
+      continue
+    try:
+      if now - os.path.getmtime(os.path.join(UPLOADS_DIR, filename)) < \
+          UPLOAD_EXPIRY:
+        continue
+      for path in upload_paths(upload_id):
+        os.unlink(path)
+    except (OSError, KeyError):
+      pass
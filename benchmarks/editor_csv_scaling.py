@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+# Copyright 2019 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Scaling benchmark of the parallel Ads Editor CSV build.
+
+Builds the Editor CSV of synthetic multi-account feeds, made of the rows of
+base_project/feed.csv with new account, campaign, ad group and ad names, with
+an increasing number of worker processes, and prints the build time and the
+speedup over a single process as JSON, e.g.:
+
+  python benchmarks/editor_csv_scaling.py --rows 10000 100000 1000000
+
+Outputs of every worker count are checked to be identical.
+"""
+
+import argparse
+import csv
+import filecmp
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import google_ads_editor_csv as g_ads_editor  # pylint: disable=g-import-not-at-top
+import vogon  # pylint: disable=g-import-not-at-top
+
+PROJECT_ID = 'editor_csv_scaling'
+
+
+def write_feed(feed_uri, rows, accounts, rows_per_campaign, rows_per_adgroup):
+  """Writes a feed of the given size cycling over the base project rows."""
+  base_rows = list(vogon.iter_csv_file(
+      os.path.join(REPO_DIR, 'base_project', 'feed.csv'), ','))
+  columns = [c.strip() for c in base_rows[0].keys()] + ['conta']
+  with open(feed_uri, 'w', newline='') as f:
+    writer = csv.writer(f)
+    writer.writerow(columns)
+    for i in range(rows):
+      row = dict((k.strip(), v.strip())
+                 for k, v in base_rows[i % len(base_rows)].items())
+      campaign = i // rows_per_campaign
+      row['conta'] = 'Account %d' % (campaign % accounts)
+      row['campanha'] = 'Campanha %d' % campaign
+      row['grupo_de_anuncio'] = 'AdGroup %d' % (i // rows_per_adgroup)
+      row['anuncio'] = 'Anuncio %d' % i
+      writer.writerow([row.get(c, '') for c in columns])
+    f.close()
+
+
+def time_build(workers):
+  start = time.monotonic()
+  (uploaded, missing), error = g_ads_editor.build_csv(PROJECT_ID,
+                                                      workers=workers)
+  if error is not None:
+    raise RuntimeError(error)
+  return time.monotonic() - start, uploaded + missing
+
+
+def run_benchmark(sizes, worker_counts, accounts, rows_per_campaign,
+                  rows_per_adgroup):
+  """Times the build of each feed size with each number of workers."""
+  results = {'cpu_count': os.cpu_count(), 'runs': []}
+  work_dir = tempfile.mkdtemp(prefix='vogon_bench_')
+  cwd = os.getcwd()
+  try:
+    os.chdir(work_dir)
+    project_dir = os.path.join('projects', PROJECT_ID)
+    os.makedirs(os.path.join(project_dir, 'youtube'))
+    config = vogon.load_config(
+        os.path.join(REPO_DIR, 'base_project', 'config.json'))
+    config['adwords']['Account'] = '{{conta}}'
+    with open(os.path.join(project_dir, 'config.json'), 'w') as f:
+      json.dump(config, f)
+      f.close()
+    csv_path = os.path.join(project_dir, 'google_ads_editor.csv')
+    for rows in sizes:
+      write_feed(os.path.join(project_dir, 'feed.csv'), rows, accounts,
+                 rows_per_campaign, rows_per_adgroup)
+      baseline = None
+      for workers in worker_counts:
+        elapsed, feed_rows = time_build(workers)
+        if baseline is None:
+          baseline = elapsed
+          shutil.copy(csv_path, csv_path + '.baseline')
+        identical = filecmp.cmp(csv_path + '.baseline', csv_path,
+                                shallow=False)
+        run = {
+            'rows': feed_rows,
+            'workers': workers,
+            'seconds': round(elapsed, 3),
+            'rows_per_s': round(feed_rows / elapsed, 1) if elapsed else None,
+            'speedup': round(baseline / elapsed, 2) if elapsed else None,
+            'efficiency': (round(baseline / elapsed / workers, 2)
+                           if elapsed else None),
+            'identical_output': identical
+        }
+        results['runs'].append(run)
+        print(json.dumps(run), file=sys.stderr)
+  finally:
+    os.chdir(cwd)
+    shutil.rmtree(work_dir)
+  return results
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--rows",
+          help="Feed sizes to build",
+          type=int,
+          nargs='+',
+          default=[10000, 100000, 1000000])
+  parser.add_argument("--workers",
+          help="Worker counts to compare, the first one is the baseline",
+          type=int,
+          nargs='+')
+  parser.add_argument("--accounts",
+          help="Accounts in the synthetic feeds",
+          type=int,
+          default=10)
+  parser.add_argument("--rows_per_campaign",
+          help="Feed rows of each campaign",
+          type=int,
+          default=100)
+  parser.add_argument("--rows_per_adgroup",
+          help="Feed rows of each ad group",
+          type=int,
+          default=10)
+  args = parser.parse_args()
+
+  worker_counts = args.workers
+  if not worker_counts:
+    worker_counts = [1]
+    while worker_counts[-1] * 2 <= (os.cpu_count() or 1):
+      worker_counts.append(worker_counts[-1] * 2)
+  results = run_benchmark(args.rows, worker_counts, args.accounts,
+                          args.rows_per_campaign, args.rows_per_adgroup)
+  print(json.dumps(results, indent=2))
+
+if __name__=='__main__':
+  main()
@@ -0,0 +1,425 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+# Copyright 2019 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark of each stage of the Vogon pipeline on a synthetic project.
+
+Copies base_project to a new project with a feed of N rows and a layout of
+M text, K image and V video overlays, times each stage of the pipeline on
+its own and prints the results as JSON, to compare versions:
+
+  python benchmarks/pipeline_benchmark.py --rows 1000 --texts 3 --images 2 \\
+      --videos 1 > results.json
+
+Stages:
+  feed_parse: reading feed.csv.
+  replace_vars: replacing the feed values in the overlays of every row.
+  filter_graph: building the ffmpeg filter graph of --render_rows rows,
+    besides the time spent rasterizing texts.
+  text_rasterization: ImageMagick rendering the texts of those rows.
+  ffmpeg_encode: rendering the videos of --encode_rows rows.
+  ads_csv: building the Ads Editor CSV of the whole feed.
+  upload: uploading --upload_rows videos and their metadata to a mock of
+    the YouTube API running on localhost.
+
+Stages needing ImageMagick or ffmpeg are reported as skipped when they are
+not installed. The project is deleted at the end, unless --keep is given.
+"""
+
+import argparse
+import contextlib
+import csv
+import http.server
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import threading
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import google_ads_editor_csv as g_ads_editor  # pylint: disable=g-import-not-at-top
+import upload_manifest  # pylint: disable=g-import-not-at-top
+import vogon  # pylint: disable=g-import-not-at-top
+import yt_api  # pylint: disable=g-import-not-at-top
+
+VIDEO_OVERLAY = 'base_video.mp4'
+
+
+class Stopwatch(object):
+  """Accumulates the time spent in a stage, over any number of items."""
+
+  def __init__(self):
+    self.seconds = 0.0
+    self.items = 0
+
+  @contextlib.contextmanager
+  def timing(self, items=1):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.seconds += time.perf_counter() - start
+      self.items += items
+
+  def result(self):
+    return {
+        'seconds': round(self.seconds, 6),
+        'items': self.items,
+        'ms_per_item': (round(self.seconds * 1000 / self.items, 3)
+                        if self.items else None)
+    }
+
+
+def skipped(reason):
+  return {'skipped': reason}
+
+
+def create_project(project_id, rows, texts, images, videos):
+  """Copies base_project to a project with a synthetic feed and layout."""
+  project_dir = os.path.join(REPO_DIR, 'projects', project_id)
+  shutil.copytree(os.path.join(REPO_DIR, 'base_project'), project_dir)
+  config_file = os.path.join(project_dir, 'config.json')
+  config = vogon.load_config(config_file)
+
+  base_text = config['text_lines'][0]
+  config['text_lines'] = []
+  for i in range(texts):
+    text = dict(base_text)
+    text['text'] = '%s %d' % (base_text['text'], i)
+    text['y'] = str(int(base_text['y']) + 30 * i)
+    config['text_lines'].append(text)
+
+  base_image = config['images'][0]
+  config['images'] = []
+  for i in range(images):
+    image = dict(base_image)
+    image['x'] = base_image['x'] + 20 * i
+    config['images'].append(image)
+  for i in range(videos):
+    video = dict(base_image)
+    video['image'] = VIDEO_OVERLAY
+    video['width'] = 160
+    video['y'] = base_image['y'] + 20 * i
+    config['images'].append(video)
+
+  config['data_file'] = 'feed.csv'
+  with open(config_file, 'w') as f:
+    json.dump(config, f, indent=2)
+    f.close()
+
+  base_rows = list(vogon.iter_csv_file(
+      os.path.join(REPO_DIR, 'base_project', 'feed.csv'), ','))
+  columns = [c.strip() for c in base_rows[0].keys()]
+  with open(os.path.join(project_dir, 'feed.csv'), 'w', newline='') as f:
+    writer = csv.writer(f)
+    writer.writerow(columns)
+    for i in range(rows):
+      row = dict((k.strip(), v.strip())
+                 for k, v in base_rows[i % len(base_rows)].items())
+      row['Persona'] = str(i + 1)
+      row['campanha'] = 'Campanha %d' % (i // 100)
+      row['grupo_de_anuncio'] = 'AdGroup %d' % (i // 10)
+      row['anuncio'] = 'Anuncio %d' % i
+      writer.writerow([row.get(c, '') for c in columns])
+    f.close()
+  return config
+
+
+class MockYouTubeHandler(http.server.BaseHTTPRequestHandler):
+  """Answers video inserts and updates like the YouTube API does."""
+  uploads = 0
+  lock = threading.Lock()
+
+  def do_POST(self):  # pylint: disable=invalid-name
+    self.read_body()
+    with self.lock:
+      MockYouTubeHandler.uploads += 1
+      video_id = 'mock_%d' % MockYouTubeHandler.uploads
+    self.reply({'id': video_id, 'kind': 'youtube#video'})
+
+  def do_PUT(self):  # pylint: disable=invalid-name
+    self.reply(json.loads(self.read_body()))
+
+  def read_body(self):
+    # uploads of file objects are sent with chunked transfer encoding
+    if self.headers.get('Transfer-Encoding') == 'chunked':
+      chunks = []
+      while True:
+        length = int(self.rfile.readline().split(b';')[0], 16)
+        if not length:
+          self.rfile.readline()
+          return b''.join(chunks)
+        chunks.append(self.rfile.read(length))
+        self.rfile.readline()
+    return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+  def reply(self, content):
+    body = json.dumps(content).encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):  # pylint: disable=arguments-differ
+    pass
+
+
+def time_feed_parse(feed_uri):
+  watch = Stopwatch()
+  with watch.timing(0):
+    rows = list(vogon.iter_csv_file(feed_uri, ','))
+  watch.items = len(rows)
+  return watch.result(), rows
+
+
+def time_replace_vars(config, rows):
+  watch = Stopwatch()
+  overlays = []
+  for i, row in enumerate(rows):
+    with watch.timing():
+      row['$id'] = str(i + 1)
+      image_overlays = vogon.replace_vars_in_overlay(config['images'], row)
+      text_overlays = vogon.replace_vars_in_overlay(config['text_lines'], row)
+    overlays.append((image_overlays, text_overlays))
+  return watch.result(), overlays
+
+
+def time_filter_graph(overlays, project_id, rasterize):
+  """Times filter graph builds, apart from the text rasterization in them.
+
+  Returns:
+    The results of both stages, and the ffmpeg arguments of each row.
+  """
+  graph_watch = Stopwatch()
+  raster_watch = Stopwatch()
+  temp_files = []
+  write_temp_image = vogon.write_temp_image
+  write_to_temp_file = vogon.write_to_temp_file
+
+  def timed_write_temp_image(*args, **kwargs):
+    with raster_watch.timing():
+      if rasterize:
+        path = write_temp_image(*args, **kwargs)
+      else:
+        path = os.path.join(REPO_DIR, 'base_project', 'assets', 'vogon.png')
+    if rasterize:
+      temp_files.append(path)
+    return path
+
+  def tracked_write_to_temp_file(text):
+    path = write_to_temp_file(text)
+    temp_files.append(path)
+    return path
+
+  row_args = []
+  vogon.write_temp_image = timed_write_temp_image
+  vogon.write_to_temp_file = tracked_write_to_temp_file
+  try:
+    for image_overlays, text_overlays in overlays:
+      with graph_watch.timing():
+        filters, txt_in_files, out_audio_filter, out_video_filter = (
+            vogon.complex_filter_strings(image_overlays, text_overlays))
+        img_args = vogon.image_and_video_inputs(image_overlays, project_id,
+                                                txt_in_files)
+      row_args.append((img_args, filters, out_audio_filter, out_video_filter))
+  finally:
+    vogon.write_temp_image = write_temp_image
+    vogon.write_to_temp_file = write_to_temp_file
+  graph_watch.seconds -= raster_watch.seconds
+  raster_result = raster_watch.result()
+  if not rasterize:
+    raster_result = skipped('ImageMagick convert not found')
+  return graph_watch.result(), raster_result, row_args, temp_files
+
+
+def time_ffmpeg_encode(config, project_id, row_args, rows):
+  watch = Stopwatch()
+  base_video = os.path.join('projects', project_id, 'assets', config['video'])
+  for i, (img_args, filters, out_audio_filter, out_video_filter) in (
+      enumerate(row_args)):
+    out_file = os.path.join('projects', project_id, 'output',
+                            vogon.replace_vars(config['output_video'],
+                                               rows[i]))
+    with watch.timing():
+      vogon.run_ffmpeg(img_args, filters, base_video, out_file,
+                       out_audio_filter, out_video_filter,
+                       executable=config.get('ffmpeg_path', 'ffmpeg'))
+  return watch.result()
+
+
+def time_ads_csv(project_id, workers):
+  watch = Stopwatch()
+  with watch.timing(0):
+    (uploaded, missing), error = g_ads_editor.build_csv(project_id,
+                                                        workers=workers)
+  if error is not None:
+    return skipped('Editor CSV failed: %s' % error)
+  watch.items = uploaded + missing
+  return watch.result()
+
+
+def time_upload(project_id, upload_rows, upload_bytes):
+  """Uploads outputs to a local mock of the YouTube API."""
+  server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                           MockYouTubeHandler)
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  googleapis_url = yt_api.GOOGLEAPIS_URL
+  yt_api.GOOGLEAPIS_URL = 'http://127.0.0.1:%d' % server.server_address[1]
+  watch = Stopwatch()
+  total_bytes = 0
+  try:
+    output_dir = os.path.join('projects', project_id, 'output')
+    with upload_manifest.UploadManifest(project_id) as manifest:
+      for row_number in range(1, upload_rows + 1):
+        video_path = os.path.join(output_dir,
+                                  'output_video_row_%d.mp4' % row_number)
+        if not os.path.exists(video_path):
+          # rows that were not encoded upload a file of --upload_bytes
+          with open(video_path, 'wb') as f:
+            f.write(os.urandom(upload_bytes))
+            f.close()
+        total_bytes += os.path.getsize(video_path)
+        with watch.timing():
+          video_resource = yt_api.upload_video(
+              'benchmark_token', 'benchmark', video_path, project_id,
+              'benchmark_channel', manifest=manifest, row_number=row_number)
+          yt_api.write_video_metadata('benchmark_token', video_resource,
+                                      'title', 'description')
+  finally:
+    yt_api.GOOGLEAPIS_URL = googleapis_url
+    server.shutdown()
+    server.server_close()
+  result = watch.result()
+  result['bytes'] = total_bytes
+  result['mb_per_s'] = (round(total_bytes / watch.seconds / 2**20, 2)
+                        if watch.seconds else None)
+  return result
+
+
+def run_benchmark(args):
+  """Runs every stage on a new synthetic project and returns the results."""
+  project_id = 'benchmark_%d' % os.getpid()
+  results = {
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'cpu_count': os.cpu_count(),
+      'parameters': {
+          'rows': args.rows,
+          'texts': args.texts,
+          'images': args.images,
+          'videos': args.videos,
+          'render_rows': min(args.render_rows, args.rows),
+          'encode_rows': min(args.encode_rows, args.render_rows, args.rows),
+          'upload_rows': min(args.upload_rows, args.rows),
+          'csv_workers': args.csv_workers
+      },
+      'stages': {}
+  }
+  stages = results['stages']
+  cwd = os.getcwd()
+  os.chdir(REPO_DIR)
+  temp_files = []
+  try:
+    config = create_project(project_id, args.rows, args.texts, args.images,
+                            args.videos)
+    # keeps the print calls of the pipeline out of the JSON results
+    with contextlib.redirect_stdout(io.StringIO()):
+      feed_uri = os.path.join('projects', project_id, 'feed.csv')
+      stages['feed_parse'], rows = time_feed_parse(feed_uri)
+      stages['replace_vars'], overlays = time_replace_vars(config, rows)
+
+      rasterize = shutil.which('convert') is not None
+      render_overlays = overlays[:args.render_rows]
+      (stages['filter_graph'], stages['text_rasterization'], row_args,
+       temp_files) = time_filter_graph(render_overlays, project_id, rasterize)
+
+      if not shutil.which(config.get('ffmpeg_path', 'ffmpeg')):
+        stages['ffmpeg_encode'] = skipped('ffmpeg not found')
+      elif not rasterize and args.texts:
+        stages['ffmpeg_encode'] = skipped('texts need ImageMagick convert')
+      else:
+        stages['ffmpeg_encode'] = time_ffmpeg_encode(
+            config, project_id, row_args[:args.encode_rows], rows)
+
+      stages['upload'] = time_upload(project_id,
+                                     min(args.upload_rows, args.rows),
+                                     args.upload_bytes)
+      # after the upload, so the CSV has the video IDs of uploaded rows
+      stages['ads_csv'] = time_ads_csv(project_id, args.csv_workers)
+  finally:
+    for path in temp_files:
+      if os.path.exists(path):
+        os.unlink(path)
+    if not args.keep:
+      shutil.rmtree(os.path.join(REPO_DIR, 'projects', project_id),
+                    ignore_errors=True)
+    os.chdir(cwd)
+  return results
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--rows",
+          help="Rows of the synthetic feed",
+          type=int,
+          default=100)
+  parser.add_argument("--texts",
+          help="Text overlays",
+          type=int,
+          default=2)
+  parser.add_argument("--images",
+          help="Image overlays",
+          type=int,
+          default=1)
+  parser.add_argument("--videos",
+          help="Video overlays",
+          type=int,
+          default=0)
+  parser.add_argument("--render_rows",
+          help="Rows whose filter graphs and texts are rendered",
+          type=int,
+          default=10)
+  parser.add_argument("--encode_rows",
+          help="Rows encoded by ffmpeg",
+          type=int,
+          default=1)
+  parser.add_argument("--upload_rows",
+          help="Rows uploaded to the mock YouTube API",
+          type=int,
+          default=10)
+  parser.add_argument("--upload_bytes",
+          help="Size of the files uploaded for rows that were not encoded",
+          type=int,
+          default=2**20)
+  parser.add_argument("--csv_workers",
+          help="Processes building the Ads Editor CSV",
+          type=int,
+          default=1)
+  parser.add_argument("--keep",
+          help="Keep the synthetic project under projects/",
+          action="store_true")
+  args = parser.parse_args()
+  print(json.dumps(run_benchmark(args), indent=2))
+
+if __name__=='__main__':
+  main()
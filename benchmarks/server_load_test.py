@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+# Copyright 2019 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Load test of the Vogon web server.
+
+Sends concurrent preview and project list requests to a running server.py
+and prints the p50/p99 latency of each endpoint as JSON, e.g.:
+
+  python benchmarks/server_load_test.py --project my_project --concurrency 8
+"""
+
+import argparse
+import concurrent.futures
+import json
+import time
+import urllib.request
+
+
+def percentile(values, p):
+  """Nearest-rank percentile of a list of numbers."""
+  if not values:
+    return None
+  ordered = sorted(values)
+  rank = max(0, int(round(p / 100.0 * len(ordered))) - 1)
+  return ordered[min(rank, len(ordered) - 1)]
+
+
+def timed_get(url, timeout):
+  start = time.monotonic()
+  try:
+    with urllib.request.urlopen(url, timeout=timeout) as rs:
+      rs.read()
+      status = rs.status
+  except Exception as e:  # pylint: disable=broad-except
+    status = '%s' % e
+  return time.monotonic() - start, status
+
+
+def run_load_test(base_url, project, preview_row, concurrency, requests,
+                  preview_every, timeout):
+  """Runs the load test and returns latency stats per endpoint."""
+  urls = []
+  for i in range(requests):
+    if project and preview_every and i % preview_every == 0:
+      urls.append(('preview', '%s/api/projects/%s/preview/row/%s' %
+                   (base_url, project, preview_row)))
+    else:
+      urls.append(('list', '%s/api/projects/list' % base_url))
+
+  latencies = {}
+  errors = {}
+  start = time.monotonic()
+  with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+    futures = {executor.submit(timed_get, url, timeout): name
+               for name, url in urls}
+    for future in concurrent.futures.as_completed(futures):
+      name = futures[future]
+      elapsed, status = future.result()
+      latencies.setdefault(name, []).append(elapsed)
+      if status != 200:
+        errors[name] = errors.get(name, 0) + 1
+  wall_time = time.monotonic() - start
+
+  results = {
+      'concurrency': concurrency,
+      'requests': requests,
+      'wall_time_s': round(wall_time, 3),
+      'requests_per_s': round(requests / wall_time, 2),
+      'endpoints': {}
+  }
+  for name, values in sorted(latencies.items()):
+    results['endpoints'][name] = {
+        'count': len(values),
+        'errors': errors.get(name, 0),
+        'p50_ms': round(percentile(values, 50) * 1000, 1),
+        'p99_ms': round(percentile(values, 99) * 1000, 1),
+        'max_ms': round(max(values) * 1000, 1)
+    }
+  return results
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--base_url",
+          help="Address of the running server",
+          default="http://localhost:8080")
+  parser.add_argument("--project",
+          help="Project used for preview requests, none to skip previews")
+  parser.add_argument("--preview_row",
+          help="Feed row rendered by preview requests",
+          type=int,
+          default=1)
+  parser.add_argument("--preview_every",
+          help="Send a preview request every N requests",
+          type=int,
+          default=10)
+  parser.add_argument("--concurrency",
+          help="Concurrent clients",
+          type=int,
+          default=8)
+  parser.add_argument("--requests",
+          help="Total number of requests",
+          type=int,
+          default=200)
+  parser.add_argument("--timeout",
+          help="Timeout of each request in seconds",
+          type=float,
+          default=300)
+  args = parser.parse_args()
+
+  results = run_load_test(args.base_url, args.project, args.preview_row,
+                          args.concurrency, args.requests, args.preview_every,
+                          args.timeout)
+  print(json.dumps(results, indent=2))
+
+if __name__=='__main__':
+  main()
@@ -0,0 +1,163 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+# Copyright 2019 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Throughput benchmark of concurrent video streams.
+
+Streams an asset of a project from a running server.py to concurrent
+clients, like players of the UI. Each client downloads the whole video, or,
+with --seeks, plays it from random offsets with Range requests, reading
+--seek_bytes from each. Prints the aggregate throughput and the p50/p99
+time to first byte as JSON, e.g.:
+
+  python benchmarks/video_stream_benchmark.py --project my_project \
+      --asset base_video.mp4 --concurrency 16 --seeks 20
+"""
+
+import argparse
+import concurrent.futures
+import json
+import random
+import time
+import urllib.parse
+import urllib.request
+
+BUFFER_SIZE = 2**16
+
+
+def percentile(values, p):
+  """Nearest-rank percentile of a list of numbers."""
+  if not values:
+    return None
+  ordered = sorted(values)
+  rank = max(0, int(round(p / 100.0 * len(ordered))) - 1)
+  return ordered[min(rank, len(ordered) - 1)]
+
+
+def stream(url, byte_range, timeout):
+  """Reads a URL, or a (start, end) range of it.
+
+  Returns (seconds to the first byte, seconds in all, bytes read, status).
+  """
+  headers = {}
+  if byte_range:
+    headers['Range'] = 'bytes=%d-%d' % (byte_range[0], byte_range[1] - 1)
+  start = time.monotonic()
+  first_byte = None
+  size = 0
+  try:
+    request = urllib.request.Request(url, headers=headers)
+    with urllib.request.urlopen(request, timeout=timeout) as rs:
+      status = rs.status
+      while True:
+        data = rs.read(BUFFER_SIZE)
+        if first_byte is None:
+          first_byte = time.monotonic() - start
+        if not data:
+          break
+        size += len(data)
+  except Exception as e:  # pylint: disable=broad-except
+    status = '%s' % e
+  return first_byte or 0, time.monotonic() - start, size, status
+
+
+def video_size(url, timeout):
+  request = urllib.request.Request(url, method='HEAD')
+  with urllib.request.urlopen(request, timeout=timeout) as rs:
+    return int(rs.headers['Content-Length'])
+
+
+def run_benchmark(base_url, project, asset, concurrency, streams, seeks,
+                  seek_bytes, timeout):
+  """Runs the streams and returns their throughput and latency stats."""
+  url = '%s/api/projects/%s/download/assets/?asset_path=%s' % (
+      base_url, project, urllib.parse.quote(asset))
+  size = video_size(url, timeout)
+  jobs = []
+  for _ in range(streams):
+    if not seeks:
+      jobs.append(None)
+      continue
+    for _ in range(seeks):
+      start = random.randrange(max(1, size - seek_bytes))
+      jobs.append((start, min(size, start + seek_bytes)))
+
+  first_bytes = []
+  errors = 0
+  total_bytes = 0
+  start = time.monotonic()
+  with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+    futures = [executor.submit(stream, url, job, timeout) for job in jobs]
+    for future in concurrent.futures.as_completed(futures):
+      first_byte, _, read, status = future.result()
+      first_bytes.append(first_byte)
+      total_bytes += read
+      if status not in (200, 206):
+        errors += 1
+  wall_time = time.monotonic() - start
+
+  return {
+      'video_bytes': size,
+      'concurrency': concurrency,
+      'requests': len(jobs),
+      'errors': errors,
+      'wall_time_s': round(wall_time, 3),
+      'throughput_mb_per_s': round(total_bytes / wall_time / 2**20, 1),
+      'first_byte_p50_ms': round(percentile(first_bytes, 50) * 1000, 1),
+      'first_byte_p99_ms': round(percentile(first_bytes, 99) * 1000, 1)
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--base_url",
+          help="Address of the running server",
+          default="http://localhost:8080")
+  parser.add_argument("--project",
+          help="Project of the video",
+          required=True)
+  parser.add_argument("--asset",
+          help="Video streamed, under the project's assets",
+          required=True)
+  parser.add_argument("--concurrency",
+          help="Concurrent streams",
+          type=int,
+          default=8)
+  parser.add_argument("--streams",
+          help="Total number of streams",
+          type=int,
+          default=32)
+  parser.add_argument("--seeks",
+          help="Range requests per stream, 0 to download whole videos",
+          type=int,
+          default=0)
+  parser.add_argument("--seek_bytes",
+          help="Bytes read after each seek",
+          type=int,
+          default=2**20)
+  parser.add_argument("--timeout",
+          help="Timeout of each request in seconds",
+          type=float,
+          default=300)
+  args = parser.parse_args()
+
+  results = run_benchmark(args.base_url, args.project, args.asset,
+                          args.concurrency, args.streams, args.seeks,
+                          args.seek_bytes, args.timeout)
+  print(json.dumps(results, indent=2))
+
+if __name__=='__main__':
+  main()
@@ -0,0 +1,187 @@
+# vim: set fileencoding=utf-8 :
+
+# Copyright 2019 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Disk usage of each project, kept in memory.
+
+A project's size is measured once, the first time it is asked for, and then
+kept up to date by the code that writes to it: renders, uploads, asset and
+feed uploads, clearing outputs, wrap their writes in tracking(paths), which
+adds the difference between the size of the paths before and after to their
+project. The paths are the files written, not the trees they are in, so a
+write costs a stat, and writes to other files of the tree at the same time
+are not counted twice. A background reconciler measures every project again
+from time to time, correcting whatever drift writes outside of tracking()
+left, like assets hardlinked twice in a project.
+
+Sizes are kept by each process: forked server workers only count their own
+writes, and see the others' when their reconciler runs.
+
+Sizes are disk blocks, counting hardlinked files once, like du.
+"""
+
+import contextlib
+import logging
+import math
+import os
+import stat
+import threading
+import time
+
+PROJECTS_DIR = 'projects'
+RECONCILE_INTERVAL = 15 * 60
+
+lock = threading.Lock()
+usage = {}
+reconciler_pid = None
+
+
+def project_of(path):
+  """Returns the id of the project a path belongs to, or None."""
+  relative = os.path.relpath(path, PROJECTS_DIR).split(os.sep)
+  if relative[0] in ('.', '..') or relative[0].startswith('.'):
+    return None
+  return relative[0]
+
+
+def disk_size(path):
+  """Returns the bytes of disk used by a file, or by a directory tree."""
+  try:
+    st = os.lstat(path)
+  except OSError:
+    return 0
+  total = st.st_blocks * 512
+  if not stat.S_ISDIR(st.st_mode):
+    return total
+  seen = set()
+  pending = [path]
+  while pending:
+    try:
+      entries = list(os.scandir(pending.pop()))
+    except OSError:
+      continue
+    for entry in entries:
+      try:
+        st = entry.stat(follow_symlinks=False)
+      except OSError:
+        continue
+      if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+        if (st.st_dev, st.st_ino) in seen:
+          continue
+        seen.add((st.st_dev, st.st_ino))
+      total += st.st_blocks * 512
+      if stat.S_ISDIR(st.st_mode):
+        pending.append(entry.path)
+  return total
+
+
+def add(project_id, delta):
+  with lock:
+    # projects not measured yet get their whole size when first asked for
+    if project_id in usage:
+      usage[project_id] += delta
+
+
+@contextlib.contextmanager
+def tracking(*paths):
+  """Adds how much the size of the paths changed to their projects.
+
+  Directories are measured whole, so only trees rewritten at once, like
+  cleared outputs, should be tracked as directories.
+  """
+  before = [disk_size(path) for path in paths]
+  try:
+    yield
+  finally:
+    for path, size in zip(paths, before):
+      project_id = project_of(path)
+      if project_id is not None:
+        add(project_id, disk_size(path) - size)
+
+
+def created(*paths):
+  """Adds the size of new files to their projects."""
+  for path in paths:
+    project_id = project_of(path)
+    if project_id is not None:
+      add(project_id, disk_size(path))
+
+
+def forget(project_id):
+  with lock:
+    usage.pop(project_id, None)
+
+
+def project_size(project_id):
+  """Returns the bytes used by a project, measuring it if not known yet."""
+  with lock:
+    size = usage.get(project_id)
+  if size is None:
+    size = disk_size(os.path.join(PROJECTS_DIR, project_id))
+    with lock:
+      size = usage.setdefault(project_id, size)
+  return size
+
+
+def reconcile():
+  """Measures every project again, replacing the sizes kept in memory."""
+  try:
+    project_ids = [d for d in os.listdir(PROJECTS_DIR) if d[0] != '.']
+  except OSError:
+    return
+  for project_id in project_ids:
+    size = disk_size(os.path.join(PROJECTS_DIR, project_id))
+    with lock:
+      known = usage.get(project_id)
+      usage[project_id] = size
+    if known is not None and known != size:
+      logging.info('Disk usage of %s drifted by %d bytes', project_id,
+                   size - known)
+  with lock:
+    for project_id in set(usage) - set(project_ids):
+      del usage[project_id]
+
+
+def start_reconciler(interval=RECONCILE_INTERVAL):
+  """Starts the reconciler thread of this process, if not started yet."""
+  global reconciler_pid
+  with lock:
+    # forked server workers do not inherit the thread of their parent
+    if reconciler_pid == os.getpid():
+      return
+    reconciler_pid = os.getpid()
+  def run():
+    while True:
+      time.sleep(interval)
+      try:
+        reconcile()
+      except Exception:  # pylint: disable=broad-except
+        logging.exception('Disk usage reconciliation failed')
+  threading.Thread(target=run, daemon=True).start()
+
+
+def format_size(size):
+  """Formats bytes like 'du -h' does, e.g. '2.1G'."""
+  units = ['', 'K', 'M', 'G', 'T', 'P']
+  value = float(size)
+  n = 0
+  while value >= 1024 and n < len(units) - 1:
+    value /= 1024
+    n += 1
+  if n == 0:
+    return '%d' % size
+  if value < 10:
+    return '%.1f%s' % (math.ceil(value * 10) / 10, units[n])
+  return '%d%s' % (math.ceil(value), units[n])
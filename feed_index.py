@@ -0,0 +1,268 @@
+# vim: set fileencoding=utf-8 :
+
+# Copyright 2019 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Row-offset index of feed files, to read any page of a feed with a seek.
+
+The index of a feed is the byte offset at which each of its CSV records
+starts, the header being record 0. Records end at newlines outside of
+quotes, so fields spanning lines stay in one record. An index is found by
+one scan of the feed, or recorded by feed_store while it writes the feed,
+and is kept in memory and saved next to the feed, in .feed.index, with the
+inode, size and mtime of the feed it describes: a feed changed any other
+way is scanned again when read.
+
+Rows are numbered as feed_store numbers them, 1-based, header excluded.
+"""
+
+import array
+import csv
+import io
+import os
+import re
+import struct
+import threading
+
+INDEX_FILE = '.feed.index'
+BUFFER_SIZE = 2**16
+# inode, size and mtime of the feed, then the offsets
+STAMP = struct.Struct('<QQQ')
+MAX_LIMIT = 1000
+# rows read at a time while filtering
+FILTER_BATCH = 500
+
+indexes = {}  # feed path -> FeedIndex
+indexes_lock = threading.Lock()
+
+
+class FeedIndex(object):
+  """The offsets of the records of a version of a feed file."""
+
+  def __init__(self, stamp, offsets):
+    self.stamp = stamp
+    self.offsets = offsets
+
+  @property
+  def rows(self):
+    return max(0, len(self.offsets) - 1)
+
+  def span(self, first, last):
+    """Returns the bytes of records first to last, not included."""
+    start = self.offsets[first]
+    end = (self.offsets[last] if last < len(self.offsets) else
+           self.stamp[1])
+    return start, end
+
+
+def stamp_of(st):
+  return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def scan(f):
+  """Returns the offsets of the records of a binary feed file."""
+  offsets = array.array('Q', [0])
+  position = 0
+  quotes = 0
+  f.seek(0)
+  while True:
+    data = f.read(BUFFER_SIZE)
+    if not data:
+      break
+    lines = data.split(b'\n')
+    for line in lines[:-1]:
+      position += len(line) + 1
+      # a doubled quote inside a field counts twice, so parity tells
+      quotes += line.count(b'"')
+      if not quotes % 2:
+        offsets.append(position)
+    quotes += lines[-1].count(b'"')
+    position += len(lines[-1])
+  if len(offsets) > 1 and offsets[-1] == position:
+    offsets.pop()
+  elif position == 0:
+    offsets.pop()
+  return offsets
+
+
+def load(feed_path, stamp):
+  """Returns the offsets saved for a version of a feed, or None."""
+  try:
+    with open(index_path(feed_path), 'rb') as f:
+      if STAMP.unpack(f.read(STAMP.size)) != stamp:
+        return None
+      offsets = array.array('Q')
+      offsets.frombytes(f.read())
+      f.close()
+    return offsets
+  except (OSError, struct.error, ValueError):
+    return None
+
+
+def save(feed_path, index):
+  path = index_path(feed_path)
+  temp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+  try:
+    with open(temp_path, 'wb') as f:
+      f.write(STAMP.pack(*index.stamp))
+      index.offsets.tofile(f)
+      f.close()
+    os.replace(temp_path, path)
+  except OSError:
+    # only costs a scan on the next start
+    if os.path.exists(temp_path):
+      os.unlink(temp_path)
+
+
+def index_path(feed_path):
+  return os.path.join(os.path.dirname(feed_path), INDEX_FILE)
+
+
+def get(feed_path, f):
+  """Returns the index of the feed open as binary file f."""
+  stamp = stamp_of(os.fstat(f.fileno()))
+  with indexes_lock:
+    index = indexes.get(feed_path)
+  if index is not None and index.stamp == stamp:
+    return index
+  offsets = load(feed_path, stamp)
+  if offsets is None:
+    offsets = scan(f)
+    index = FeedIndex(stamp, offsets)
+    save(feed_path, index)
+  else:
+    index = FeedIndex(stamp, offsets)
+  with indexes_lock:
+    indexes[feed_path] = index
+  return index
+
+
+def record(feed_path, offsets):
+  """Records the offsets of a feed just written, sparing a scan of it.
+
+  Must be called by the writer of the feed, before anything else writes it.
+  """
+  index = FeedIndex(stamp_of(os.stat(feed_path)), offsets)
+  save(feed_path, index)
+  with indexes_lock:
+    indexes[feed_path] = index
+
+
+class OffsetRecorder(object):
+  """Text file wrapper recording where each csv.writer row starts."""
+
+  def __init__(self, f):
+    self.f = f
+    self.position = 0
+    self.offsets = array.array('Q')
+
+  def write(self, text):
+    # csv.writer writes each row in one call
+    self.offsets.append(self.position)
+    self.position += len(text.encode('utf-8'))
+    return self.f.write(text)
+
+
+def read_records(f, index, first, last):
+  """Returns records first to last, not included, of an indexed feed."""
+  last = min(last, len(index.offsets))
+  if first >= last:
+    return []
+  start, end = index.span(first, last)
+  f.seek(start)
+  text = f.read(end - start).decode('utf-8', 'backslashreplace')
+  return list(csv.reader(io.StringIO(text.replace('\0', ''), newline='')))
+
+
+class Filter(object):
+  """A column=value, column!=value or column~substring row filter."""
+
+  PATTERN = re.compile(r'^(.+?)(!=|~|=)(.*)$', re.S)
+
+  def __init__(self, text):
+    match = self.PATTERN.match(text)
+    if not match:
+      raise ValueError('Invalid filter %r, use column=value, column!=value '
+                       'or column~text' % text)
+    self.column, self.op, self.value = match.groups()
+    self.position = None
+
+  def bind(self, header):
+    if self.column not in header:
+      raise ValueError('Unknown column %s' % self.column)
+    self.position = header.index(self.column)
+
+  def matches(self, row):
+    cell = row[self.position] if self.position < len(row) else ''
+    if self.op == '=':
+      return cell == self.value
+    if self.op == '!=':
+      return cell != self.value
+    return self.value.lower() in cell.lower()
+
+
+def page(feed_path, offset=0, limit=100, columns=None, filters=()):
+  """Returns a page of the rows of a feed.
+
+  Skips `offset` rows of the feed, then returns up to `limit` rows matching
+  all the filters (Filter texts), with only the given columns, as:
+
+    {"columns": [...], "rows": [[...], ...], "total": rows in the feed,
+     "offset": offset, "next_offset": offset to read the next page from}
+
+  next_offset is None after the last row. Filtered pages read the feed
+  from the offset until the page is full, so following next_offset never
+  reads a row twice. Raises ValueError on unknown columns or filters.
+  """
+  if offset < 0 or limit < 1:
+    raise ValueError('offset must be >= 0 and limit >= 1')
+  limit = min(limit, MAX_LIMIT)
+  filters = [Filter(text) for text in filters]
+  try:
+    f = open(feed_path, 'rb')
+  except FileNotFoundError:
+    return {'columns': [], 'rows': [], 'total': 0, 'offset': offset,
+            'next_offset': None}
+  with f:
+    index = get(feed_path, f)
+    header = read_records(f, index, 0, 1)
+    header = header[0] if header else []
+    for feed_filter in filters:
+      feed_filter.bind(header)
+    positions = None
+    if columns:
+      unknown = [c for c in columns if c not in header]
+      if unknown:
+        raise ValueError('Unknown columns %s' % unknown)
+      positions = [header.index(c) for c in columns]
+    rows = []
+    # record n is row n
+    record = offset + 1
+    while len(rows) < limit and record < len(index.offsets):
+      batch = limit - len(rows) if not filters else FILTER_BATCH
+      end = min(record + batch, len(index.offsets))
+      for n, row in enumerate(read_records(f, index, record, end)):
+        if all(feed_filter.matches(row) for feed_filter in filters):
+          rows.append(row)
+          if len(rows) == limit:
+            end = record + n + 1
+            break
+      record = end
+    f.close()
+  if positions is not None:
+    rows = [[row[p] if p < len(row) else '' for p in positions]
+            for row in rows]
+  return {'columns': columns or header, 'rows': rows, 'total': index.rows,
+          'offset': offset,
+          'next_offset': record - 1 if record < len(index.offsets) else None}
@@ -0,0 +1,453 @@
+# vim: set fileencoding=utf-8 :
+
+# Copyright 2019 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Writes of project feeds, streamed, atomic and recorded row by row.
+
+A feed is replaced by streaming a CSV or NDJSON body into a temp file next
+to feed.csv, row by row, and renaming it over feed.csv once complete, so
+readers never see half a feed. patch() applies row inserts, updates and
+deletes the same way, copying the rows it does not touch.
+
+Every write compares the rows it writes with the rows they replace and
+appends what changed to the project's feed_changes.jsonl:
+
+  {"version": 3, "rows": 1000, "inserted": [[12, 12]],
+   "updated": [[3, 3], [40, 45]], "deleted": [[7, 7]]}
+
+Changes are [first, last] ranges of row numbers, 1-based and header
+excluded: inserted and updated rows are numbered as in the new feed, deleted
+ones as in the previous feed. changes_since() returns them, so renders and
+exports can find the rows to redo without diffing feeds.
+
+Writes record where each row starts in feed_index, so the first page read
+of a new feed does not scan it.
+"""
+
+import array
+import contextlib
+import csv
+import fcntl
+import hashlib
+import io
+import json
+import os
+import stat
+import tempfile
+import threading
+import zlib
+
+try:
+  import brotli
+except ImportError:  # brotli bodies are refused
+  brotli = None
+
+import disk_usage
+import feed_index
+
+FEED_FILE = 'feed.csv'
+CHANGES_FILE = 'feed_changes.jsonl'
+LOCK_FILE = '.feed.lock'
+CSV = 'csv'
+NDJSON = 'ndjson'
+BUFFER_SIZE = 2**16
+# read once, as setting it is not thread safe
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+locks = {}
+locks_lock = threading.Lock()
+
+
+class FeedError(ValueError):
+  """A feed body or patch that cannot be applied."""
+
+
+def feed_path(project_id):
+  return os.path.join('projects', project_id, FEED_FILE)
+
+
+@contextlib.contextmanager
+def feed_lock(project_id):
+  """Serializes the writes of a feed, across threads and processes."""
+  with locks_lock:
+    lock = locks.setdefault(project_id, threading.Lock())
+  with lock, open(os.path.join('projects', project_id, LOCK_FILE),
+                  'a') as lock_file:
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class DecodingReader(io.RawIOBase):
+  """Raw binary stream decompressing a gzip, deflate or brotli stream."""
+
+  def __init__(self, stream, encoding):
+    super(DecodingReader, self).__init__()
+    self.stream = stream
+    if encoding == 'br':
+      if brotli is None:
+        raise FeedError('brotli bodies need the brotli module')
+      self.decompress = brotli.Decompressor().process
+    elif encoding in ('gzip', 'x-gzip', 'deflate'):
+      # 32 + MAX_WBITS reads both gzip and zlib headers
+      self.decompress = zlib.decompressobj(32 + zlib.MAX_WBITS).decompress
+    else:
+      raise FeedError('Unsupported encoding %s' % encoding)
+    self.pending = b''
+
+  def readable(self):
+    return True
+
+  def readinto(self, buffer):
+    while not self.pending:
+      data = self.stream.read(BUFFER_SIZE)
+      if not data:
+        return 0
+      try:
+        self.pending = self.decompress(data)
+      except Exception as e:  # pylint: disable=broad-except
+        # zlib.error, brotli.error
+        raise FeedError('Invalid compressed body: %s' % e)
+    size = min(len(buffer), len(self.pending))
+    buffer[:size] = self.pending[:size]
+    self.pending = self.pending[size:]
+    return size
+
+
+def text_stream(stream, encoding=None):
+  """Returns the text of a binary stream, decompressing it if encoded."""
+  if encoding and encoding != 'identity':
+    stream = DecodingReader(stream, encoding)
+  elif not isinstance(stream, io.RawIOBase):
+    stream = RawReader(stream)
+  return io.TextIOWrapper(io.BufferedReader(stream, BUFFER_SIZE),
+                          encoding='utf-8', errors='replace', newline='')
+
+
+class RawReader(io.RawIOBase):
+  """Raw binary stream of any object with read(size)."""
+
+  def __init__(self, stream):
+    super(RawReader, self).__init__()
+    self.stream = stream
+
+  def readable(self):
+    return True
+
+  def readinto(self, buffer):
+    data = self.stream.read(len(buffer))
+    buffer[:len(data)] = data
+    return len(data)
+
+
+def iter_rows(text, body_format):
+  """Yields the rows of a CSV or NDJSON text stream, the header first.
+
+  NDJSON lines are JSON arrays, the first one being the header, or JSON
+  objects, whose keys are the columns; the keys of the first object make
+  the header. Raises FeedError on objects with keys not in the header.
+  """
+  if body_format == CSV:
+    for row in csv.reader(text):
+      yield row
+    return
+  header = None
+  for n, line in enumerate(text):
+    if not line.strip():
+      continue
+    try:
+      value = json.loads(line)
+    except ValueError as e:
+      raise FeedError('Invalid JSON on line %d: %s' % (n + 1, e))
+    if isinstance(value, dict):
+      if header is None:
+        header = list(value)
+        yield header
+      unknown = [c for c in value if c not in header]
+      if unknown:
+        raise FeedError('Line %d has unknown columns %s' % (n + 1, unknown))
+      yield [cell_text(value.get(column)) for column in header]
+    elif isinstance(value, list):
+      if header is None:
+        header = value
+      yield [cell_text(v) for v in value]
+    else:
+      raise FeedError('Line %d is neither an array nor an object' % (n + 1))
+
+
+def cell_text(value):
+  if value is None:
+    return ''
+  if isinstance(value, str):
+    return value
+  return json.dumps(value)
+
+
+def row_hash(row):
+  """Returns a 64 bit hash of a row, to compare rows cheaply."""
+  digest = hashlib.sha1(json.dumps(row, ensure_ascii=False).encode('utf-8'))
+  return int.from_bytes(digest.digest()[:8], 'little')
+
+
+def write_rows(project_id, rows):
+  """Replaces the feed of a project with rows, the header first.
+
+  Rows are written as they are iterated, to a temp file renamed over the
+  feed once all of them are written. Returns the change record.
+  """
+  path = feed_path(project_id)
+  with feed_lock(project_id):
+    # rows are compared by position with the rows they replace
+    old_hashes = array.array('Q', (row_hash(row) for row in iter_feed(path)))
+    change = {'inserted': [], 'updated': [], 'deleted': []}
+    with replacing(path) as f:
+      f = feed_index.OffsetRecorder(f)
+      writer = csv.writer(f, dialect=csv.excel)
+      count = None
+      for count, row in enumerate(rows):
+        writer.writerow(row)
+        if count == 0:
+          continue
+        if count >= len(old_hashes):
+          change['inserted'].append(count)
+        elif row_hash(row) != old_hashes[count]:
+          change['updated'].append(count)
+      if count is None:
+        raise FeedError('The feed is empty')
+    feed_index.record(path, f.offsets)
+    change['deleted'] = list(range(count + 1, len(old_hashes)))
+    return record_change(project_id, change, count)
+
+
+def write_stream(project_id, stream, body_format=CSV, encoding=None):
+  """Replaces the feed of a project with a CSV or NDJSON stream."""
+  return write_rows(project_id,
+                    iter_rows(text_stream(stream, encoding), body_format))
+
+
+def patch(project_id, operations):
+  """Applies row operations to the feed of a project, all or none.
+
+  Operations are dicts, with 1-based row numbers of the feed as it is
+  before the patch:
+
+    {"op": "update", "row": 3, "values": {"column": "value", ...}}
+    {"op": "insert", "row": 3, "values": {...} or [...]}  # before row 3
+    {"op": "insert", "values": ...}  # after the last row
+    {"op": "delete", "row": 3}
+
+  Returns the change record. Raises FeedError, leaving the feed as it was,
+  if an operation does not apply.
+  """
+  path = feed_path(project_id)
+  with feed_lock(project_id):
+    rows = iter_feed(path)
+    header = next(rows, None)
+    if header is None:
+      raise FeedError('The feed has no header')
+    updates, inserts, deletes = parse_operations(operations, header)
+    change = {'inserted': [], 'updated': [], 'deleted': []}
+    with replacing(path) as f:
+      f = feed_index.OffsetRecorder(f)
+      writer = csv.writer(f, dialect=csv.excel)
+      writer.writerow(header)
+      written = 0
+      old_row = 0
+      for old_row, row in enumerate(rows, 1):
+        for values in inserts.pop(old_row, []):
+          writer.writerow(values)
+          written += 1
+          change['inserted'].append(written)
+        if old_row in deletes:
+          change['deleted'].append(old_row)
+          continue
+        row += [''] * (len(header) - len(row))
+        new_row = list(row)
+        for column, value in updates.pop(old_row, {}).items():
+          new_row[header.index(column)] = value
+        writer.writerow(new_row)
+        written += 1
+        if new_row != row:
+          change['updated'].append(written)
+      for values in inserts.pop(old_row + 1, []) + inserts.pop(None, []):
+        writer.writerow(values)
+        written += 1
+        change['inserted'].append(written)
+      missing = sorted(set(updates) | set(inserts) |
+                       (deletes - set(change['deleted'])))
+      if missing:
+        raise FeedError('Rows %s are not in the feed' % missing)
+    feed_index.record(path, f.offsets)
+    return record_change(project_id, change, written)
+
+
+def parse_operations(operations, header):
+  """Returns the updates, inserts and deletes of a patch, by row."""
+  updates = {}
+  inserts = {}
+  deletes = set()
+  if not isinstance(operations, list):
+    raise FeedError('Operations must be a list')
+  for n, operation in enumerate(operations):
+    if not isinstance(operation, dict):
+      raise FeedError('Operation %d is not an object' % n)
+    op = operation.get('op')
+    row = operation.get('row')
+    if row is not None and (not isinstance(row, int) or row < 1):
+      raise FeedError('Operation %d has an invalid row %r' % (n, row))
+    if op in ('update', 'delete') and row is None:
+      raise FeedError('Operation %d needs a row' % n)
+    if op == 'delete':
+      deletes.add(row)
+    elif op == 'update':
+      values = operation.get('values')
+      if not isinstance(values, dict):
+        raise FeedError('Operation %d needs values by column' % n)
+      unknown = [c for c in values if c not in header]
+      if unknown:
+        raise FeedError('Operation %d has unknown columns %s' % (n, unknown))
+      updates.setdefault(row, {}).update(
+          (c, cell_text(v)) for c, v in values.items())
+    elif op == 'insert':
+      inserts.setdefault(row, []).append(
+          insert_values(operation.get('values'), header, n))
+    else:
+      raise FeedError('Operation %d has an unknown op %r' % (n, op))
+  if deletes & set(updates):
+    raise FeedError('Rows %s are both updated and deleted' %
+                    sorted(deletes & set(updates)))
+  return updates, inserts, deletes
+
+
+def insert_values(values, header, n):
+  if isinstance(values, dict):
+    unknown = [c for c in values if c not in header]
+    if unknown:
+      raise FeedError('Operation %d has unknown columns %s' % (n, unknown))
+    return [cell_text(values.get(column)) for column in header]
+  if isinstance(values, list) and len(values) <= len(header):
+    return ([cell_text(v) for v in values] +
+            [''] * (len(header) - len(values)))
+  raise FeedError('Operation %d needs values by column, or a list of at '
+                  'most %d values' % (n, len(header)))
+
+
+def iter_feed(path):
+  """Yields the rows of a feed file, the header first."""
+  try:
+    f = open(path, 'r', encoding='utf-8', errors='backslashreplace',
+             newline='')
+  except FileNotFoundError:
+    return
+  with f:
+    for row in csv.reader(l.replace('\0', '') for l in f):
+      yield row
+
+
+@contextlib.contextmanager
+def replacing(path):
+  """Yields a text file that replaces path once closed without errors."""
+  fd, temp_path = tempfile.mkstemp(prefix='.feed_', suffix='.tmp',
+                                   dir=os.path.dirname(path))
+  try:
+    # mkstemp files are private, the feed keeps its mode
+    os.fchmod(fd, file_mode(path))
+    with disk_usage.tracking(path):
+      with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+        yield f
+        f.flush()
+        os.fsync(f.fileno())
+      os.replace(temp_path, path)
+  finally:
+    if os.path.exists(temp_path):
+      os.unlink(temp_path)
+
+
+def file_mode(path):
+  """Returns the mode of path, or the one open() gives new files."""
+  try:
+    return stat.S_IMODE(os.stat(path).st_mode)
+  except FileNotFoundError:
+    return 0o666 & ~UMASK
+
+
+def record_change(project_id, change, rows):
+  """Appends a change to the project's change log, returning it.
+
+  Must be called holding feed_lock().
+  """
+  changes_path = os.path.join('projects', project_id, CHANGES_FILE)
+  change = dict((kind, to_ranges(numbers)) for kind, numbers in change.items())
+  change['version'] = last_version(changes_path) + 1
+  change['rows'] = rows
+  with disk_usage.tracking(changes_path), open(changes_path, 'a') as f:
+    f.write(json.dumps(change, sort_keys=True) + '\n')
+    f.close()
+  return change
+
+
+def to_ranges(numbers):
+  """Returns sorted numbers as [first, last] ranges of consecutive ones."""
+  ranges = []
+  for n in numbers:
+    if ranges and ranges[-1][1] == n - 1:
+      ranges[-1][1] = n
+    else:
+      ranges.append([n, n])
+  return ranges
+
+
+def last_version(changes_path):
+  """Returns the version of the last change of a log, reading its end."""
+  try:
+    with open(changes_path, 'rb') as f:
+      end = f.seek(0, os.SEEK_END)
+      data = b''
+      # the last line is the one after the last newline but the final one
+      while end > 0 and data.count(b'\n') < 2:
+        start = max(0, end - BUFFER_SIZE)
+        f.seek(start)
+        data = f.read(end - start) + data
+        end = start
+      f.close()
+  except FileNotFoundError:
+    return 0
+  lines = data.rstrip(b'\n').split(b'\n')
+  try:
+    return json.loads(lines[-1])['version']
+  except (ValueError, KeyError):
+    return 0
+
+
+def changes_since(project_id, version):
+  """Returns the change records of a feed newer than a version, in order."""
+  changes_path = os.path.join('projects', project_id, CHANGES_FILE)
+  changes = []
+  try:
+    with open(changes_path) as f:
+      for line in f:
+        try:
+          change = json.loads(line)
+        except ValueError:
+          continue
+        if change['version'] > version:
+          changes.append(change)
+      f.close()
+  except FileNotFoundError:
+    pass
+  return changes
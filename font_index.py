@@ -0,0 +1,302 @@
+# vim: set fileencoding=utf-8 :
+
+# Copyright 2019 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent index of the fonts of the system and of the projects.
+
+The index records, for each directory, its mtime, its subdirectories and its
+font files, with the family and style names read from each font's 'name'
+table. A refresh walks the directories again but only lists, and only reads
+the fonts of, the directories whose mtime changed, so an unchanged font
+package costs a stat per directory. The index is kept in memory and saved
+to projects/.font_index.json, so a restarted server starts warm.
+
+A font edited in place keeps its directory's mtime and is not read again;
+replacing it, like copying a new file over it, does update the index.
+"""
+
+import json
+import os
+import re
+import struct
+import threading
+import time
+
+INDEX_FILE = os.path.join('projects', '.font_index.json')
+FONT_EXTENSIONS = ('.ttf', '.otf', '.ttc')
+SYSTEM_FONT_DIRS = [
+    '/Library/Fonts',
+    '/System/Library/Fonts',
+    '/usr/share/fonts',
+    '~/fonts',
+    '~/.fonts',
+]
+# Requests within this many seconds of a refresh are served as they are.
+REFRESH_INTERVAL = 10
+
+# name IDs of the 'name' table
+FAMILY, SUBFAMILY, FULL_NAME = 1, 2, 4
+TYPOGRAPHIC_FAMILY, TYPOGRAPHIC_SUBFAMILY = 16, 17
+
+
+def read_font_names(file_path):
+  """Returns the family, style and full names of a TrueType/OpenType font.
+
+  Collections (.ttc) give the names of their first font. Returns None if
+  the file is not a font, or has no name table.
+  """
+  with open(file_path, 'rb') as f:
+    header = f.read(12)
+    if header[:4] == b'ttcf':
+      # a collection starts with the offsets of its fonts
+      f.seek(12)
+      (font_offset,) = struct.unpack('>I', f.read(4))
+      f.seek(font_offset)
+      header = f.read(12)
+    if len(header) < 12 or header[:4] not in (b'\x00\x01\x00\x00', b'OTTO',
+                                              b'true'):
+      return None
+    (num_tables,) = struct.unpack('>H', header[4:6])
+    directory = f.read(16 * num_tables)
+    for i in range(num_tables):
+      tag, _, offset, length = struct.unpack(
+          '>4sIII', directory[16 * i:16 * (i + 1)])
+      if tag == b'name':
+        f.seek(offset)
+        return parse_name_table(f.read(length))
+  return None
+
+
+def parse_name_table(data):
+  _, count, strings_offset = struct.unpack('>HHH', data[:6])
+  names = {}
+  for i in range(count):
+    platform, encoding, language, name_id, length, offset = struct.unpack(
+        '>HHHHHH', data[6 + 12 * i:18 + 12 * i])
+    if name_id not in (FAMILY, SUBFAMILY, FULL_NAME, TYPOGRAPHIC_FAMILY,
+                       TYPOGRAPHIC_SUBFAMILY):
+      continue
+    raw = data[strings_offset + offset:strings_offset + offset + length]
+    # Windows English names first, then any Unicode one, then Macintosh
+    if platform == 3 and language == 0x409:
+      rank, value = 0, raw.decode('utf-16-be', 'replace')
+    elif platform in (0, 3):
+      rank, value = 1, raw.decode('utf-16-be', 'replace')
+    elif platform == 1 and encoding == 0:
+      rank, value = 2, raw.decode('mac_roman', 'replace')
+    else:
+      continue
+    if name_id not in names or rank < names[name_id][0]:
+      names[name_id] = (rank, value)
+  if not names:
+    return None
+  family = (names.get(TYPOGRAPHIC_FAMILY) or names.get(FAMILY) or
+            (0, ''))[1]
+  style = (names.get(TYPOGRAPHIC_SUBFAMILY) or names.get(SUBFAMILY) or
+           (0, ''))[1]
+  full_name = names.get(FULL_NAME, (0, ('%s %s' % (family, style)).strip()))[1]
+  return {'family': family, 'style': style, 'full_name': full_name}
+
+
+def name_from_file_name(filename):
+  """Makes a display name of a font file name, like 'Open Sans Bold'."""
+  stem = os.path.splitext(filename)[0].replace('_', ' ').replace('-', ' ')
+  name = ' '.join(re.findall('[A-Z][^A-Z]*', stem))
+  if not name:
+    name = ' '.join([w.capitalize() for w in stem.split(' ')])
+  return name
+
+
+def normalize_name(name):
+  return re.sub(r'[\s_-]+', '', name.lower())
+
+
+class FontIndex(object):
+  """The fonts found under a set of directories, refreshed incrementally."""
+
+  def __init__(self, index_file=INDEX_FILE):
+    self.index_file = index_file
+    self.lock = threading.Lock()
+    self.dirs = None  # path -> {'mtime', 'subdirs', 'fonts'}
+    self.refreshed_at = {}  # root -> time.monotonic() of its last refresh
+    self.version = 0
+    self.lookups = {}  # tuple of roots -> (version, {lower case name: path})
+
+  def load(self):
+    try:
+      with open(self.index_file) as f:
+        self.dirs = json.load(f)['dirs']
+        f.close()
+    except (OSError, ValueError, KeyError):
+      self.dirs = {}
+
+  def save(self):
+    directory = os.path.dirname(self.index_file)
+    if directory and not os.path.isdir(directory):
+      return
+    temp_file = '%s.%d.%d.tmp' % (self.index_file, os.getpid(),
+                                  threading.get_ident())
+    with open(temp_file, 'w') as f:
+      json.dump({'dirs': self.dirs}, f)
+      f.close()
+    os.replace(temp_file, self.index_file)
+
+  def refresh(self, roots, force=False):
+    """Brings the index of the given root directories up to date."""
+    with self.lock:
+      if self.dirs is None:
+        self.load()
+      now = time.monotonic()
+      changed = False
+      for root in roots:
+        root = os.path.expanduser(root)
+        if not force and now - self.refreshed_at.get(root, -1e9) < \
+            REFRESH_INTERVAL:
+          continue
+        changed = self.refresh_tree(root) or changed
+        self.refreshed_at[root] = now
+      if changed:
+        self.version += 1
+        self.save()
+
+  def refresh_tree(self, root):
+    changed = False
+    pending = [root]
+    while pending:
+      path = pending.pop()
+      try:
+        mtime = os.stat(path).st_mtime
+      except OSError:
+        if path in self.dirs:
+          self.forget(path)
+          changed = True
+        continue
+      entry = self.dirs.get(path)
+      if entry is None or entry['mtime'] != mtime:
+        entry = self.scan(path, mtime, entry)
+        self.dirs[path] = entry
+        changed = True
+      pending.extend(entry['subdirs'])
+    return changed
+
+  def scan(self, path, mtime, previous):
+    """Lists a directory, reading the fonts that are new or replaced."""
+    known = previous['fonts'] if previous else {}
+    subdirs = []
+    fonts = {}
+    try:
+      entries = list(os.scandir(path))
+    except OSError:
+      entries = []
+    for entry in entries:
+      try:
+        if entry.is_dir():
+          subdirs.append(entry.path)
+          continue
+        if not entry.name.lower().endswith(FONT_EXTENSIONS):
+          continue
+        stat = entry.stat()
+      except OSError:
+        continue
+      font = known.get(entry.name)
+      if (font is None or font['mtime'] != stat.st_mtime or
+          font['size'] != stat.st_size):
+        try:
+          names = read_font_names(entry.path)
+        except (OSError, struct.error):
+          names = None
+        font = {'mtime': stat.st_mtime, 'size': stat.st_size}
+        font.update(names or {'family': '', 'style': '', 'full_name': ''})
+      fonts[entry.name] = font
+    if previous:
+      # subdirectories that are gone take their own subdirectories along
+      for subdir in set(previous['subdirs']) - set(subdirs):
+        self.forget(subdir)
+    return {'mtime': mtime, 'subdirs': sorted(subdirs), 'fonts': fonts}
+
+  def forget(self, path):
+    entry = self.dirs.pop(path, None)
+    if entry:
+      for subdir in entry['subdirs']:
+        self.forget(subdir)
+
+  def fonts(self, roots):
+    """Returns the fonts under the roots, as dicts with path and names."""
+    self.refresh(roots)
+    result = []
+    with self.lock:
+      pending = [os.path.expanduser(root) for root in roots]
+      seen = set()
+      while pending:
+        path = pending.pop()
+        entry = self.dirs.get(path)
+        if entry is None or path in seen:
+          continue
+        seen.add(path)
+        for filename, font in entry['fonts'].items():
+          name = font['full_name'] or name_from_file_name(filename)
+          result.append({'name': name, 'path': os.path.join(path, filename),
+                         'family': font['family'], 'style': font['style']})
+        pending.extend(entry['subdirs'])
+    return result
+
+  def find(self, name, roots):
+    """Returns the path of the font with the given name, or None.
+
+    The name is matched, ignoring case, spaces, dashes and underscores,
+    against the full names, then family and style, then the families, then
+    the file names without extension.
+    """
+    self.refresh(roots)
+    roots = tuple(roots)
+    with self.lock:
+      version, lookup = self.lookups.get(roots, (None, None))
+      current_version = self.version
+    if version != current_version:
+      # a family name alone gives its regular style
+      fonts = sorted(self.fonts(roots), key=lambda f: (
+          f['style'].lower() not in ('regular', 'normal', 'book', ''),
+          f['path']))
+      lookup = {}
+      for names in (lambda f: f['name'],
+                    lambda f: f['family'] + f['style'],
+                    lambda f: f['family'],
+                    lambda f: os.path.splitext(os.path.basename(f['path']))[0]):
+        for font in fonts:
+          lookup.setdefault(normalize_name(names(font)), font['path'])
+      lookup.pop('', None)
+      with self.lock:
+        self.lookups[roots] = (current_version, lookup)
+    return lookup.get(normalize_name(name))
+
+
+index = FontIndex()
+
+
+def project_font_dirs(project_id):
+  return [os.path.join('projects', project_id, 'assets')] + SYSTEM_FONT_DIRS
+
+
+def list_fonts(project_id):
+  """Returns [display name, path] of the fonts a project can use."""
+  return sorted([font['name'], font['path']]
+                for font in index.fonts(project_font_dirs(project_id)))
+
+
+def find_font(name, project_id=None):
+  """Returns the path of a font given its name, or None."""
+  if project_id is None:
+    return index.find(name, SYSTEM_FONT_DIRS)
+  return index.find(name, project_font_dirs(project_id))
@@ -14,85 +14,622 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import concurrent.futures
 import csv
+import disk_usage
+import glob
+import hashlib
+import json
+import locale
 import vogon
 import logging
-import yt_api
+import row_mapper
+import upload_manifest
 import os
+import re
+import shutil
+import tempfile
+from io import StringIO
 
-def build_csv(project_id):
+# Shards of a sharded export, see write_streaming_csv.
+SHARD_BY_ACCOUNT = 'account'
+SHARD_BY_CAMPAIGN = 'campaign'
+SHARD_WORKERS = 4
+SHARDS_DIR = 'google_ads_editor'
+SNAPSHOT_FILE = 'google_ads_editor_snapshot.json'
+
+# Section lines are buffered as bytes, in the encoding open() uses by default.
+ENCODING = locale.getpreferredencoding(False)
+COPY_BUFFER_SIZE = 2**20  # 1MB
+
+def build_csv(project_id, shard_by=None, max_rows=0, delta=False,
+              workers=1, channel_id=None, shards_dir=None):
+  """Writes the Editor CSV of a project.
+
+  Without shard_by nor max_rows the CSV is projects/<id>/google_ads_editor.csv,
+  otherwise it is split in CSV files written to shards_dir, by default
+  projects/<id>/google_ads_editor, and listed by shard_files.
+
+  Every export saves a snapshot of the entities it wrote. With delta, only
+  the entities added or changed since the last export are written.
+
+  With more than one worker, the template substitution and target expansion
+  of the feed rows is spread over that many processes.
+
+  The ads use the videos uploaded to channel_id, by default the channel of
+  the latest upload of the project.
+  """
   error_message = None
+  counts = (0, 0)
   try:
     config_uri = os.path.join("projects", project_id, "config.json")
     config = vogon.load_config(config_uri)
 
     feed_uri = os.path.join("projects", project_id, "feed.csv")
-    data = vogon.read_csv_file(feed_uri, ',')
-    lines = enumerate(data)
-
-    uploaded_video_list = yt_api.get_latest_uploaded_videos(project_id)
-    adwords = config['adwords']
-    campaigns = {}
-    adgroups = {}
-    ads = {}
-    targets = {}
-    uploaded_videos = 0
-    missing_videos = 0
-
-    for i, row in lines:
-      account = vogon.replace_vars(adwords.get('Account', ''), row)
-
-      # First, look for the video ID in the upload job log. If it's not there,
-      # look for a column named 'youtube_video_id' in the feed.
-      youtube_video_id = uploaded_video_list.get(str(i+1), None)
-      if not youtube_video_id:
-        youtube_video_id = 'MISSING'
-        missing_videos += 1
-      else:
-        uploaded_videos += 1
-      row['video_id'] = youtube_video_id
-
-      # Set up campaigns
-      campaign = vogon.replace_vars_in_dict(adwords['campaign'], row)
-      campaign['Account'] = account
-      campaigns[campaign['name']] = campaign
-
-      # Set up campaign targets
-      target_list = vogon.replace_vars_in_targets(adwords['targets'], row)
-      campaign_targets = [t for t in target_list if t['level'] == 'Campaign']
-      campaign['targets'] = target_list
-
-      # Set up ad groups
-      adgroup_name = vogon.replace_vars(campaign['Ad Group name'], row)
-      adgroup = {'name': adgroup_name, 'Campaign': campaign}
-      adgroups[adgroup_name] = adgroup
-
-      # Set up ad group targets
-      adgroup_targets = [t for t in target_list if t['level'] == 'Ad Group']
-      adgroup['targets'] = target_list
-
-      # Set up ads
-      ad = vogon.replace_vars_in_dict(adwords['ad'], row)
-      ad['Account'] = account
-      ad['Campaign'] = campaign['name']
-      ad['Ad Group'] = adgroup['name']
-      ad['Video id'] = youtube_video_id
-      ad['Video'] = youtube_video_id
-      ads[ad['name']] = ad
-
-      # Set up legacy targets for Bulk
-      targets[campaign['name']] = target_list
-      print(campaign['targets'])
-      print(adgroup['targets'])
 
     # Write AdWords CSV
-    awv_csv_file = os.path.join("projects", project_id, "google_ads_editor.csv")
-    awv_editor_csv = GoogleAdsEditorCsv(campaigns, adgroups, ads)
-    awv_editor_csv.write_to_file(awv_csv_file)
+    if shard_by or max_rows:
+      output_path = shards_dir or shards_path(project_id)
+    else:
+      output_path = os.path.join("projects", project_id,
+                                 "google_ads_editor.csv")
+    snapshot = ExportSnapshot(
+        os.path.join("projects", project_id, SNAPSHOT_FILE))
+    with disk_usage.tracking(output_path, snapshot.file_path):
+      manifest = upload_manifest.UploadManifest.open_existing(project_id)
+      try:
+        if manifest is not None and channel_id is None:
+          channel_id = manifest.last_channel()
+        counts = write_streaming_csv(config['adwords'], feed_uri, manifest,
+                                     output_path, shard_by, max_rows,
+                                     snapshot, delta, workers, channel_id)
+      finally:
+        if manifest is not None:
+          manifest.close()
+      snapshot.save()
   except Exception as e:
     error_message = "%s"%e
 
-  return (uploaded_videos, missing_videos), error_message
+  return counts, error_message
+
+
+def shards_path(project_id):
+  return os.path.join("projects", project_id, SHARDS_DIR)
+
+
+def new_shards_dir(project_id):
+  """Makes a directory for the shards of one export, see build_csv.
+
+  Each export gets its own, so exports running at once, or an export during
+  the download of the previous one, never change each other's files. The
+  caller removes it with remove_shards_dir.
+  """
+  return tempfile.mkdtemp(prefix='.%s_' % SHARDS_DIR,
+                          dir=os.path.join("projects", project_id))
+
+
+def remove_shards_dir(shards_dir):
+  with disk_usage.tracking(shards_dir):
+    shutil.rmtree(shards_dir, ignore_errors=True)
+
+
+def shard_files(shards_dir):
+  """Returns the paths of the CSV files of a sharded export."""
+  return sorted(glob.glob(os.path.join(shards_dir, '*.csv')))
+
+
+def row_entities(adwords, row, youtube_video_id):
+  """Builds the campaign, ad group and ad of a feed row.
+
+  Args:
+    adwords: the 'adwords' section of the project config.
+    row: dict of the feed row, which receives the 'video_id' column.
+    youtube_video_id: ID of the row's video on YouTube.
+
+  Returns:
+    A (campaign, adgroup, ad) tuple of dicts, in the format expected by
+    GoogleAdsEditorCsv.
+  """
+  account = vogon.replace_vars(adwords.get('Account', ''), row)
+  row['video_id'] = youtube_video_id
+
+  # Set up campaigns
+  campaign = vogon.replace_vars_in_dict(adwords['campaign'], row)
+  campaign['Account'] = account
+
+  # Set up campaign and ad group targets, filtered by level later on
+  target_list = vogon.replace_vars_in_targets(adwords['targets'], row)
+  campaign['targets'] = target_list
+
+  # Set up ad groups
+  adgroup_name = vogon.replace_vars(campaign['Ad Group name'], row)
+  adgroup = {'name': adgroup_name, 'Campaign': campaign}
+  adgroup['targets'] = target_list
+
+  # Set up ads
+  ad = vogon.replace_vars_in_dict(adwords['ad'], row)
+  ad['Account'] = account
+  ad['Campaign'] = campaign['name']
+  ad['Ad Group'] = adgroup['name']
+  ad['Video id'] = youtube_video_id
+  ad['Video'] = youtube_video_id
+  return campaign, adgroup, ad
+
+
+def row_video_id(manifest, channel_id, row_number):
+  """Looks for the video ID of a feed row on a channel in the manifest."""
+  youtube_video_id = None
+  if manifest is not None and channel_id is not None:
+    youtube_video_id = manifest.video_id_for_row(channel_id, row_number)
+  return youtube_video_id if youtube_video_id else 'MISSING'
+
+
+def write_streaming_csv(adwords, feed_uri, manifest, file_name,
+                        shard_by=None, max_rows=0, snapshot=None,
+                        delta=False, workers=1, channel_id=None):
+  """Writes the Editor CSV of a feed without holding its entities in memory.
+
+  The output is the same GoogleAdsEditorCsv writes, but the feed is read
+  twice. The first pass indexes the row where each campaign, ad group and ad
+  appears for the last time, which is the one whose values are exported,
+  and the order of their first appearance, which is the order of the output.
+  The second pass computes the lines of each entity at that last row, and
+  writes them through a SectionBuffer per section, which spills lines that
+  arrive before their turn to disk.
+
+  With shard_by or max_rows, file_name is a folder that receives one CSV per
+  shard instead. Every line is labelled with the campaign it belongs to, so
+  a campaign, its ad groups, targets and ads always share a shard.
+
+  Args:
+    shard_by: SHARD_BY_ACCOUNT to never mix accounts in a shard, or
+      SHARD_BY_CAMPAIGN to pack campaigns of any account together.
+    max_rows: maximum number of lines per shard, besides the header, or 0
+      for no limit. Campaigns with more lines get a shard of their own.
+    snapshot: ExportSnapshot receiving the hashes of the exported entities.
+    delta: whether to write only the entities whose hash differs from the
+      one in the snapshot, keeping the order of a full export.
+    workers: number of processes computing the entities of the rows, see
+      row_mapper.RowMapper.
+    channel_id: YouTube channel whose videos the ads use. manifest may be
+      None, when nothing was uploaded yet.
+
+  Returns:
+    A tuple with the number of uploaded and missing videos.
+  """
+  campaigns = {}  # name: [position, last row, campaign type]
+  adgroups = {}  # name: [position, last row, campaign name, gender targeted]
+  ads = {}  # name: [position, last row]
+  with row_mapper.RowMapper(workers) as mapper:
+    # only the names are needed, targets are left for the second pass
+    jobs = ((i, row, row_video_id(manifest, channel_id, i+1))
+            for i, row in enumerate(vogon.iter_csv_file(feed_uri, ',')))
+    for i, (c_name, c_type, adgroup_name, ad_name) in mapper.map(
+        row_names, (adwords,), jobs):
+      index_entity(campaigns, c_name, i, c_type)
+      index_entity(adgroups, adgroup_name, i, c_name, False)
+      index_entity(ads, ad_name, i)
+
+    # Ad groups and ads inherit the type of the last campaign in the file.
+    is_bumper = False
+    if campaigns:
+      last_campaign = list(campaigns.values())[-1]
+      is_bumper = (last_campaign[2] == 'Video - Bumper ad')
+
+    # Campaigns without ad groups get a default one, after all the others.
+    campaigns_with_adgroups = set(ag[2] for ag in adgroups.values())
+    default_adgroup_positions = {}
+    for c_name in campaigns:
+      if c_name not in campaigns_with_adgroups:
+        default_adgroup_positions[c_name] = (len(adgroups) +
+                                             len(default_adgroup_positions))
+    default_adgroups = []
+
+    campaign_last_rows = dict((c[1], c_name)
+                              for c_name, c in campaigns.items())
+    adgroup_last_rows = dict((ag[1], ag_name)
+                             for ag_name, ag in adgroups.items())
+    ad_last_rows = dict((ad[1], ad_name) for ad_name, ad in ads.items())
+
+    counts = [0, 0]  # uploaded and missing videos
+    def entity_jobs():
+      for i, row in enumerate(vogon.iter_csv_file(feed_uri, ',')):
+        youtube_video_id = row_video_id(manifest, channel_id, i+1)
+        counts[youtube_video_id == 'MISSING'] += 1
+        if (i not in campaign_last_rows and i not in adgroup_last_rows and
+            i not in ad_last_rows):
+          continue
+        adgroup_position = None
+        if i in adgroup_last_rows:
+          adgroup_position = adgroups[adgroup_last_rows[i]][0]
+        yield (i, row, youtube_video_id, i in campaign_last_rows,
+               campaign_last_rows.get(i) in default_adgroup_positions,
+               adgroup_position, i in ad_last_rows)
+
+    campaign_accounts = {}
+    with SectionBuffer('campaign') as campaign_section, \
+         SectionBuffer('adgroup') as adgroup_section, \
+         SectionBuffer('target') as target_section, \
+         SectionBuffer('target') as gender_section, \
+         SectionBuffer('campaign_target') as campaign_target_section, \
+         SectionBuffer('ad') as ad_section:
+      for i, lines in mapper.map(row_entity_lines, (adwords, is_bumper),
+                                 entity_jobs()):
+        if 'campaign' in lines:
+          c_name = campaign_last_rows[i]
+          position = campaigns[c_name][0]
+          account, campaign_lines, target_lines, adg = lines['campaign']
+          add_entity(snapshot, delta, 'campaign', c_name, c_name, [
+              (campaign_section, position, campaign_lines),
+              (campaign_target_section, position, target_lines)])
+          campaign_accounts[c_name] = account
+          if adg is not None:
+            default_adgroups.append((default_adgroup_positions[c_name], adg))
+
+        if 'adgroup' in lines:
+          ag_index = adgroups[adgroup_last_rows[i]]
+          position = ag_index[0]
+          c_name, adgroup_lines, target_lines, gender_lines, \
+              gender_targeted = lines['adgroup']
+          ag_index[3] = gender_targeted
+          add_entity(snapshot, delta, 'adgroup', adgroup_last_rows[i],
+                     c_name, [
+                         (adgroup_section, position, adgroup_lines),
+                         (target_section, position, target_lines),
+                         (gender_section, position, gender_lines)])
+
+        if 'ad' in lines:
+          c_name, ad_lines = lines['ad']
+          add_entity(snapshot, delta, 'ad', ad_last_rows[i], c_name, [
+              (ad_section, ads[ad_last_rows[i]][0], ad_lines)])
+
+      # Default ad groups come after all the others, so they are added once
+      # the gender targeting of every regular ad group is known.
+      for position, adg in sorted(default_adgroups, key=lambda d: d[0]):
+        # Default ad groups are gender targeted only if a regular ad group
+        # has the same name.
+        ag_index = adgroups.get(adg['Ad group'])
+        gender_targeted = ag_index is not None and ag_index[3]
+        add_entity(snapshot, delta, 'default_adgroup', adg['Campaign'],
+                   adg['Campaign'], [
+                       (adgroup_section, position,
+                        encode_section_lines('adgroup', [adg])),
+                       (gender_section, position,
+                        encode_section_lines(
+                            'target',
+                            [] if gender_targeted else gender_values(adg)))])
+
+      sections = (campaign_section, adgroup_section, target_section,
+                  gender_section, campaign_target_section, ad_section)
+      if shard_by or max_rows:
+        shards = assign_shards(campaigns, campaign_accounts, sections,
+                               shard_by, max_rows)
+        write_csv_shards(file_name, sections, shards)
+      else:
+        write_csv_file(file_name, sections)
+
+  return tuple(counts)
+
+
+def row_names(adwords, job):
+  """Returns the names of the campaign, its type, ad group and ad of a row."""
+  _, row, youtube_video_id = job
+  row['video_id'] = youtube_video_id
+  campaign = vogon.replace_vars_in_dict(adwords['campaign'], row)
+  adgroup_name = vogon.replace_vars(campaign['Ad Group name'], row)
+  ad_name = vogon.replace_vars_in_dict({'name': adwords['ad']['name']},
+                                       row)['name']
+  return (campaign['name'], campaign['Campaign Type'], adgroup_name, ad_name)
+
+
+def row_entity_lines(adwords, is_bumper, job):
+  """Encodes the lines of the entities whose last row is a feed row.
+
+  Args:
+    job: tuple of the row index, the row, its video ID, whether the row is
+      the last of its campaign, whether that campaign gets a default ad
+      group, the position of the ad group if the row is its last one, and
+      whether the row is the last of its ad.
+
+  Returns:
+    A dict with the 'campaign', 'adgroup' and 'ad' entities of the row, each
+    a tuple with the name of its campaign, or account for campaigns, and the
+    (data, number of lines) of each of its sections.
+  """
+  (_, row, youtube_video_id, campaign_last, default_adgroup, adgroup_position,
+   ad_last) = job
+  campaign, adgroup, ad = row_entities(adwords, row, youtube_video_id)
+  lines = {}
+  if campaign_last:
+    adg = None
+    if default_adgroup:
+      adg = default_adgroup_values(campaign, is_bumper)
+    lines['campaign'] = (
+        campaign['Account'],
+        encode_section_lines('campaign', [campaign_values(campaign)]),
+        encode_section_lines('campaign_target',
+                             campaign_target_values(campaign)),
+        adg)
+
+  if adgroup_position is not None:
+    c = adgroup['Campaign']
+    adgroup_name = adgroup.get('name', None)
+    if not adgroup_name:
+      adgroup_name = AD_GROUP_BASE_NAME % (adgroup_position + 1, c['name'])
+    adg = adgroup_values(adgroup_name, c, is_bumper)
+    target_values, gender_targeted = adgroup_target_values(
+        adgroup['targets'], adgroup_name, c)
+    lines['adgroup'] = (
+        c['name'],
+        encode_section_lines('adgroup', [adg]),
+        encode_section_lines('target', target_values),
+        encode_section_lines(
+            'target', [] if gender_targeted else gender_values(adg)),
+        gender_targeted)
+
+  if ad_last:
+    lines['ad'] = (ad['Campaign'],
+                   encode_section_lines('ad', [ad_values(ad, is_bumper)]))
+  return lines
+
+
+def add_entity(snapshot, delta, kind, name, campaign_name, parts):
+  """Adds the lines of an entity to its sections.
+
+  Args:
+    snapshot: ExportSnapshot receiving the hash of the entity's lines, or
+      None.
+    delta: whether to leave the entity out when its lines did not change
+      since the snapshot was saved.
+    kind: 'campaign', 'adgroup', 'default_adgroup' or 'ad'.
+    name: name of the entity, unique among the entities of its kind.
+    campaign_name: campaign the lines belong to.
+    parts: list of (section, position, (data, number of lines)) tuples with
+      the lines of the entity in each section, see encode_section_lines.
+  """
+  changed = True
+  if snapshot is not None:
+    changed = snapshot.update(kind, name,
+                              [data for _, _, (data, _) in parts])
+  for section, position, (data, rows) in parts:
+    if delta and not changed:
+      # the position is still filled, so the next entities keep their order
+      section.add_encoded(position, b'', 0, campaign_name)
+    else:
+      section.add_encoded(position, data, rows, campaign_name)
+
+
+def encode_section_lines(section_type, values):
+  """Returns the bytes and the number of lines of values in a section."""
+  return (encode_lines(line_values(line, section_type) for line in values),
+          len(values))
+
+
+def write_csv_file(file_name, sections, campaign_names=None):
+  """Writes the header and the lines of each section to a CSV file.
+
+  Writes to a temporary file, so a failed export does not leave a truncated
+  CSV behind. With campaign_names, only the lines of those campaigns are
+  written.
+  """
+  csv_dir = os.path.dirname(os.path.abspath(file_name))
+  (fd, temp_file_name) = tempfile.mkstemp(prefix='vogon_', suffix='.csv',
+                                          dir=csv_dir)
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      f.write(encode_lines([pad_line(FILE_HEADERS)]))
+      for section in sections:
+        section.copy_to(f, campaign_names)
+      f.close()
+    os.replace(temp_file_name, file_name)
+  except Exception:
+    if os.path.exists(temp_file_name):
+      os.unlink(temp_file_name)
+    raise
+
+
+def assign_shards(campaigns, campaign_accounts, sections, shard_by, max_rows):
+  """Packs campaigns in shards, in the order they appear in the output.
+
+  Returns:
+    A list of (file name, set of campaign names) tuples.
+  """
+  campaign_rows = {}
+  for section in sections:
+    for c_name, rows in section.rows.items():
+      campaign_rows[c_name] = campaign_rows.get(c_name, 0) + rows
+  shards = []
+  open_shards = {}  # account or None: [file name, campaign names, rows]
+  shard_counts = {}
+  for c_name in campaigns:
+    group = None
+    if shard_by == SHARD_BY_ACCOUNT:
+      group = campaign_accounts.get(c_name, '')
+    rows = campaign_rows.get(c_name, 0)
+    shard = open_shards.get(group)
+    if shard is None or (max_rows and shard[2] and
+                         shard[2] + rows > max_rows):
+      if max_rows and rows > max_rows:
+        logging.warning('Campaign %s has %s rows, over the %s rows per file',
+                        c_name, rows, max_rows)
+      shard_counts[group] = shard_counts.get(group, 0) + 1
+      shard = [shard_file_name(group, shard_counts[group]), set(), 0]
+      shards.append(shard)
+      open_shards[group] = shard
+    shard[1].add(c_name)
+    shard[2] += rows
+  return [(file_name, c_names) for file_name, c_names, _ in shards]
+
+
+def shard_file_name(account, number):
+  if account is None:
+    return 'google_ads_editor_%03d.csv' % number
+  slug = re.sub(r'[^\w-]+', '_', account).strip('_') or 'no_account'
+  return 'google_ads_editor_%s_%03d.csv' % (slug, number)
+
+
+def write_csv_shards(shards_dir, sections, shards):
+  """Writes the CSV file of each shard, in parallel.
+
+  The files of a previous export are removed first, so the folder only holds
+  the shards of this one.
+  """
+  if not os.path.exists(shards_dir):
+    os.makedirs(shards_dir)
+  for file_path in glob.glob(os.path.join(shards_dir, '*.csv')):
+    os.unlink(file_path)
+  with concurrent.futures.ThreadPoolExecutor(SHARD_WORKERS) as executor:
+    futures = [executor.submit(write_csv_file,
+                               os.path.join(shards_dir, file_name), sections,
+                               campaign_names)
+               for file_name, campaign_names in shards]
+    for future in futures:
+      future.result()
+
+
+def index_entity(index, name, row_index, *values):
+  """Records the last row of an entity, keeping the position it first had."""
+  if name in index:
+    index[name][1] = row_index
+    index[name][2:] = values
+  else:
+    index[name] = [len(index), row_index] + list(values)
+
+
+class SectionBuffer(object):
+  """Lines of a CSV section, written in the order of their entities.
+
+  Entities are added with their position in the section. The lines of the
+  next expected position are written to a spool file at once, while the ones
+  that arrive early are spilled to a second file until their turn, so only
+  the offsets of the early entities are kept in memory.
+
+  Lines are labelled with the campaign they belong to, and the spool keeps
+  the byte ranges of each run of lines of the same campaign, so shards can
+  copy the lines of their campaigns, even from several threads at once.
+  """
+
+  def __init__(self, section_type):
+    self.section_type = section_type
+    self.next_position = 0
+    self.pending = {}
+    self.spool = tempfile.TemporaryFile()
+    self.spill = tempfile.TemporaryFile()
+    self.spill_end = 0
+    self.blocks = []  # [campaign name, offset, length] runs of the spool
+    self.spool_end = 0
+    self.rows = {}  # campaign name: number of lines
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type_, value, traceback_):
+    self.spool.close()
+    self.spill.close()
+
+  def add(self, position, values, campaign_name=None):
+    """Adds the lines of the entity at a position of the section."""
+    data, rows = encode_section_lines(self.section_type, values)
+    self.add_encoded(position, data, rows, campaign_name)
+
+  def add_encoded(self, position, data, rows, campaign_name=None):
+    """Adds lines already encoded by encode."""
+    if rows:
+      self.rows[campaign_name] = self.rows.get(campaign_name, 0) + rows
+    if position != self.next_position:
+      self.spill.seek(self.spill_end)
+      self.spill.write(data)
+      self.pending[position] = (self.spill_end, len(data), campaign_name)
+      self.spill_end += len(data)
+      return
+    self.write_block(data, campaign_name)
+    self.next_position += 1
+    while self.next_position in self.pending:
+      offset, length, campaign_name = self.pending.pop(self.next_position)
+      self.spill.seek(offset)
+      self.write_block(self.spill.read(length), campaign_name)
+      self.next_position += 1
+
+  def write_block(self, data, campaign_name):
+    if not data:
+      return
+    self.spool.seek(self.spool_end)
+    self.spool.write(data)
+    if self.blocks and self.blocks[-1][0] == campaign_name:
+      self.blocks[-1][2] += len(data)
+    else:
+      self.blocks.append([campaign_name, self.spool_end, len(data)])
+    self.spool_end += len(data)
+
+  def copy_to(self, f, campaign_names=None):
+    """Copies the lines to a binary file, or only those of some campaigns."""
+    if self.pending:
+      raise ValueError('Missing entities in section %s.' % self.section_type)
+    self.spool.flush()
+    fd = self.spool.fileno()
+    for campaign_name, offset, length in self.blocks:
+      if campaign_names is not None and campaign_name not in campaign_names:
+        continue
+      # pread leaves the file position alone, so threads can share the spool
+      end = offset + length
+      while offset < end:
+        data = os.pread(fd, min(COPY_BUFFER_SIZE, end - offset), offset)
+        f.write(data)
+        offset += len(data)
+
+
+def encode_lines(lines):
+  """Returns the bytes of CSV lines, as csv.writer writes them."""
+  queue = StringIO()
+  csvwriter = csv.writer(
+      queue, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+  for line in lines:
+    csvwriter.writerow(line)
+  return queue.getvalue().encode(ENCODING)
+
+
+class ExportSnapshot(object):
+  """Hashes of the lines of each entity exported, saved as JSON.
+
+  Entities are keyed by their kind and the name GoogleAdsEditorCsv gives
+  them, so a renamed entity counts as a new one.
+  """
+
+  def __init__(self, file_path):
+    self.file_path = file_path
+    self.previous = {}
+    self.current = {}
+    try:
+      with open(file_path, 'r') as f:
+        self.previous = json.load(f)
+        f.close()
+    except (IOError, ValueError):
+      pass
+
+  def update(self, kind, name, chunks):
+    """Records the hash of an entity's lines.
+
+    Returns:
+      Whether the entity is new or its lines changed since the snapshot.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for chunk in chunks:
+      # lines of each section are hashed apart, so they cannot shift over
+      digest.update(b'%d:' % len(chunk))
+      digest.update(chunk)
+    entity_hash = digest.hexdigest()
+    self.current.setdefault(kind, {})[name] = entity_hash
+    return self.previous.get(kind, {}).get(name) != entity_hash
+
+  def save(self):
+    """Replaces the snapshot file with the entities of this export."""
+    dir_path = os.path.dirname(os.path.abspath(self.file_path))
+    (fd, temp_file_name) = tempfile.mkstemp(prefix='vogon_', suffix='.json',
+                                            dir=dir_path)
+    with os.fdopen(fd, 'w') as f:
+      json.dump(self.current, f)
+      f.close()
+    os.replace(temp_file_name, self.file_path)
 
 
 FILE_HEADERS = [
@@ -109,122 +646,335 @@ FILE_HEADERS = [
 
 GENDERS = ['Male', 'Female', 'Unknown']
 
+AD_GROUP_BASE_NAME = 'Ad Group_%03d (%s)'
+DEFAULT_AD_GROUP_BASE_NAME = 'Default Ad Group (%s)'
+
+
+def campaign_values(c):
+  """Returns the CSV values of a campaign."""
+  is_bumper = (c['Campaign Type'] == 'Video - Bumper ad')
+
+  ad_rotation = c['Ad rotation']
+  if ad_rotation.lower() == 'optimize for views':
+    ad_rotation = 'Optimize for Clicks'
+  m_bid = c['Mobile bid modifier'].strip().strip('%').strip()
+  if not m_bid:
+    m_bid = '0'
+
+  return {
+      'Account': c.get('Account'),
+      'Campaign': c['name'],
+      'Campaign Status': c['Status'],
+      'Campaign Type': c['Campaign Type'],
+      'Campaign subtype': 'All features',
+      'Campaign Daily Budget': c['Budget'],
+      'Bid Strategy Type': ('Manual CPM' if is_bumper else 'Manual CPV'),
+      'Labels': 'Vogon_Generated',
+      # Use these values: YouTube Videos;YouTube Search;Display Network,
+      # separated by a semicolon
+      'Networks': c['Network'],
+      # Use AWFE names for reference
+      'Delivery Method': c['Delivery method'],
+      'Start date': c['Start date'],  # YYYY-MM-DD
+      'End date': c['End date'],  #YYYY-MM-DD
+      'Ad Rotation': ad_rotation,  # Use AWEditor names for reference
+      'Bid adjustment': m_bid
+  }
+
+
+def campaign_target_values(c):
+  """Returns the CSV values of the campaign level targets of a campaign."""
+  campaign_target_values = []
+
+  # Supported target types: Location (for campaigns), Keyword, Placement,
+  # Topic, Audience
+  # We can have more than one targeting per video, so iterating
+  for t in c['targets']:
+    # Targeting comes in two flavors: campaign and ad group (if none
+    # specified, then ad group)
+    target_level = t.get('level', None)
+    if target_level is not None and target_level == 'Campaign':
+      if t['type'] == 'Location':
+        # You can concatenate targets by separating them with a semicolon.
+        # Commas are not supported in locations anymore, since canonical
+        # locations have commas in them, creating wrong targeting
+
+        target_array = t['value'].split(';')
+
+        for tgv in target_array:
+          # Locations must be canonical names from
+          # https://developers.google.com/adwords/api/docs/appendix/geotargeting
+          tgv = tgv.strip()
+          if is_intish(tgv):
+            values = {
+                'Location ID': tgv,
+                'Account': c.get('Account'),
+                'Campaign': c['name']
+            }
+            campaign_target_values.append(values)
+          else:
+            values = {
+                'Location': tgv,
+                'Account': c.get('Account'),
+                'Campaign': c['name']
+            }
+            campaign_target_values.append(values)
+
+      elif t['type'] == 'Ad Schedule':
+        if ';' in t['value']:
+          target_array = t['value'].split(';')
+        else:
+          target_array = t['value'].split(',')
+
+        for tgv in target_array:
+          values = {
+              'Ad Schedule': tgv,
+              'Account': c.get('Account'),
+              'Campaign': c['name']
+          }
+          campaign_target_values.append(values)
+      else:
+        raise ValueError('Invalid type for Campaign targeting.', t['type'])
+
+  return campaign_target_values
+
+
+def adgroup_values(adgroup_name, c, is_bumper):
+  """Returns the CSV values of an ad group of campaign c."""
+  # Creating the Ad group (formerly known as target group)
+  return {
+      'Ad group': adgroup_name,
+      'Ad group type': ('Bumper' if is_bumper else 'InStream'),
+      'Ad Group Status': 'enabled',
+      'Campaign': c['name'],
+      'Account': c.get('Account', ''),
+      'Max CPV': c['Max CPV'],
+      # This is not a typo, Max Bid in the UI is mapped to Max CPV in
+      # the config for historical reasons we should not speculate about.
+      'Max CPM': c['Max CPV'],
+      'Labels': 'Vogon_Generated'
+  }
+
+
+def default_adgroup_values(c, is_bumper):
+  """Returns the CSV values of the ad group of a campaign without any."""
+  return {
+      'Ad group': DEFAULT_AD_GROUP_BASE_NAME % c['name'],
+      'Ad group type': ('Bumper' if is_bumper else 'InStream'),
+      'Ad Group Status': 'enabled',
+      'Campaign': c['name'],
+      'Account': c.get('Account', ''),
+      'Max CPV': c['Max CPV'],
+      # This is not a typo, Max Bid in the UI is mapped to Max CPV in the
+      # config for historical reasons we should not speculate about.
+      'Max CPM': c['Max CPV'],
+      'Labels': 'Vogon_Generated'
+  }
+
+
+def adgroup_target_values(targets, adgroup_name, c):
+  """Returns the CSV values of the ad group level targets of an ad group.
+
+  Returns:
+    A tuple with the list of values and whether the ad group has gender
+    targeting.
+  """
+  target_values = []
+  gender_targeted = False
+
+  for t in targets:
+    # Targeting comes in two flavors: campaign and ad group (if none
+    # specified, then ad group)
+    target_level = t.get('level', None)
+    if target_level is not None and target_level == 'Ad Group':
+      # Supported target types for AdGroups: Keyword, Placement, Topic,
+      # Audience
+      # TODO: support extra target types
+
+      # You can concatenate targets by separating them with a semicolon.
+      # Commas are supported too, but only for backwards compatibility
+      if ';' in t['value']:
+        target_array = t['value'].split(';')
+      else:
+        target_array = t['value'].split(',')
+
+      for tgv in target_array:
+        if t['type'] == 'Keyword':
+          if tgv.startswith('[') and tgv.endswith(']'):
+            match_type = 'Exact'
+          elif tgv.startswith("\"") and tgv.endswith("\""):
+            match_type = 'Phrase'
+          elif tgv.startswith('-'):
+            match_type = 'Negative'
+          else:
+            match_type = 'Broad'
+
+          # Remove special chars from keywords
+          if match_type != 'Broad':
+            tgv = tgv[1:-1]
+
+          values = {
+              'Account': c.get('Account', ''),
+              'Campaign': c['name'],
+              'Ad group': adgroup_name,
+              'Max CPV': t.get('max_cpv', ''),
+              'Max CPM': t.get('max_cpv',
+                               ''),  # This is not a typo, historical
+              'Keyword state': 'enabled',
+              'Keyword': tgv,
+              'Criterion Type': match_type
+          }
+          target_values.append(values)
+        elif t['type'] == 'Placement':
+          values = {
+              'Account': c.get('Account', ''),
+              'Campaign': c['name'],
+              'Ad group': adgroup_name,
+              'Max CPV': t.get('max_cpv', ''),
+              'Max CPM': t.get('max_cpv',
+                               ''),  # This is not a typo, historical
+              # TODO: let users add negative placements
+              'Criterion Type': '',
+              'Website': tgv
+          }
+          target_values.append(values)
+        elif t['type'] == 'Topic':
+          values = {
+              'Account': c.get('Account', ''),
+              'Campaign': c['name'],
+              'Ad group': adgroup_name,
+              'Max CPV': t.get('max_cpv', ''),
+              'Max CPM': t.get('max_cpv',
+                               ''),  # This is not a typo, historical
+              # TODO: let users add negative topics
+              'Criterion Type': '',
+              'Topic': tgv
+          }
+          target_values.append(values)
+        elif t['type'] == 'Audience':
+          values = {
+              'Account': c.get('Account', ''),
+              'Campaign': c['name'],
+              'Ad group': adgroup_name,
+              'Max CPV': t.get('max_cpv', ''),
+              'Max CPM': t.get('max_cpv',
+                               ''),  # This is not a typo, historical
+              # TODO: let users add negative audiences
+              'Criterion Type': '',
+              'Audience': tgv
+          }
+          target_values.append(values)
+        elif t['type'] == 'Gender':
+          if tgv != '':
+            values = {
+                'Account': c.get('Account', ''),
+                'Campaign': c['name'],
+                'Ad group': adgroup_name,
+                'Max CPV': t.get('max_cpv', ''),
+                'Max CPM': t.get('max_cpv',
+                                 ''),  # This is not a typo, historical
+                # TODO: let users add negative topics
+                'Criterion Type': '',
+                'Gender': tgv
+            }
+            target_values.append(values)
+            gender_targeted = True
+        elif t['type'] == 'Age':
+          if tgv != '':
+            values = {
+                'Account': c.get('Account', ''),
+                'Campaign': c['name'],
+                'Ad group': adgroup_name,
+                'Max CPV': t.get('max_cpv', ''),
+                'Max CPM': t.get('max_cpv',
+                                 ''),  # This is not a typo, historical
+                # TODO: let users add negative topics
+                'Criterion Type': '',
+                'Age': tgv
+            }
+            target_values.append(values)
+        else:
+          raise ValueError('Invalid type for Ad Group targeting', t['type'])
+
+  return target_values, gender_targeted
+
+
+def gender_values(adg):
+  """Returns the default demographic targeting of an ad group.
+
+  AdWords Editor does not add them like AWFE does.
+  """
+  target_values = []
+  for g in GENDERS:
+    values = {
+        'Account': adg.get('Account', ''),
+        'Campaign': adg['Campaign'],
+        'Ad group': adg['Ad group'],
+        'Gender': g
+    }
+    target_values.append(values)
+  return target_values
+
+
+def ad_values(ad, is_bumper):
+  """Returns the CSV values of an ad."""
+  return {
+      'Account':
+          ad.get('Account', ''),
+      'Campaign':
+          ad['Campaign'],
+      'Ad group':
+          ad['Ad Group'],
+      'Ad Name':
+          ad['name'],
+      'Status':
+          'enabled',
+      # Only used for in-stream ads
+      'Display URL':
+          ad['Display Url'],
+      # New Final URL field is Final Url, but we kept the Destination Url
+      # for backwards compatibility.
+      'Final URL': (ad['Final Url']
+                    if 'Final Url' in ad else ad['Destination Url']),
+      'Final Mobile URL':
+          ad.get('Mobile Final Url', ''),
+      'Tracking template':
+          ad.get('Tracking Template', ''),
+      # TODO: add ability to create custom params for tracking template
+      'Custom parameters':
+          '',
+      'Labels':
+          'Vogon_Generated',
+      'Video ID':
+          ad['Video id'],
+      'Bumper Ad': ('[]' if is_bumper else '')
+  }
+
 
 class GoogleAdsEditorCsv():
 
   def __init__(self, campaigns, adgroups, ads):
     self.sections = []
-    campaign_values = []
-    adgroup_values = []
-    campaign_target_values = []
-    target_values = []
+    campaign_values_list = []
+    adgroup_values_list = []
+    campaign_target_values_list = []
+    target_values_list = []
     gender_targeted_adgs = []
     adgroups_by_campaign = {}
-    ad_group_base_name = 'Ad Group_%03d (%s)'
-    default_ad_group_base_name = 'Default Ad Group (%s)'
 
     for c in campaigns.values():
       is_bumper = (c['Campaign Type'] == 'Video - Bumper ad')
-
-      ad_rotation = c['Ad rotation']
-      if ad_rotation.lower() == 'optimize for views':
-        ad_rotation = 'Optimize for Clicks'
-      m_bid = c['Mobile bid modifier'].strip().strip('%').strip()
-      if not m_bid:
-        m_bid = '0'
-
-      values = {
-          'Account': c.get('Account'),
-          'Campaign': c['name'],
-          'Campaign Status': c['Status'],
-          'Campaign Type': c['Campaign Type'],
-          'Campaign subtype': 'All features',
-          'Campaign Daily Budget': c['Budget'],
-          'Bid Strategy Type': ('Manual CPM' if is_bumper else 'Manual CPV'),
-          'Labels': 'Vogon_Generated',
-          # Use these values: YouTube Videos;YouTube Search;Display Network,
-          # separated by a semicolon
-          'Networks': c['Network'],
-          # Use AWFE names for reference
-          'Delivery Method': c['Delivery method'],
-          'Start date': c['Start date'],  # YYYY-MM-DD
-          'End date': c['End date'],  #YYYY-MM-DD
-          'Ad Rotation': ad_rotation,  # Use AWEditor names for reference
-          'Bid adjustment': m_bid
-      }
-      campaign_values.append(values)
-
-      # Supported target types: Location (for campaigns), Keyword, Placement,
-      # Topic, Audience
-      # We can have more than one targeting per video, so iterating
-      for t in c['targets']:
-        # Targeting comes in two flavors: campaign and ad group (if none
-        # specified, then ad group)
-        target_level = t.get('level', None)
-        if target_level is not None and target_level == 'Campaign':
-          if t['type'] == 'Location':
-            # You can concatenate targets by separating them with a semicolon.
-            # Commas are not supported in locations anymore, since canonical
-            # locations have commas in them, creating wrong targeting
-
-            target_array = t['value'].split(';')
-
-            for tgv in target_array:
-              # Locations must be canonical names from
-              # https://developers.google.com/adwords/api/docs/appendix/geotargeting
-              tgv = tgv.strip()
-              if is_intish(tgv):
-                values = {
-                    'Location ID': tgv,
-                    'Account': c.get('Account'),
-                    'Campaign': c['name']
-                }
-                campaign_target_values.append(values)
-              else:
-                values = {
-                    'Location': tgv,
-                    'Account': c.get('Account'),
-                    'Campaign': c['name']
-                }
-                campaign_target_values.append(values)
-
-          elif t['type'] == 'Ad Schedule':
-            if ';' in t['value']:
-              target_array = t['value'].split(';')
-            else:
-              target_array = t['value'].split(',')
-
-            for tgv in target_array:
-              values = {
-                  'Ad Schedule': tgv,
-                  'Account': c.get('Account'),
-                  'Campaign': c['name']
-              }
-              campaign_target_values.append(values)
-          else:
-            raise ValueError('Invalid type for Campaign targeting.', t['type'])
+      campaign_values_list.append(campaign_values(c))
+      campaign_target_values_list += campaign_target_values(c)
 
     i = 1
     for ag in adgroups.values():
 
       c = ag['Campaign']
-      # Creating the Ad group (formerly known as target group)
       adgroup_name = ag.get('name', None)
       if not adgroup_name:
-        adgroup_name = ad_group_base_name % (i, c['name'])
-      values = {
-          'Ad group': adgroup_name,
-          'Ad group type': ('Bumper' if is_bumper else 'InStream'),
-          'Ad Group Status': 'enabled',
-          'Campaign': c['name'],
-          'Account': c.get('Account', ''),
-          'Max CPV': c['Max CPV'],
-          # This is not a typo, Max Bid in the UI is mapped to Max CPV in
-          # the config for historical reasons we should not speculate about.
-          'Max CPM': c['Max CPV'],
-          'Labels': 'Vogon_Generated'
-      }
-      adgroup_values.append(values)
+        adgroup_name = AD_GROUP_BASE_NAME % (i, c['name'])
+      adgroup_values_list.append(adgroup_values(adgroup_name, c, is_bumper))
 
       # Putting the target groups in a dict so the ads can refer to it
       # later on. The variable is not used later, but the initialization
@@ -232,119 +982,11 @@ class GoogleAdsEditorCsv():
       campaign_adgroups = adgroups_by_campaign.setdefault(c['name'], [])
       campaign_adgroups.append(adgroup_name)
 
-      for t in ag['targets']:
-        # Targeting comes in two flavors: campaign and ad group (if none
-        # specified, then ad group)
-        target_level = t.get('level', None)
-        if target_level is not None and target_level == 'Ad Group':
-          # Supported target types for AdGroups: Keyword, Placement, Topic,
-          # Audience
-          # TODO: support extra target types
-
-          # You can concatenate targets by separating them with a semicolon.
-          # Commas are supported too, but only for backwards compatibility
-          if ';' in t['value']:
-            target_array = t['value'].split(';')
-          else:
-            target_array = t['value'].split(',')
-
-          for tgv in target_array:
-            if t['type'] == 'Keyword':
-              if tgv.startswith('[') and tgv.endswith(']'):
-                match_type = 'Exact'
-              elif tgv.startswith("\"") and tgv.endswith("\""):
-                match_type = 'Phrase'
-              elif tgv.startswith('-'):
-                match_type = 'Negative'
-              else:
-                match_type = 'Broad'
-
-              # Remove special chars from keywords
-              if match_type != 'Broad':
-                tgv = tgv[1:-1]
-
-              values = {
-                  'Account': c.get('Account', ''),
-                  'Campaign': c['name'],
-                  'Ad group': adgroup_name,
-                  'Max CPV': t.get('max_cpv', ''),
-                  'Max CPM': t.get('max_cpv',
-                                   ''),  # This is not a typo, historical
-                  'Keyword state': 'enabled',
-                  'Keyword': tgv,
-                  'Criterion Type': match_type
-              }
-              target_values.append(values)
-            elif t['type'] == 'Placement':
-              values = {
-                  'Account': c.get('Account', ''),
-                  'Campaign': c['name'],
-                  'Ad group': adgroup_name,
-                  'Max CPV': t.get('max_cpv', ''),
-                  'Max CPM': t.get('max_cpv',
-                                   ''),  # This is not a typo, historical
-                  # TODO: let users add negative placements
-                  'Criterion Type': '',
-                  'Website': tgv
-              }
-              target_values.append(values)
-            elif t['type'] == 'Topic':
-              values = {
-                  'Account': c.get('Account', ''),
-                  'Campaign': c['name'],
-                  'Ad group': adgroup_name,
-                  'Max CPV': t.get('max_cpv', ''),
-                  'Max CPM': t.get('max_cpv',
-                                   ''),  # This is not a typo, historical
-                  # TODO: let users add negative topics
-                  'Criterion Type': '',
-                  'Topic': tgv
-              }
-              target_values.append(values)
-            elif t['type'] == 'Audience':
-              values = {
-                  'Account': c.get('Account', ''),
-                  'Campaign': c['name'],
-                  'Ad group': adgroup_name,
-                  'Max CPV': t.get('max_cpv', ''),
-                  'Max CPM': t.get('max_cpv',
-                                   ''),  # This is not a typo, historical
-                  # TODO: let users add negative audiences
-                  'Criterion Type': '',
-                  'Audience': tgv
-              }
-              target_values.append(values)
-            elif t['type'] == 'Gender':
-              if tgv != '':
-                values = {
-                    'Account': c.get('Account', ''),
-                    'Campaign': c['name'],
-                    'Ad group': adgroup_name,
-                    'Max CPV': t.get('max_cpv', ''),
-                    'Max CPM': t.get('max_cpv',
-                                     ''),  # This is not a typo, historical
-                    # TODO: let users add negative topics
-                    'Criterion Type': '',
-                    'Gender': tgv
-                }
-                target_values.append(values)
-                gender_targeted_adgs.append(adgroup_name)
-            elif t['type'] == 'Age':
-              if tgv != '':
-                values = {
-                    'Account': c.get('Account', ''),
-                    'Campaign': c['name'],
-                    'Ad group': adgroup_name,
-                    'Max CPV': t.get('max_cpv', ''),
-                    'Max CPM': t.get('max_cpv',
-                                     ''),  # This is not a typo, historical
-                    # TODO: let users add negative topics
-                    'Criterion Type': '',
-                    'Age': tgv
-                }
-                target_values.append(values)
-            else:
-              raise ValueError('Invalid type for Ad Group targeting', t['type'])
+      target_values, gender_targeted = adgroup_target_values(
+          ag['targets'], adgroup_name, c)
+      target_values_list += target_values
+      if gender_targeted:
+        gender_targeted_adgs.append(adgroup_name)
 
       i += 1
 
@@ -352,75 +994,25 @@ class GoogleAdsEditorCsv():
     # Location only targeted campaigns.
     for c in campaigns.values():
       if c['name'] not in adgroups_by_campaign.keys():
-        missing_adgroup_name = default_ad_group_base_name % c['name']
-        missing_ad_group = {
-            'Ad group': missing_adgroup_name,
-            'Ad group type': ('Bumper' if is_bumper else 'InStream'),
-            'Ad Group Status': 'enabled',
-            'Campaign': c['name'],
-            'Account': c.get('Account', ''),
-            'Max CPV': c['Max CPV'],
-            # This is not a typo, Max Bid in the UI is mapped to Max CPV in the
-            # config for historical reasons we should not speculate about.
-            'Max CPM': c['Max CPV'],
-            'Labels': 'Vogon_Generated'
-        }
-        adgroup_values.append(missing_ad_group)
-        adgroups_by_campaign[c['name']] = [missing_adgroup_name]
+        missing_ad_group = default_adgroup_values(c, is_bumper)
+        adgroup_values_list.append(missing_ad_group)
+        adgroups_by_campaign[c['name']] = [missing_ad_group['Ad group']]
 
     # Adds demographic default targeting to all ad groups. AdWords Editor does
     # not add them life AWFE does
-    for adg in adgroup_values:
+    for adg in adgroup_values_list:
       if adg['Ad group'] not in gender_targeted_adgs:
-        for g in GENDERS:
-          values = {
-              'Account': adg.get('Account', ''),
-              'Campaign': adg['Campaign'],
-              'Ad group': adg['Ad group'],
-              'Gender': g
-          }
-          target_values.append(values)
+        target_values_list += gender_values(adg)
 
-    self.add_section(campaign_values, 'campaign')
-    self.add_section(adgroup_values, 'adgroup')
-    self.add_section(target_values, 'target')
-    self.add_section(campaign_target_values, 'campaign_target')
-    ad_values = []
+    self.add_section(campaign_values_list, 'campaign')
+    self.add_section(adgroup_values_list, 'adgroup')
+    self.add_section(target_values_list, 'target')
+    self.add_section(campaign_target_values_list, 'campaign_target')
+    ad_values_list = []
 
     for ad in ads.values():
-      values = {
-          'Account':
-              ad.get('Account', ''),
-          'Campaign':
-              ad['Campaign'],
-          'Ad group':
-              ad['Ad Group'],
-          'Ad Name':
-              ad['name'],
-          'Status':
-              'enabled',
-          # Only used for in-stream ads
-          'Display URL':
-              ad['Display Url'],
-          # New Final URL field is Final Url, but we kept the Destination Url
-          # for backwards compatibility.
-          'Final URL': (ad['Final Url']
-                        if 'Final Url' in ad else ad['Destination Url']),
-          'Final Mobile URL':
-              ad.get('Mobile Final Url', ''),
-          'Tracking template':
-              ad.get('Tracking Template', ''),
-          # TODO: add ability to create custom params for tracking template
-          'Custom parameters':
-              '',
-          'Labels':
-              'Vogon_Generated',
-          'Video ID':
-              ad['Video id'],
-          'Bumper Ad': ('[]' if is_bumper else '')
-      }
-      ad_values.append(values)
-    self.add_section(ad_values, 'ad')
+      ad_values_list.append(ad_values(ad, is_bumper))
+    self.add_section(ad_values_list, 'ad')
 
   def add_section(self, values, type):
     section = AwEditorCsvSection(values, type)
@@ -463,20 +1055,25 @@ class AwEditorCsvSection():
     retval = []
     if len(self.values) > 0:
       for line in self.values:
-        line_values = []
-        for header in FILE_HEADERS:
-          value = line.get(header, '')
-          if value is not None:
-            line_values.append(value)
-          else:
-            line_values.append('')
-            logging.warning(
-                'Missing value from section %s, column %s in attempt to ' +
-                'generate AdWords Editor CSV.', self.section_type, header)
-        retval.append(pad_line(line_values))
+        retval.append(line_values(line, self.section_type))
     return retval
 
 
+def line_values(line, section_type):
+  """Returns the values of a line dict in the order of FILE_HEADERS."""
+  values = []
+  for header in FILE_HEADERS:
+    value = line.get(header, '')
+    if value is not None:
+      values.append(value)
+    else:
+      values.append('')
+      logging.warning(
+          'Missing value from section %s, column %s in attempt to ' +
+          'generate AdWords Editor CSV.', section_type, header)
+  return pad_line(values)
+
+
 def pad_line(arr):
   return arr + ([None] * (len(FILE_HEADERS) - len(arr)))
 
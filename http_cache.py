@@ -0,0 +1,239 @@
+# vim: set fileencoding=utf-8 :
+
+# Copyright 2019 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Content-hash ETags and compression of HTTP responses.
+
+Responses get an ETag made of the hash of their content, and of the encoding
+they are sent with, so a conditional GET of an unchanged response is
+answered with a 304 and no body. Text responses are compressed with brotli,
+when the brotli module is installed and the client accepts it, or gzip.
+
+The UI's static files are compressed once, at startup, and kept in memory,
+ready to be sent, by StaticFiles. The references index.html makes to
+them carry a hash of their content, ?v=..., so browsers can cache those
+URLs for good: a changed file gets a new URL.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import stat
+import threading
+
+try:
+  import brotli
+except ImportError:  # gzip is used alone
+  brotli = None
+
+GZIP = 'gzip'
+BROTLI = 'br'
+# in order of preference
+ENCODINGS = ([BROTLI] if brotli else []) + [GZIP]
+# responses smaller than this gain less than the compression costs
+MIN_COMPRESSED_SIZE = 1024
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript',
+                      'application/xml', 'image/svg+xml')
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+
+def compressible(content_type, size):
+  return size >= MIN_COMPRESSED_SIZE and (content_type or '').startswith(
+      COMPRESSIBLE_TYPES)
+
+
+def compress(data, encoding, best=False):
+  """Compresses data with an encoding; best is for data compressed once."""
+  if encoding == BROTLI:
+    return brotli.compress(data, quality=11 if best else 5)
+  # mtime=0 so the same data always compresses the same
+  return gzip.compress(data, 9 if best else 6, mtime=0)
+
+
+def negotiate(accept_encoding, available):
+  """Returns the encoding of `available` the client prefers, or None.
+
+  accept_encoding is the Accept-Encoding header; encodings with the same
+  q-value are picked in the order of ENCODINGS.
+  """
+  accepted = {}
+  for item in (accept_encoding or '').split(','):
+    name, _, params = item.strip().partition(';')
+    q = 1.0
+    match = re.search(r'q=([0-9.]+)', params)
+    if match:
+      try:
+        q = float(match.group(1))
+      except ValueError:
+        continue
+    accepted[name.strip().lower()] = q
+  best = None
+  for encoding in ENCODINGS:
+    q = accepted.get(encoding, accepted.get('*', 0))
+    if encoding in available and q > 0 and (best is None or q > best[0]):
+      best = (q, encoding)
+  return best and best[1]
+
+
+def content_hash(data):
+  return hashlib.sha1(data).hexdigest()
+
+
+def representation_etag(content_etag, encoding):
+  """Returns the quoted ETag of a content sent with an encoding."""
+  if encoding:
+    return '"%s-%s"' % (content_etag, encoding)
+  return '"%s"' % content_etag
+
+
+def etag_matches(if_none_match, etag):
+  """Whether an If-None-Match header matches an ETag."""
+  if not if_none_match:
+    return False
+  if if_none_match.strip() == '*':
+    return True
+  for tag in if_none_match.split(','):
+    tag = tag.strip()
+    # If-None-Match compares weakly
+    if tag.startswith('W/'):
+      tag = tag[2:]
+    if tag == etag:
+      return True
+  return False
+
+
+class StaticFile(object):
+  """A static file ready to send, in each encoding it is worth sending in."""
+
+  def __init__(self, path, data, content_type, references=()):
+    self.path = path
+    self.stamp = file_stamp(path)
+    # the static files an HTML page refers to, by name
+    self.references = references
+    self.content_type = content_type
+    self.etag = content_hash(data)
+    self.version = self.etag[:12]
+    self.bodies = {None: data}
+    if compressible(content_type, len(data)):
+      for encoding in ENCODINGS:
+        body = compress(data, encoding, best=True)
+        if len(body) < len(data):
+          self.bodies[encoding] = body
+
+
+class StaticFiles(object):
+  """The files under a directory, hashed and compressed once.
+
+  Files are loaded by load(), or on the first request. Each request checks
+  the mtime of the file it asks for, and of the files an HTML page refers
+  to, and a changed file reloads them all, so editing the UI in place needs
+  no restart.
+  """
+
+  def __init__(self, root, url_prefix='/static/'):
+    self.root = root
+    self.url_prefix = url_prefix
+    self.lock = threading.Lock()
+    self.files = None
+
+  def load(self):
+    raw = {}
+    for root, dirnames, filenames in os.walk(self.root):
+      for filename in filenames:
+        path = os.path.join(root, filename)
+        with open(path, 'rb') as f:
+          raw[os.path.relpath(path, self.root).replace(os.sep, '/')] = (
+              path, f.read())
+          f.close()
+    versions = dict((name, content_hash(data)[:12])
+                    for name, (path, data) in raw.items())
+    files = {}
+    for name, (path, data) in raw.items():
+      content_type = content_type_of(name)
+      references = []
+      if content_type.startswith('text/html'):
+        data = self.version_references(data, versions, references)
+      files[name] = StaticFile(path, data, content_type, tuple(references))
+    with self.lock:
+      self.files = files
+
+  def version_references(self, html, versions, references):
+    """Adds ?v=<content hash> to the static files an HTML page refers to.
+
+    The names of those files are appended to references.
+    """
+    pattern = re.compile(br'((?:src|href)=")' + re.escape(
+        self.url_prefix.encode('utf-8')) + br'([^"?#]+)(")')
+    def add_version(match):
+      name = match.group(2).decode('utf-8')
+      if name not in versions:
+        return match.group(0)
+      references.append(name)
+      return b'%s%s%s?v=%s%s' % (match.group(1),
+                                 self.url_prefix.encode('utf-8'),
+                                 match.group(2),
+                                 versions[name].encode('utf-8'),
+                                 match.group(3))
+    return pattern.sub(add_version, html)
+
+  def get(self, name):
+    """Returns the StaticFile of a path under the root, or None."""
+    if os.path.normpath(name).startswith(('..', '/')):
+      return None
+    with self.lock:
+      files = self.files
+    if files is None:
+      self.load()
+      return self.get(name)
+    static_file = files.get(name)
+    path = (static_file.path if static_file else
+            os.path.join(self.root, name))
+    try:
+      st = os.stat(path)
+      stamp = (st.st_mtime_ns, st.st_size)
+    except OSError:
+      st = stamp = None
+    if static_file is None and (st is None or not stat.S_ISREG(st.st_mode)):
+      return None
+    # a page is stale too when the versions of its references changed
+    if (static_file is None or static_file.stamp != stamp or
+        any(files[reference].stamp != file_stamp(files[reference].path)
+            for reference in static_file.references)):
+      self.load()
+      with self.lock:
+        static_file = self.files.get(name)
+    return static_file
+
+
+def file_stamp(path):
+  """Returns the mtime and size of a file, or None if it is missing."""
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return (st.st_mtime_ns, st.st_size)
+
+
+def content_type_of(name):
+  content_type, _ = mimetypes.guess_type(name)
+  content_type = content_type or 'application/octet-stream'
+  if content_type.startswith('text/') or content_type in (
+      'application/javascript', 'application/json'):
+    content_type += '; charset=UTF-8'
+  return content_type
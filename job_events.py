@@ -0,0 +1,154 @@
+# vim: set fileencoding=utf-8 :
+
+# Copyright 2019 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Stage timing of rendered rows and structured events of render jobs.
+
+A RowTimer is active on the thread rendering a row. Functions decorated with
+timed() add the time they take to a stage of that row, and the ones that
+learn something about it, like ffmpeg's exit code, record() it. Nested
+stages only count their own time, so text rasterization is not counted again
+as part of the filter graph build that triggers it. Outside of a RowTimer
+the hooks do nothing.
+
+Jobs write their events, one JSON object per line, to a JobEventLog, which
+also hands them to the listeners registered with add_listener.
+"""
+
+import contextlib
+import datetime
+import functools
+import json
+import logging
+import threading
+import time
+
+_local = threading.local()
+listeners = []
+
+
+def current():
+  """Returns the RowTimer active on this thread, or None."""
+  return getattr(_local, 'timer', None)
+
+
+def timed(stage_name):
+  """Decorates a function to add its duration to a stage of the row."""
+  def decorator(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      timer = current()
+      if timer is None:
+        return func(*args, **kwargs)
+      with timer.stage(stage_name):
+        return func(*args, **kwargs)
+    return wrapper
+  return decorator
+
+
+def record(**fields):
+  """Records fields of the event of the row being rendered, if any."""
+  timer = current()
+  if timer is not None:
+    timer.fields.update(fields)
+
+
+def add_listener(listener):
+  """Registers a function receiving every event written to a JobEventLog."""
+  listeners.append(listener)
+
+
+class RowTimer(object):
+  """Durations of the stages of a row, usable on 'with' statements."""
+
+  def __init__(self, row_number):
+    self.row_number = row_number
+    self.stages = {}
+    self.fields = {}
+    self.stack = []  # [stage name, start, seconds of nested stages]
+    self.start = None
+    self.duration = None
+    self.previous = None
+
+  def __enter__(self):
+    self.previous = current()
+    _local.timer = self
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, type_, value, traceback_):
+    self.duration = time.perf_counter() - self.start
+    _local.timer = self.previous
+
+  @contextlib.contextmanager
+  def stage(self, stage_name):
+    frame = [stage_name, time.perf_counter(), 0.0]
+    self.stack.append(frame)
+    try:
+      yield
+    finally:
+      self.stack.pop()
+      elapsed = time.perf_counter() - frame[1]
+      self.stages[stage_name] = (self.stages.get(stage_name, 0.0) +
+                                 elapsed - frame[2])
+      if self.stack:
+        self.stack[-1][2] += elapsed
+
+  def event_fields(self):
+    """Returns the fields of the row's event."""
+    fields = {
+        'row': self.row_number,
+        'duration': round(self.duration or 0, 4),
+        'stages': dict((name, round(seconds, 4))
+                       for name, seconds in self.stages.items())
+    }
+    fields.update(self.fields)
+    return fields
+
+
+class JobEventLog(object):
+  """JSON lines file of the events of a job, usable on 'with' statements."""
+
+  def __init__(self, file_path, **job_fields):
+    self.file_path = file_path
+    self.job_fields = job_fields
+    self.lock = threading.Lock()
+    self.file = open(file_path, 'a')
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type_, value, traceback_):
+    self.close()
+
+  def close(self):
+    self.file.close()
+
+  def write(self, event_type, **fields):
+    event = {
+        'ts': datetime.datetime.now().isoformat(),
+        'event': event_type
+    }
+    event.update(self.job_fields)
+    event.update(fields)
+    with self.lock:
+      self.file.write(json.dumps(event) + '\n')
+      self.file.flush()
+    for listener in listeners:
+      try:
+        listener(event)
+      except Exception:  # pylint: disable=broad-except
+        logging.exception('Job event listener failed')
+    return event
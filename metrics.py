@@ -0,0 +1,228 @@
+# vim: set fileencoding=utf-8 :
+
+# Copyright 2019 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process counters and histograms, exposed in the Prometheus text format.
+
+Updating a metric takes a lock and a dict update, so it can be done on hot
+paths. Values that are already kept somewhere else, like the YouTube API
+counters of yt_retry, are read by collector functions when the metrics are
+rendered instead of being copied.
+
+Metrics are per process: with 'server.py --server workers' each worker
+process exposes its own.
+"""
+
+import bisect
+import threading
+
+import job_events
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+RENDER_BUCKETS = (.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+registry = []
+
+
+def escape_label_value(value):
+  return ('%s' % value).replace('\\', '\\\\').replace('"', '\\"').replace(
+      '\n', '\\n')
+
+
+def format_labels(labels):
+  if not labels:
+    return ''
+  return '{%s}' % ','.join('%s="%s"' % (name, escape_label_value(value))
+                           for name, value in labels)
+
+
+def format_value(value):
+  if value == float('inf'):
+    return '+Inf'
+  if isinstance(value, float) and value.is_integer():
+    return '%d' % value
+  return repr(value)
+
+
+class Metric(object):
+  """A metric with a value per combination of label values."""
+  metric_type = 'untyped'
+
+  def __init__(self, name, documentation, labelnames=()):
+    self.name = name
+    self.documentation = documentation
+    self.labelnames = tuple(labelnames)
+    self.lock = threading.Lock()
+    self.values = {}
+    registry.append(self)
+
+  def key(self, labels):
+    return tuple((name, labels.get(name, '')) for name in self.labelnames)
+
+  def samples(self):
+    """Yields (name, labels, value) tuples, labels being (name, value)s."""
+    with self.lock:
+      values = list(self.values.items())
+    for labels, value in sorted(values):
+      yield self.name, labels, value
+
+  def render(self):
+    lines = ['# HELP %s %s' % (self.name, self.documentation),
+             '# TYPE %s %s' % (self.name, self.metric_type)]
+    for name, labels, value in self.samples():
+      lines.append('%s%s %s' % (name, format_labels(labels),
+                                format_value(value)))
+    return '\n'.join(lines)
+
+
+class Counter(Metric):
+  metric_type = 'counter'
+
+  def inc(self, amount=1, **labels):
+    key = self.key(labels)
+    with self.lock:
+      self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+  metric_type = 'gauge'
+
+  def set(self, value, **labels):
+    with self.lock:
+      self.values[self.key(labels)] = value
+
+  def inc(self, amount=1, **labels):
+    key = self.key(labels)
+    with self.lock:
+      self.values[key] = self.values.get(key, 0) + amount
+
+  def dec(self, amount=1, **labels):
+    self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+  metric_type = 'histogram'
+
+  def __init__(self, name, documentation, labelnames=(),
+               buckets=DEFAULT_BUCKETS):
+    super(Histogram, self).__init__(name, documentation, labelnames)
+    self.buckets = tuple(buckets)
+
+  def observe(self, value, **labels):
+    key = self.key(labels)
+    index = bisect.bisect_left(self.buckets, value)
+    with self.lock:
+      counts = self.values.get(key)
+      if counts is None:
+        # a count per bucket, plus the +Inf one, the sum and the count
+        counts = self.values[key] = [0] * (len(self.buckets) + 3)
+      counts[index] += 1
+      counts[-2] += value
+      counts[-1] += 1
+
+  def samples(self):
+    with self.lock:
+      values = [(labels, list(counts))
+                for labels, counts in self.values.items()]
+    for labels, counts in sorted(values):
+      cumulative = 0
+      for bound, count in zip(self.buckets + (float('inf'),), counts):
+        cumulative += count
+        yield (self.name + '_bucket',
+               labels + (('le', format_value(float(bound))),), cumulative)
+      yield self.name + '_sum', labels, counts[-2]
+      yield self.name + '_count', labels, counts[-1]
+
+
+class CollectedMetric(Metric):
+  """A metric whose values are read from a function when rendered.
+
+  The function returns a list of (dict of labels, value) tuples.
+  """
+
+  def __init__(self, name, documentation, metric_type, collect,
+               labelnames=()):
+    super(CollectedMetric, self).__init__(name, documentation, labelnames)
+    self.metric_type = metric_type
+    self.collect = collect
+
+  def samples(self):
+    samples = [(self.key(labels), value) for labels, value in self.collect()]
+    for labels, value in sorted(samples):
+      yield self.name, labels, value
+
+
+def render():
+  """Returns every metric in the Prometheus text exposition format."""
+  return '\n'.join(metric.render() for metric in registry) + '\n'
+
+
+ROWS_RENDERED = Counter(
+    'vogon_rows_rendered_total',
+    'Feed rows rendered by video generation jobs.')
+RENDER_SECONDS = Histogram(
+    'vogon_row_render_seconds',
+    'Time to render a feed row.',
+    buckets=RENDER_BUCKETS)
+RENDER_STAGE_SECONDS = Histogram(
+    'vogon_row_render_stage_seconds',
+    'Time spent in each stage of a row render.',
+    labelnames=('stage',),
+    buckets=DEFAULT_BUCKETS + RENDER_BUCKETS[-5:])
+FFMPEG_FAILURES = Counter(
+    'vogon_ffmpeg_failures_total',
+    'ffmpeg runs that exited with an error or could not start.')
+RENDER_JOBS = Counter(
+    'vogon_render_jobs_total',
+    'Video generation jobs by outcome.',
+    labelnames=('outcome',))
+CACHE_REQUESTS = Counter(
+    'vogon_cache_requests_total',
+    'Lookups of reusable results, by cache and whether they were found.',
+    labelnames=('cache', 'result'))
+UPLOAD_BYTES = Counter(
+    'vogon_upload_bytes_total',
+    'Bytes of videos uploaded to YouTube.')
+UPLOAD_SECONDS = Histogram(
+    'vogon_upload_seconds',
+    'Time to upload a video to YouTube, by HTTP status.',
+    labelnames=('status',),
+    buckets=RENDER_BUCKETS)
+HTTP_REQUEST_SECONDS = Histogram(
+    'vogon_http_request_seconds',
+    'Time to handle HTTP requests, until the response body starts.',
+    labelnames=('method', 'route', 'status'))
+HTTP_QUEUED_REQUESTS = Gauge(
+    'vogon_http_queued_requests',
+    'Accepted HTTP requests waiting for a thread of the server pool.')
+
+
+def record_job_event(event):
+  """Updates the render metrics with a video generation job event."""
+  if event['event'] == 'row_done':
+    ROWS_RENDERED.inc()
+    RENDER_SECONDS.observe(event['duration'])
+    for stage, seconds in event['stages'].items():
+      RENDER_STAGE_SECONDS.observe(seconds, stage=stage)
+    if 'exit_code' in event and event['exit_code'] != 0:
+      FFMPEG_FAILURES.inc()
+  elif event['event'] == 'job_done':
+    RENDER_JOBS.inc(outcome='done')
+  elif event['event'] == 'job_failed':
+    RENDER_JOBS.inc(outcome='failed')
+
+job_events.add_listener(record_job_event)
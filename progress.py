@@ -0,0 +1,284 @@
+# vim: set fileencoding=utf-8 :
+
+# Copyright 2019 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Progress of the render and upload jobs of each project.
+
+Jobs publish their state here as they go, besides writing their log files,
+and the web server long-polls it, so the UI learns about progress as soon as
+it is published instead of tailing log files on a timer. The latest state
+of a job is also saved in the project folder, so a server process that
+does not run the job, like another worker of --server workers, answers
+with it too.
+
+EtaEstimator turns the rows a job has finished, and how far the current one
+is, into an estimate of the time left.
+
+Which jobs run, and which are asked to stop, is shared by every process of
+the server through JobMarker files in the project folder, so a worker
+process can cancel a job another one runs.
+"""
+
+import collections
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+
+VIDEO_GENERATION = 'video_generation'
+YOUTUBE = 'youtube'
+# kinds of JobMarker
+RUNNING = 'running'
+STOPPING = 'stop'
+STATE_FILE = '.progress_%s.json'
+# how often waiters look for the states published by other processes
+POLL_INTERVAL = 0.5
+# states the log lines of finished jobs start with
+FINISHED_STATES = ('[DONE]', '[Done]', '[FAIL]', '[ERROR]')
+
+condition = threading.Condition()
+states = {}
+
+
+def publish(project_id, job, started_at, current_state, **details):
+  """Stores the latest state of a project's job and wakes up its waiters.
+
+  Details, like the percentage done or the ETA, are added to the state as
+  they are.
+  """
+  with condition:
+    previous = latest(project_id, job)
+    state = {
+      'version': previous['version'] + 1 if previous else 1,
+      'started_at': started_at,
+      'current_state': current_state
+    }
+    state.update(details)
+    states[(project_id, job)] = state
+    save_state(project_id, job, state)
+    condition.notify_all()
+
+
+def state_path(project_id, job):
+  return os.path.join('projects', project_id, STATE_FILE % job)
+
+
+def save_state(project_id, job, state):
+  path = state_path(project_id, job)
+  temp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+  try:
+    with open(temp_path, 'w') as f:
+      json.dump(state, f)
+      f.close()
+    os.replace(temp_path, path)
+  except OSError:
+    # the project was deleted; waiters of this process still get the state
+    if os.path.exists(temp_path):
+      os.unlink(temp_path)
+
+
+def latest(project_id, job):
+  """Returns the latest state of a project's job, or None.
+
+  That is the newest of the state this process published and the one saved
+  by any process.
+  """
+  with condition:
+    state = states.get((project_id, job))
+    state = dict(state) if state else None
+  try:
+    with open(state_path(project_id, job)) as f:
+      saved = json.load(f)
+      f.close()
+  except (OSError, ValueError):
+    saved = None
+  if saved and (state is None or saved['version'] > state['version']):
+    return saved
+  return state
+
+
+def wait_for_update(project_id, job, since_version, timeout):
+  """Waits until a job publishes a state newer than since_version.
+
+  States published by this process wake the waiter at once, the ones of
+  other processes are seen within POLL_INTERVAL.
+
+  Returns:
+    The newest state, or None if nothing newer was published before the
+    timeout.
+  """
+  key = (project_id, job)
+  def has_update():
+    return key in states and states[key]['version'] > since_version
+  deadline = time.monotonic() + timeout
+  while True:
+    state = latest(project_id, job)
+    if state is not None and state['version'] > since_version:
+      return state
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+      return None
+    with condition:
+      condition.wait_for(has_update, min(remaining, POLL_INTERVAL))
+
+
+def is_finished(current_state):
+  return current_state.startswith(FINISHED_STATES)
+
+
+def run_job(project_id, job, target, *args):
+  """Calls target(*args) holding the RUNNING JobMarker of a job."""
+  with JobMarker(project_id, RUNNING, job):
+    return target(*args)
+
+
+def last_line(file_path, block_size=4096):
+  """Returns the last line of a file without reading all of it."""
+  with open(file_path, 'rb') as f:
+    f.seek(0, 2)
+    end = f.tell()
+    data = b''
+    position = end
+    while position > 0:
+      position = max(0, position - block_size)
+      f.seek(position)
+      data = f.read(end - position)
+      # a trailing line break does not start the last line
+      if b'\n' in data.rstrip(b'\n'):
+        break
+    f.close()
+  return data.rstrip(b'\n').split(b'\n')[-1].decode('utf-8', 'replace')
+
+
+class EtaEstimator(object):
+  """Estimates the time left of a job processing a known number of rows.
+
+  A row is assumed to cost the moving average of the durations of the last
+  `window` finished rows, so the estimate follows a slower part of the feed
+  without jumping on every outlier. Until a row finishes, the cost is
+  extrapolated from how far the current row is.
+  """
+
+  def __init__(self, total_rows, window=10):
+    self.total_rows = total_rows
+    self.durations = collections.deque(maxlen=window)
+
+  def add_row(self, seconds):
+    self.durations.append(seconds)
+
+  def row_cost(self):
+    """Returns the estimated seconds per row, or None before the first."""
+    if not self.durations:
+      return None
+    return sum(self.durations) / len(self.durations)
+
+  def eta(self, rows_done, row_fraction=0.0, row_elapsed=0.0):
+    """Returns the seconds left, or None if there is nothing to go on yet.
+
+    Arguments:
+      rows_done: rows finished, not counting the one in progress.
+      row_fraction: how much of the row in progress is done, 0 to 1.
+      row_elapsed: seconds since the row in progress started.
+    """
+    rows_left = self.total_rows - rows_done
+    if rows_left <= 0:
+      return 0.0
+    cost = self.row_cost()
+    if row_fraction > 0:
+      current_row_left = row_elapsed / row_fraction - row_elapsed
+      if cost is None:
+        cost = row_elapsed / row_fraction
+    elif cost is None:
+      return None
+    else:
+      current_row_left = max(cost - row_elapsed, 0.0)
+    return current_row_left + (rows_left - 1) * cost
+
+
+def format_eta(seconds):
+  """Formats seconds as H:MM:SS, or '--' when unknown."""
+  if seconds is None:
+    return '--'
+  minutes, seconds = divmod(int(round(seconds)), 60)
+  hours, minutes = divmod(minutes, 60)
+  return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+
+class JobMarker(object):
+  """A file telling every process that a job runs, or is asked to stop.
+
+  The file is flocked by the process holding the marker, from acquire() to
+  release(), so the marker of a process that died is seen as gone. Usable
+  on 'with' statements.
+  """
+
+  def __init__(self, project_id, kind, job, name=None):
+    self.name = name or '%d_%d' % (os.getpid(), threading.get_ident())
+    self.path = os.path.join('projects', project_id,
+                             '.%s_%s_%s' % (kind, job, self.name))
+    self.file = None
+
+  def acquire(self):
+    # locked before it gets its name, so it is never seen unlocked
+    temp_path = os.path.join(os.path.dirname(self.path),
+                             '.new' + os.path.basename(self.path))
+    self.file = open(temp_path, 'w')
+    fcntl.flock(self.file, fcntl.LOCK_EX)
+    os.replace(temp_path, self.path)
+
+  def release(self):
+    try:
+      os.unlink(self.path)
+    except OSError:
+      pass
+    self.file.close()
+
+  def __enter__(self):
+    self.acquire()
+    return self
+
+  def __exit__(self, type_, value, traceback_):
+    self.release()
+
+
+def is_held(project_id, kind, job):
+  """Whether any process holds a marker of a kind of a job."""
+  pattern = os.path.join('projects', project_id, '.%s_%s_*' % (kind, job))
+  for path in glob.glob(pattern):
+    try:
+      f = open(path)
+    except OSError:
+      continue
+    with f:
+      try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except OSError:
+        return True
+      # left by a process that died
+      try:
+        os.unlink(path)
+      except OSError:
+        pass
+  return False
+
+
+def is_running(project_id, job):
+  return is_held(project_id, RUNNING, job)
+
+
+def stop_requested(project_id, job):
+  return is_held(project_id, STOPPING, job)
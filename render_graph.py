@@ -0,0 +1,233 @@
+# vim: set fileencoding=utf-8 :
+
+# Copyright 2019 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Filter graphs of renders, built as objects and serialized to ffmpeg syntax.
+
+A RenderGraph holds the filters of a row's -filter_complex. Each filter reads
+and writes named slots: '1:v' is the video of the second ffmpeg input, and
+other names are the links between filters. The slots mapped to the output
+file are the graph's outputs.
+
+Graphs are built naively, one filter per step, and then optimize()d:
+
+- no-op filters, like copy, a scale to -1:-1 or volume=1, are dropped and
+  their consumers rewired to their input;
+- adjacent filters that undo or repeat each other, like two identical
+  format conversions or two volume changes, are merged;
+- filters that no output depends on, like the audio of an overlay that is
+  never mixed, are dropped.
+
+serialize() then joins every linear run of filters into one ffmpeg filter
+chain, 'a,b,c', so only the links between chains get a label.
+"""
+
+VIDEO = 'video'
+AUDIO = 'audio'
+
+
+class Filter(object):
+  """An ffmpeg filter reading input slots and writing output slots.
+
+  Options are (name, value) tuples, with None as the name of positional
+  ones, and values already escaped for ffmpeg.
+  """
+
+  def __init__(self, name, options=(), inputs=(), outputs=(), media=VIDEO):
+    self.name = name
+    self.options = [(key, '%s' % value) for key, value in options]
+    self.inputs = list(inputs)
+    self.outputs = list(outputs)
+    self.media = media
+
+  def option(self, key, position=None):
+    """Returns the value of an option, given by name or position."""
+    for n, (name, value) in enumerate(self.options):
+      if name == key or (name is None and n == position):
+        return value
+    return None
+
+  def spec(self):
+    """Returns the filter in ffmpeg syntax, without its slots."""
+    if not self.options:
+      return self.name
+    return '%s=%s' % (self.name, ':'.join(
+        value if key is None else '%s=%s' % (key, value)
+        for key, value in self.options))
+
+  def __repr__(self):
+    return '%s%s%s' % (''.join('[%s]' % s for s in self.inputs), self.spec(),
+                       ''.join('[%s]' % s for s in self.outputs))
+
+
+class RenderGraph(object):
+  """The filters of a render, in the order they were added."""
+
+  def __init__(self):
+    self.filters = []
+    self.video_output = None
+    self.audio_output = None
+
+  def add(self, name, options=(), inputs=(), outputs=(), media=VIDEO):
+    """Adds a filter and returns it."""
+    f = Filter(name, options, inputs, outputs, media)
+    self.filters.append(f)
+    return f
+
+  def outputs(self):
+    return [s for s in (self.video_output, self.audio_output) if s]
+
+  def producers(self):
+    """Returns a dict of the filter writing each slot."""
+    return dict((slot, f) for f in self.filters for slot in f.outputs)
+
+  def consumers(self):
+    """Returns a dict of the filters reading each slot."""
+    readers = {}
+    for f in self.filters:
+      for slot in f.inputs:
+        readers.setdefault(slot, []).append(f)
+    return readers
+
+  def optimize(self):
+    """Simplifies the graph without changing what it renders."""
+    self.drop_noops()
+    self.merge_adjacent()
+    self.drop_unused()
+    return self
+
+  def drop_noops(self):
+    for f in list(self.filters):
+      if is_noop(f):
+        self.bypass(f)
+
+  def merge_adjacent(self):
+    merged = True
+    while merged:
+      merged = False
+      for f in self.filters:
+        following = self.sole_consumer(f)
+        if following is not None and merge(f, following):
+          self.bypass(following)
+          merged = True
+          break
+
+  def drop_unused(self):
+    """Drops the filters none of the outputs depends on."""
+    producers = self.producers()
+    needed = set()
+    pending = list(self.outputs())
+    while pending:
+      f = producers.get(pending.pop())
+      if f is not None and id(f) not in needed:
+        needed.add(id(f))
+        pending.extend(f.inputs)
+    self.filters = [f for f in self.filters if id(f) in needed]
+
+  def sole_consumer(self, f):
+    """Returns the only filter reading the only output of f, if any."""
+    if len(f.outputs) != 1 or f.outputs[0] in self.outputs():
+      return None
+    readers = self.consumers().get(f.outputs[0], [])
+    if len(readers) != 1 or len(readers[0].inputs) != 1:
+      return None
+    return readers[0]
+
+  def bypass(self, f):
+    """Removes a single input, single output filter, rewiring its readers.
+
+    A graph output keeps its name: the filter writing the bypassed filter's
+    input is renamed, unless the input is an ffmpeg input or read by other
+    filters too, in which case the filter is kept.
+    """
+    if len(f.inputs) != 1 or len(f.outputs) != 1:
+      return False
+    source, target = f.inputs[0], f.outputs[0]
+    if target in self.outputs():
+      producer = self.producers().get(source)
+      if producer is None or len(self.consumers().get(source, [])) > 1:
+        return False
+      producer.outputs = [target if s == source else s
+                          for s in producer.outputs]
+    else:
+      for reader in self.filters:
+        reader.inputs = [source if s == target else s for s in reader.inputs]
+    self.filters.remove(f)
+    return True
+
+  def serialize(self):
+    """Returns the graph as a list of ffmpeg filter chains."""
+    producers = self.producers()
+    consumers = self.consumers()
+    chains = []
+    chain_of = {}
+    for f in self.filters:
+      chain = None
+      if len(f.inputs) == 1:
+        previous = producers.get(f.inputs[0])
+        if (previous is not None and len(previous.outputs) == 1 and
+            len(consumers[f.inputs[0]]) == 1 and
+            f.inputs[0] not in self.outputs() and
+            chain_of[id(previous)][-1] is previous):
+          chain = chain_of[id(previous)]
+      if chain is None:
+        chain = []
+        chains.append(chain)
+      chain.append(f)
+      chain_of[id(f)] = chain
+    return ['%s%s%s' % (''.join('[%s]' % s for s in chain[0].inputs),
+                        ','.join(f.spec() for f in chain),
+                        ''.join('[%s]' % s for s in chain[-1].outputs))
+            for chain in chains]
+
+
+def is_noop(f):
+  """Whether a single input filter passes its input through unchanged."""
+  if f.name in ('copy', 'acopy', 'null', 'anull'):
+    return True
+  if f.name == 'scale':
+    return (len(f.options) == 2 and
+            f.option('w', 0) in ('-1', 'iw') and
+            f.option('h', 1) in ('-1', 'ih'))
+  if f.name == 'volume':
+    return len(f.options) == 1 and is_number(f.option('volume', 0), 1.0)
+  return False
+
+
+def merge(f, following):
+  """Merges a filter into the one it feeds, returning whether it did.
+
+  The merged filter keeps the options of both, so `following` is left to be
+  bypassed.
+  """
+  if f.name != following.name:
+    return False
+  if f.name == 'format':
+    return f.options == following.options
+  if f.name == 'volume' and len(f.options) == len(following.options) == 1:
+    try:
+      f.options = [(f.options[0][0], '%s' % (float(f.options[0][1]) *
+                                              float(following.options[0][1])))]
+    except ValueError:
+      return False
+    return True
+  return False
+
+
+def is_number(value, number):
+  try:
+    return value is not None and float(value) == number
+  except ValueError:
+    return False
@@ -0,0 +1,182 @@
+# vim: set fileencoding=utf-8 :
+
+# Copyright 2019 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Dry-run planning of the renders of a project.
+
+Compiles each feed row into the ffmpeg command that would render it, without
+running ffmpeg or rasterizing texts, so a config can be checked against a
+whole feed before any video is rendered. Plans are JSON objects, one per
+row, listing the command, the inputs, the filter graph, the output and the
+assets and fonts it uses, plus the issues found:
+
+  missing_asset     an image, video or base video that does not exist
+  missing_font      a font file that does not exist
+  past_duration     an overlay ending after the base video does
+  duplicate_output  an output file name another row renders too
+  invalid_row       a row that could not be compiled at all
+
+The rows are compiled on worker processes, in chunks, like the rows of the
+Ads Editor CSV.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import row_mapper
+import vogon
+
+# seconds overlays may run past the end of the base video, for rounding
+DURATION_TOLERANCE = 0.05
+
+
+def iter_plans(project_id, workers=1, config=None):
+  """Yields the render plan of each row of a project's feed, in order.
+
+  The last item is a summary, {'summary': {...}}, with the number of rows
+  and the number of issues of each type.
+
+  Args:
+    project_id: name of the project folder, under projects/.
+    workers: number of worker processes compiling rows.
+    config: the project config, if already loaded.
+  """
+  project_dir = os.path.join('projects', project_id)
+  if config is None:
+    config = vogon.load_config(os.path.join(project_dir, 'config.json'))
+  base_video = os.path.join(project_dir, 'assets', config['video'])
+  base_duration = vogon.video_duration(
+      base_video, vogon.ffprobe_executable(config.get('ffmpeg_path', 'ffmpeg')))
+  rows = vogon.iter_csv_file(os.path.join(project_dir, 'feed.csv'), ',')
+  jobs = ((i, row) for i, row in enumerate(rows))
+
+  outputs = {}
+  summary = {'rows': 0, 'rows_with_issues': 0, 'issues': {},
+             'base_video_duration': base_duration}
+  with row_mapper.RowMapper(workers) as mapper:
+    for i, plan in mapper.map(plan_row, (config, project_id, base_duration),
+                              jobs):
+      # duplicates are only seen across rows, so they are found here
+      output = plan.get('output')
+      if output is not None:
+        if output in outputs:
+          plan['issues'].append({'type': 'duplicate_output', 'path': output,
+                                 'first_row': outputs[output]})
+        else:
+          outputs[output] = plan['row']
+      summary['rows'] += 1
+      if plan['issues']:
+        summary['rows_with_issues'] += 1
+      for issue in plan['issues']:
+        summary['issues'][issue['type']] = (
+            summary['issues'].get(issue['type'], 0) + 1)
+      yield plan
+  yield {'summary': summary}
+
+
+def plan_row(config, project_id, base_duration, job):
+  """Returns the render plan of a (row index, row) job."""
+  i, row = job
+  plan = {'row': i + 1, 'issues': []}
+  try:
+    render = vogon.build_render(config, row, i + 1, project_id, dry_run=True)
+  except Exception as e:  # pylint: disable=broad-except
+    plan['issues'].append({'type': 'invalid_row', 'error': '%s' % e})
+    return plan
+
+  command = vogon.ffmpeg_args(render['img_args'], render['filters'],
+                              render['base_video'], render['output_video'],
+                              render['out_audio_filter'],
+                              render['out_video_filter'],
+                              render['executable'])
+  assets = [render['base_video']] + [
+      os.path.join('projects', project_id, 'assets', overlay['image'])
+      for overlay in render['image_overlays']]
+  fonts = [vogon.resolve_font(overlay['font'])
+           for overlay in render['text_overlays']]
+  plan.update({
+      'output': render['output_video'],
+      'command': command,
+      'inputs': [command[n + 1] for n, arg in enumerate(command)
+                 if arg == '-i'],
+      'filter_complex': ';'.join(render['filters']),
+      'assets': assets,
+      'fonts': fonts,
+      'texts': [overlay['text'] for overlay in render['text_overlays']]
+  })
+
+  for asset in sorted(set(assets)):
+    if not os.path.isfile(asset):
+      plan['issues'].append({'type': 'missing_asset', 'path': asset})
+  for font in sorted(set(fonts)):
+    if not os.path.isfile(font):
+      plan['issues'].append({'type': 'missing_font', 'path': font})
+  if base_duration is not None:
+    overlays = render['image_overlays'] + render['text_overlays']
+    for n, overlay in enumerate(overlays):
+      end_time = float(overlay['end_time'])
+      if end_time > base_duration + DURATION_TOLERANCE:
+        plan['issues'].append({
+            'type': 'past_duration',
+            'overlay': n,
+            'end_time': end_time,
+            'base_video_duration': base_duration
+        })
+  return plan
+
+
+def write_plans(project_id, output, workers=1, issues_only=False):
+  """Writes the plans of a project as JSON lines, returning the summary."""
+  summary = None
+  for plan in iter_plans(project_id, workers):
+    if 'summary' in plan:
+      summary = plan['summary']
+    elif issues_only and not plan['issues']:
+      continue
+    output.write(json.dumps(plan) + '\n')
+  return summary
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Writes the render plan of each feed row as JSON lines, '
+                  'without rendering anything.')
+  parser.add_argument("project_id",
+          help="Name of the project folder under the 'projects' dir")
+  parser.add_argument("--output",
+          help="File to write the plans to, instead of stdout")
+  parser.add_argument("--workers",
+          help="Worker processes compiling the rows",
+          type=int,
+          default=os.cpu_count() or 1)
+  parser.add_argument("--issues_only",
+          help="Only write the plans of rows with issues",
+          action="store_true")
+  args = parser.parse_args()
+
+  output = open(args.output, 'w') if args.output else sys.stdout
+  try:
+    summary = write_plans(args.project_id, output, args.workers,
+                          args.issues_only)
+  finally:
+    if args.output:
+      output.close()
+  print(json.dumps(summary), file=sys.stderr)
+  sys.exit(1 if summary['rows_with_issues'] else 0)
+
+if __name__=='__main__':
+  main()
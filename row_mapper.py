@@ -0,0 +1,98 @@
+# vim: set fileencoding=utf-8 :
+
+# Copyright 2019 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Maps functions over feed rows on worker processes, keeping their order.
+
+Used by the builds that compile every row of a feed, like the Ads Editor
+CSV and the render plans, to spread the rows over processes.
+"""
+
+import collections
+import concurrent.futures
+import itertools
+import multiprocessing
+
+# Feed rows sent at once to each worker.
+CHUNK_SIZE = 500
+
+
+class RowMapper(object):
+  """Maps a function over feed rows, in order, on worker processes.
+
+  Rows are sent to the workers in chunks, and a bounded number of chunks is
+  in flight at once, so the feed is still read as a stream. Results come back
+  in the order of the rows whatever worker computed them, which keeps the
+  output identical to a build on a single process. With one worker, or
+  feeds of a single chunk, the function runs on the calling process.
+  """
+
+  def __init__(self, workers=1, chunk_size=CHUNK_SIZE):
+    self.workers = workers
+    self.chunk_size = chunk_size
+    self.executor = None
+    self.in_flight = collections.deque()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type_, value, traceback_):
+    if self.executor is not None:
+      # chunks of an abandoned map are not computed for nothing
+      for future in self.in_flight:
+        future.cancel()
+      self.executor.shutdown()
+
+  def map(self, func, args, jobs):
+    """Yields (row index, func(*args, job)) for each job, in order.
+
+    The row index is the first item of each job.
+    """
+    chunks = iter_chunks(jobs, self.chunk_size)
+    first_chunks = [chunk for chunk in (next(chunks, None),
+                                        next(chunks, None)) if chunk]
+    if self.workers <= 1 or len(first_chunks) < 2:
+      for chunk in itertools.chain(first_chunks, chunks):
+        for result in map_chunk(func, args, chunk):
+          yield result
+      return
+    if self.executor is None:
+      # spawned workers do not inherit the locks of the server's threads
+      self.executor = concurrent.futures.ProcessPoolExecutor(
+          self.workers, mp_context=multiprocessing.get_context('spawn'))
+    in_flight = self.in_flight
+    for chunk in itertools.chain(first_chunks, chunks):
+      in_flight.append(self.executor.submit(map_chunk, func, args, chunk))
+      if len(in_flight) >= self.workers * 2:
+        for result in in_flight.popleft().result():
+          yield result
+    while in_flight:
+      for result in in_flight.popleft().result():
+        yield result
+
+
+def map_chunk(func, args, chunk):
+  return [(job[0], func(*(args + (job,)))) for job in chunk]
+
+
+def iter_chunks(iterable, chunk_size):
+  chunk = []
+  for item in iterable:
+    chunk.append(item)
+    if len(chunk) >= chunk_size:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
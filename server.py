@@ -27,28 +27,55 @@ program_dir = path.abspath(path.dirname(__file__))
 sys.path.insert(0, program_dir + '/third_party/bottle/')
 
 import argparse
-from bottle import get, post, delete, request, route, run, static_file, response
-import codecs
-from io import StringIO
-import csv
-from distutils.dir_util import copy_tree
+from bottle import get, post, delete, install, request, route, run, static_file, response
+from bottle import HTTPResponse, parse_range_header, redirect
+import concurrent.futures
+import email.utils
 import http.client
 import json
 import os
 import platform
 import re
 import shutil
-import subprocess
-import tempfile
+import signal
 import threading
 import time
 import urllib
 import zipfile
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer
 
+import asset_store
+import disk_usage
+import feed_index
+import feed_store
+import font_index
+import http_cache
+import metrics
+import progress
+import render_plan
+import stored_zip
+import thumbnails
 import vogon
 import yt_api
+import yt_retry
 import google_ads_editor_csv as g_ads_editor
 
+# Long-polls of job progress answer after this many seconds without updates.
+PROGRESS_POLL_TIMEOUT = 10
+
+# Renders requested by the web UI run here, so they never hold more than
+# RENDER_WORKERS ffmpeg processes at once.
+RENDER_WORKERS = 2
+render_executor = concurrent.futures.ThreadPoolExecutor(RENDER_WORKERS)
+preview_jobs = {}
+preview_jobs_lock = threading.Lock()
+# the last preview video rendered of each (project, row)
+preview_videos = {}
+
+# Processes sharing the row work of an Editor CSV build, or of a render plan.
+EDITOR_CSV_WORKERS = os.cpu_count() or 1
+RENDER_PLAN_WORKERS = os.cpu_count() or 1
+
 ################################################################################
 # YOUTUBE AUTHENTICATION
 ################################################################################
@@ -125,9 +152,38 @@ def post_config(project_folder):
 @get('/api/projects/<project_folder>/preview/row/<index>')
 def generate_preview(project_folder, index):
   config_file = os.path.join("projects", project_folder, "config.json")
-  video = vogon.generate_preview(config_file, int(index),
-                                 project_dir=project_folder)
-  return static_file(video, root='./', download=video)
+  # the preview is rendered on the render executor, and simultaneous requests
+  # for the same row share the same render.
+  job_key = (project_folder, int(index))
+  # the player seeking in a preview asks for the rest of it from an offset;
+  # that is the preview it is playing, not a new render
+  range_header = request.environ.get('HTTP_RANGE', '')
+  if re.match(r'^bytes=[1-9]', range_header):
+    with preview_jobs_lock:
+      video = preview_videos.get(job_key)
+    if video is None:
+      # rendered by another worker process, with --server workers
+      video = vogon.preview_video_path(config_file, int(index),
+                                       project_folder)
+    if video and os.path.isfile(video):
+      return send_file(video, download=video)
+  with preview_jobs_lock:
+    job = preview_jobs.get(job_key)
+    metrics.CACHE_REQUESTS.inc(cache='preview_render',
+                               result='miss' if job is None else 'hit')
+    if job is None:
+      job = render_executor.submit(vogon.generate_preview, config_file,
+                                   int(index), project_dir=project_folder)
+      preview_jobs[job_key] = job
+      job.add_done_callback(lambda _: forget_preview_job(job_key))
+  video = job.result()
+  with preview_jobs_lock:
+    preview_videos[job_key] = video
+  return send_file(video, download=video)
+
+def forget_preview_job(job_key):
+  with preview_jobs_lock:
+    preview_jobs.pop(job_key, None)
 
 @post('/api/projects/<project_id>/generate_all_videos')
 def generate_all_variations(project_id):
@@ -136,6 +192,19 @@ def generate_all_variations(project_id):
   t.start()
   return json.dumps("Started")
 
+@get('/api/projects/<project_id>/render_plan')
+def get_render_plan(project_id):
+  """Streams the dry-run render plan of every feed row as JSON lines.
+
+  With ?issues_only=1 only the rows with issues are sent. The last line is
+  the summary of the whole feed.
+  """
+  issues_only = request.query.get('issues_only') in ('1', 'true')
+  plans = render_plan.iter_plans(project_id, workers=RENDER_PLAN_WORKERS)
+  response.headers['Content-Type'] = 'application/x-ndjson'
+  return (json.dumps(plan) + '\n' for plan in plans
+          if not issues_only or 'summary' in plan or plan['issues'])
+
 @get('/api/projects/<project_id>/cancel_video_generation')
 def cancel_video_generation(project_id):
   vogon.stop_video_generation(project_id)
@@ -144,12 +213,50 @@ def cancel_video_generation(project_id):
 @get('/api/projects/<project_id>/update_on_video_generation')
 def update_on_video_generation(project_id):
   started_at, current_state = vogon.get_video_generation_percent(project_id)
-  current_state = current_state.decode('utf-8') if current_state != "--" else ""
+  current_state = current_state if current_state != "--" else ""
   return json.dumps({
       "started_at": str(started_at),
       "current_state": current_state
   })
 
+@get('/api/projects/<project_id>/progress/<job>')
+def wait_for_progress(project_id, job):
+  """Long-polls the state of a project's video generation or upload job.
+
+  Answers as soon as the job publishes a state newer than the 'since' version
+  in the query, or with the current state after PROGRESS_POLL_TIMEOUT. The
+  state says whether the job is finished, when the UI stops polling.
+
+  A server serving one request at a time answers at once, as a long-poll
+  would hold up every other request.
+  """
+  if job not in (progress.VIDEO_GENERATION, progress.YOUTUBE):
+    response.status = 404
+    return json.dumps({"msg": "Unknown job %s" % job})
+  since = int(request.query.get('since') or 0)
+  timeout = (PROGRESS_POLL_TIMEOUT if request.environ.get('wsgi.multithread')
+             else 0)
+  state = progress.wait_for_update(project_id, job, since, timeout)
+  if state is None:
+    state = progress.latest(project_id, job)
+  if state is None:
+    # jobs from before the server started are only found in their logs
+    if job == progress.VIDEO_GENERATION:
+      started_at, current_state = vogon.get_video_generation_percent(
+          project_id)
+      current_state = current_state if current_state != "--" else ""
+    else:
+      started_at, current_state = "--", yt_api.read_log(project_id, 1)
+    state = {
+        "version": 0,
+        "started_at": str(started_at),
+        "current_state": current_state
+    }
+  # a job whose process died never logs that it finished
+  state['finished'] = (progress.is_finished(state['current_state']) or
+                       not progress.is_running(project_id, job))
+  return json.dumps(state)
+
 ################################################################################
 # PROJECT MANAGEMENT ACTIONS
 ################################################################################
@@ -157,13 +264,14 @@ def update_on_video_generation(project_id):
 def get_available_projects():
   if not os.path.exists("projects"):
     os.makedirs("projects")
+  disk_usage.start_reconciler()
   dirs = os.listdir("projects")
   output = []
   for d in dirs:
     if d[0] != ".":
       output.append({
         "name": d,
-        "size": du("projects/"+d)
+        "size": disk_usage.format_size(disk_usage.project_size(d))
       })
   return json.dumps(output)
 
@@ -174,8 +282,8 @@ def copy_base_project(project_folder):
   base_dir = "base_project/"
   is_taken = os.path.isdir(project_dir)
   if not is_taken:
-    # copies base project
-    copy_tree(base_dir, project_dir)
+    # copies base project, linking its assets from the asset store
+    asset_store.import_tree(base_dir, project_dir)
     # fixes config file
     conf_file_path = os.path.join(project_dir, "config.json")
     data = ""
@@ -184,7 +292,6 @@ def copy_base_project(project_folder):
       config_file.close()
     with open(conf_file_path, 'w') as config_file:
       config_file.write(data)
-    time.sleep(2)
     # returns success
     return json.dumps({"success":True, "project": project_folder})
   else:
@@ -193,15 +300,18 @@ def copy_base_project(project_folder):
 @post('/api/projects/<project_folder>/clear')
 def clear_project(project_folder):
   project_folder = os.path.join("projects", project_folder, "output")
-  shutil.rmtree(project_folder)
-  os.mkdir(project_folder)
+  with disk_usage.tracking(project_folder):
+    shutil.rmtree(project_folder)
+    os.mkdir(project_folder)
   return json.dumps("True")
 
 
 @post('/api/projects/<project_folder>/delete')
 def delete_project(project_folder):
-  project_folder = os.path.join("projects", project_folder)
-  shutil.rmtree(project_folder)
+  project_dir = os.path.join("projects", project_folder)
+  shutil.rmtree(project_dir)
+  disk_usage.forget(project_folder)
+  asset_store.collect_garbage()
   return json.dumps("True")
 
 
@@ -211,7 +321,28 @@ def delete_project(project_folder):
 ################################################################################
 @get('/api/projects/<project_id>/google_ads_editor_file')
 def generate_and_download_editor_file(project_id):
-    (uploaded, missing),error = g_ads_editor.build_csv(project_id)
+    # ?shard_by=account|campaign&max_rows=N download a zip of CSV shards,
+    # ?delta=1 only the entities changed since the last download
+    shard_by = request.query.get('shard_by') or None
+    if shard_by not in (None, g_ads_editor.SHARD_BY_ACCOUNT,
+                        g_ads_editor.SHARD_BY_CAMPAIGN):
+      return json.dumps({"msg": "ERROR unknown shard_by: %s" % shard_by})
+    try:
+      max_rows = int(request.query.get('max_rows') or 0)
+    except ValueError:
+      return json.dumps({"msg": "ERROR max_rows must be a number"})
+    # ?channel_id=... picks the channel of the videos, the last one used by
+    # default
+    delta = request.query.get('delta') in ('1', 'true')
+    shards_dir = None
+    if shard_by or max_rows:
+      shards_dir = g_ads_editor.new_shards_dir(project_id)
+    (uploaded, missing),error = g_ads_editor.build_csv(
+        project_id, shard_by, max_rows, delta, workers=EDITOR_CSV_WORKERS,
+        channel_id=request.query.get('channel_id') or None,
+        shards_dir=shards_dir)
+    if shards_dir and (error is not None or missing > 0):
+      g_ads_editor.remove_shards_dir(shards_dir)
     if error is not None:
       return json.dumps({"msg": "ERROR generating CSV: %s" % error})
     elif missing >0:
@@ -220,6 +351,11 @@ def generate_and_download_editor_file(project_id):
                  "all videos and upload all of them to YouTube Before "
                  "downloading the Editor CSV." % (uploaded, missing)
       })
+    elif shards_dir:
+      response.headers['Content-Type'] = 'application/zip'
+      response.headers['Content-Disposition'] = (
+          'attachment; filename="google_ads_editor.zip"')
+      return iter_shards_zip(shards_dir)
     else:
       feed_name = "google_ads_editor.csv"
       feed_path = os.path.join("projects", project_id)
@@ -234,45 +370,91 @@ def generate_and_download_editor_file(project_id):
 
 @post('/api/projects/<project_id>/feed_content_upload')
 def feed_content_upload(project_id):
-  feed_uri = "projects/%s/feed.csv" % project_id
   feed_data = json.loads(request.body.read())['feed_data']
-  queue = StringIO()
-  writer = csv.writer(queue, dialect=csv.excel)
-  encoder = codecs.getincrementalencoder('utf-8')()
-  with open(feed_uri,'wb') as feed_file:
-    for feed_row in feed_data:
-      writer.writerow([v for v in feed_row])
-      data = queue.getvalue()
-      feed_file.write(encoder.encode(data))
-      queue.truncate(0)
-    feed_file.close()
+  feed_store.write_rows(project_id, ([v for v in row] for row in feed_data))
   return json.dumps({'success': True})
 
+@get('/api/projects/<project_id>/feed')
+def get_feed(project_id):
+  """Returns a page of the feed rows, read with one seek of its index.
+
+  ?offset=N skips N rows and ?limit=N (at most 1000) sets the page size;
+  ?columns=a,b only returns those columns; each ?filter=column=value,
+  column!=value or column~text keeps the rows matching it. Continue from
+  the next_offset of the result, see feed_index.page.
+  """
+  if not os.path.isdir(os.path.join("projects", project_id)):
+    response.status = 404
+    return json.dumps({"msg": "Unknown project %s" % project_id})
+  query = request.query.decode()
+  columns = query.get('columns')
+  try:
+    return json.dumps(feed_index.page(
+        feed_store.feed_path(project_id),
+        int(query.get('offset') or 0),
+        int(query.get('limit') or 100),
+        columns.split(',') if columns else None,
+        query.getall('filter')))
+  except ValueError as e:
+    response.status = 400
+    return json.dumps({"msg": "%s" % e})
+
+@route('/api/projects/<project_id>/feed', method='PUT')
+def put_feed(project_id):
+  """Replaces the feed with the CSV or NDJSON body, streaming it to disk.
+
+  NDJSON bodies have an application/x-ndjson Content-Type. Bodies may be
+  compressed, with a Content-Encoding of gzip, deflate or br. Returns the
+  rows changed, see feed_store.
+  """
+  if not os.path.isdir(os.path.join("projects", project_id)):
+    response.status = 404
+    return json.dumps({"msg": "Unknown project %s" % project_id})
+  content_type = request.content_type.split(';')[0].strip().lower()
+  body_format = feed_store.CSV
+  if content_type in ('application/x-ndjson', 'application/ndjson',
+                      'application/jsonl'):
+    body_format = feed_store.NDJSON
+  encoding = request.environ.get('HTTP_CONTENT_ENCODING')
+  if content_type in ('application/gzip', 'application/x-gzip'):
+    encoding = 'gzip'
+  try:
+    change = feed_store.write_stream(project_id, RequestBodyReader(request),
+                                     body_format, encoding)
+  except feed_store.FeedError as e:
+    response.status = 400
+    return json.dumps({"msg": "%s" % e})
+  return json.dumps(change)
+
+@route('/api/projects/<project_id>/feed', method='PATCH')
+def patch_feed(project_id):
+  """Applies {"operations": [...]} row changes to the feed, all or none.
+
+  See feed_store.patch for the operations. Returns the rows changed.
+  """
+  if not os.path.isdir(os.path.join("projects", project_id)):
+    response.status = 404
+    return json.dumps({"msg": "Unknown project %s" % project_id})
+  try:
+    operations = json.loads(request.body.read())
+    if isinstance(operations, dict):
+      operations = operations.get('operations')
+    change = feed_store.patch(project_id, operations)
+  except ValueError as e:
+    # FeedError, or a body that is not JSON
+    response.status = 400
+    return json.dumps({"msg": "%s" % e})
+  return json.dumps(change)
+
+@get('/api/projects/<project_id>/feed/changes')
+def get_feed_changes(project_id):
+  """Returns the row changes of the feed after version ?since=N."""
+  since = int(request.query.get('since') or 0)
+  return json.dumps(feed_store.changes_since(project_id, since))
+
 @get('/api/projects/<project_id>/fonts')
 def get_font_list(project_id):
-  matches = []
-  font_dirs = []
-  font_dirs.append("projects/%s/assets" % project_id)
-  font_dirs.append("/Library/Fonts")
-  font_dirs.append("/System/Library/Fonts")
-  font_dirs.append("/usr/share/fonts")
-  font_dirs.append("~/fonts")
-  font_dirs.append("~/.fonts")
-  for font_dir in font_dirs:
-    try:
-      for root, dirnames, filenames in os.walk(font_dir):
-        for filename in filenames:
-          font_file = os.path.join(root, filename)
-          if filename[-4:] in (".ttf",".otf"):
-            beaut_name = filename[:-4].replace("_"," ").replace("-"," ")
-            beaut_name = " ".join(re.findall('[A-Z][^A-Z]*', beaut_name))
-            if not beaut_name:
-              beaut_name = filename[:-4].replace("_"," ").replace("-"," ").split(" ")
-              beaut_name = " ".join([w.capitalize() for w in beaut_name])
-            matches.append([beaut_name, font_file])
-    except Exception as e:
-      print("error loading fonts: "+e)
-  return json.dumps(sorted(matches))
+  return json.dumps(font_index.list_fonts(project_id))
 
 @get('/api/projects/<project_id>/assets')
 def get_assets_list(project_id):
@@ -288,15 +470,90 @@ def get_assets_list(project_id):
 @post('/api/projects/<project_id>/assets')
 def post_single_asset(project_id):
   assets_path = "projects/%s/assets/" % project_id
-  with PostedFileWriter(request) as file_path:
-    if file_path[-4:] == '.zip':
-      with zipfile.ZipFile(file_path, 'r') as f:
-        f.extractall(assets_path)
-    else:
-      _, asset_name = os.path.split(file_path)
-      new_asset_path = assets_path + asset_name
-      shutil.copy(file_path, new_asset_path)
-    return get_assets_list(project_id)
+  # ngFileUpload sends the content in the "file" parameter by default
+  input_file = request.files.get("file")
+  if input_file is None or not input_file.filename:
+    response.status = 400
+    return json.dumps({"msg": "No file uploaded"})
+  if input_file.filename[-4:] == '.zip':
+    asset_store.import_zip(input_file.file, assets_path)
+  else:
+    asset_store.add_stream(input_file.file,
+                           assets_path + input_file.filename)
+  # assets replaced by the upload may have been the last link to theirs
+  asset_store.collect_garbage()
+  return get_assets_list(project_id)
+
+@route('/api/projects/<project_id>/assets/<asset_name:path>', method='PUT')
+def put_asset(project_id, asset_name):
+  """Uploads an asset as the raw request body, streaming it to the store.
+
+  A .zip is extracted into the dir of asset_name.
+  """
+  asset_full_path = safe_asset_path(project_id, asset_name)
+  if asset_full_path is None:
+    response.status = 400
+    return json.dumps({"msg": "Invalid asset path %s" % asset_name})
+  body = RequestBodyReader(request)
+  if asset_full_path[-4:] == '.zip':
+    asset_store.import_zip_stream(body, os.path.dirname(asset_full_path))
+  else:
+    asset_store.add_stream(body, asset_full_path)
+  asset_store.collect_garbage()
+  return get_assets_list(project_id)
+
+@post('/api/projects/<project_id>/uploads')
+def start_upload(project_id):
+  """Starts a resumable upload of {"asset_path": ..., "size": bytes}.
+
+  The parts are PUT to /api/projects/<project_id>/uploads/<upload_id>
+  with their offset, ?offset=N; GETting that URL gives the offset to resume
+  from after a failure.
+  """
+  data = request.json or {}
+  asset_full_path = safe_asset_path(project_id, data.get('asset_path', ''))
+  if asset_full_path is None or not isinstance(data.get('size'), int) or \
+      data['size'] < 0:
+    response.status = 400
+    return json.dumps({"msg": "An asset_path and a size are required"})
+  upload_id = asset_store.start_upload(asset_full_path, data['size'])
+  return json.dumps({"upload_id": upload_id, "offset": 0,
+                     "size": data['size'], "complete": False})
+
+@get('/api/projects/<project_id>/uploads/<upload_id>')
+def get_upload(project_id, upload_id):
+  try:
+    state = asset_store.upload_state(upload_id)
+  except KeyError:
+    response.status = 404
+    return json.dumps({"msg": "Unknown upload %s" % upload_id})
+  return json.dumps({"upload_id": upload_id, "offset": state['offset'],
+                     "size": state['size'], "complete": False})
+
+@route('/api/projects/<project_id>/uploads/<upload_id>', method='PUT')
+def put_upload_part(project_id, upload_id):
+  try:
+    offset = int(request.query.get('offset') or 0)
+    state = asset_store.append_upload(upload_id, offset,
+                                      RequestBodyReader(request))
+    if state['complete']:
+      asset_store.collect_garbage()
+  except KeyError:
+    response.status = 404
+    return json.dumps({"msg": "Unknown upload %s" % upload_id})
+  except ValueError as e:
+    # the client resumes from the offset of the upload, if it still exists
+    try:
+      state = asset_store.upload_state(upload_id)
+    except KeyError:
+      response.status = 404
+      return json.dumps({"msg": "Unknown upload %s" % upload_id})
+    response.status = 409
+    return json.dumps({"msg": "%s" % e, "upload_id": upload_id,
+                       "offset": state['offset'], "size": state['size'],
+                       "complete": False})
+  return json.dumps({"upload_id": upload_id, "offset": state['offset'],
+                     "size": state['size'], "complete": state['complete']})
 
 def move_file(origin_path, dest_path):
     upload = bottle.request.files.get('file')
@@ -314,7 +571,9 @@ def delete_asset(project_id):
   try:
     assets_path = "projects/%s/assets/" % project_id
     asset_full_path = os.path.join(assets_path, asset_name)
-    os.unlink(asset_full_path)
+    with disk_usage.tracking(asset_full_path):
+      os.unlink(asset_full_path)
+    asset_store.collect_garbage()
   except Exception as e:  # pylint: disable=broad-except
     error_msg = 'Error unlinking file %s.\nError: %s.'
     error_msg %= (request.body, e)
@@ -324,15 +583,110 @@ def delete_asset(project_id):
 @get('/api/projects/<project_id>/download/assets/')
 def download_asset(project_id):
   asset_name = request.query['asset_path']
-  assets_path = "projects/%s/assets/" % project_id
-  file_path = os.path.join(assets_path, asset_name)
-  filename = str(os.path.basename(file_path))
+  file_path = safe_asset_path(project_id, asset_name)
+  if file_path is None:
+    response.status = 400
+    return json.dumps({"msg": "Invalid asset path %s" % asset_name})
+  # the attachment downloads when opened, and still plays in the UI's player
+  return send_file(file_path, download=str(os.path.basename(file_path)))
+
+@get('/api/projects/<project_id>/thumbnails/')
+def get_asset_thumbnail(project_id):
+  """Redirects to the thumbnail of an image or video asset, making it.
+
+  Thumbnails are made on the thumbnails module's pool, and their URLs are
+  named after the content of their asset, so they are cached for good.
+  """
+  asset_name = request.query.getunicode('asset_path') or ''
+  file_path = safe_asset_path(project_id, asset_name)
+  if file_path is None or not os.path.isfile(file_path):
+    response.status = 404
+    return json.dumps({"msg": "Unknown asset %s" % asset_name})
+  config_file = os.path.join("projects", project_id, "config.json")
+  try:
+    ffmpeg = vogon.load_config(config_file).get('ffmpeg_path', 'ffmpeg')
+  except (OSError, ValueError):
+    ffmpeg = 'ffmpeg'
+  try:
+    name = thumbnails.thumbnail(file_path, ffmpeg)
+  except thumbnails.ThumbnailError as e:
+    response.status = 500
+    return json.dumps({"msg": "%s" % e})
+  if name is None:
+    response.status = 404
+    return json.dumps({"msg": "%s has no thumbnail" % asset_name})
+  # the asset may change, the thumbnail it redirects to never does
+  response.headers['Cache-Control'] = http_cache.REVALIDATE
+  redirect('/api/thumbnails/%s' % name)
+
+@get('/api/thumbnails/<name>')
+def get_thumbnail(name):
+  file_path = (thumbnails.cache.get(name)
+               if thumbnails.NAME_PATTERN.match(name) else None)
+  if file_path is None:
+    response.status = 404
+    return json.dumps({"msg": "Unknown thumbnail %s" % name})
+  body = send_file(file_path)
+  response.headers['Cache-Control'] = http_cache.IMMUTABLE
+  return body
+
+@get('/api/projects/<project_id>/download/output')
+def download_output(project_id):
+  """Downloads the rendered videos of a project as a zip.
+
+  ?rows=10-20 only zips the videos of those feed rows, 1-based and
+  inclusive; '10-' goes to the last row. The zip is streamed as it is read,
+  and Range requests resume a download.
+  """
+  rows = request.query.get('rows')
+  row_range = None
+  if rows:
+    match = re.match(r'^(\d+)(?:-(\d*))?$', rows)
+    if not match:
+      response.status = 400
+      return json.dumps({"msg": "Invalid row range %s" % rows})
+    first = int(match.group(1))
+    last = match.group(2)
+    last = first if last is None else int(last) if last else None
+    row_range = (first, last)
+  archive = stored_zip.StoredZip(output_files(project_id, row_range))
+  filename = '%s_output%s.zip' % (project_id, '_rows_%s' % rows if rows else '')
+  response.headers['Content-Type'] = 'application/zip'
+  response.headers['Content-Disposition'] = (
+      'attachment; filename="%s"' % filename)
+  return ranged_body(archive.size, archive.etag, archive.iter_bytes)
+
+def output_files(project_id, row_range=None):
+  """Returns (name in the zip, path) of the rendered videos of a project.
 
-  # renders to browser as file to download, not to display.
-  response.headers['Content-Type'] = 'application/octet-stream'
-  response.headers['Content-Disposition'] = 'attachment; filename="%s"'
-  response.headers['Content-Disposition'] %= (filename)
-  return static_file(asset_name, root=assets_path, download=filename)
+  row_range, (first, last or None), restricts them to the videos of those
+  feed rows.
+  """
+  output_dir = os.path.join("projects", project_id, "output")
+  if row_range is None:
+    files = []
+    for root, dirnames, filenames in os.walk(output_dir):
+      for filename in filenames:
+        file_path = os.path.join(root, filename)
+        files.append((os.path.relpath(file_path, output_dir), file_path))
+    return sorted(files)
+  first, last = row_range
+  project_dir = os.path.join("projects", project_id)
+  config = vogon.load_config(os.path.join(project_dir, "config.json"))
+  files = []
+  names = set()
+  rows = vogon.iter_csv_file(os.path.join(project_dir, "feed.csv"), ',')
+  for i, row in enumerate(rows):
+    if i + 1 < first:
+      continue
+    if last is not None and i + 1 > last:
+      break
+    name = vogon.output_video_name(config, row, i + 1)
+    file_path = os.path.join(output_dir, name)
+    if name not in names and os.path.isfile(file_path):
+      names.add(name)
+      files.append((name, file_path))
+  return files
 
 
 ################################################################################
@@ -352,46 +706,470 @@ def get_index():
 ################################################################################
 # Static Files
 ################################################################################
+static_files = http_cache.StaticFiles(program_dir + '/static/')
+
 @get('/static/<filepath:path>')
 def get_static(filepath):
-    static_dir = program_dir + '/static/'
-    return static_file(filepath, root=static_dir)
+    entry = static_files.get(filepath)
+    if entry is None:
+      static_dir = program_dir + '/static/'
+      return static_file(filepath, root=static_dir)
+    # URLs with the hash of the content, ?v=..., never change
+    if request.query.get('v') == entry.version:
+      cache_control = http_cache.IMMUTABLE
+    else:
+      cache_control = http_cache.REVALIDATE
+    response.content_type = entry.content_type
+    return cached_body(entry.bodies[None], entry.etag, cache_control,
+                       entry.bodies)
 
 
 ################################################################################
 # Helpers
 ################################################################################
 
-def du(path):
-  """disk usage in human readable format (e.g. '2,1GB')"""
-  return subprocess.check_output(['du','-sh', path]).split()[0].decode('utf-8')
+def safe_asset_path(project_id, asset_name):
+  """Returns the path of an asset of a project, or None if it is outside."""
+  asset_name = os.path.normpath(asset_name.replace('\\', '/')).lstrip('/')
+  if not asset_name or asset_name == '.' or asset_name.startswith('..'):
+    return None
+  return os.path.join("projects", project_id, "assets", asset_name)
+
+
+class RequestBodyReader(object):
+  """File-like reader of the raw request body.
 
-class PostedFileWriter(object):
-  """Defines a resource to use on 'with' statements to clean up after upload."""
-  # not used
+  Unlike request.body, which Bottle spools to a temp file first, this reads
+  straight from the client, so the body is written once, where it goes.
+  """
   def __init__(self, request):
-    self.request = request
-  # not used
-  def __enter__(self):
-    self.temp_dir = tempfile.mkdtemp()
-    # ngFileUpload sends the content in the "file" parameter by default
-    input_file = request.files.get("file")
-    if input_file.filename:
-      file_name = input_file.filename
-      file_path = os.path.join(self.temp_dir, file_name)
-      buffer_size = 2**16  # 65k
-      with open(file_path, 'wb') as output_file:
-        buf = input_file.file.read(buffer_size)
-        while buf:
-          output_file.write(buf)
-          buf = input_file.file.read(buffer_size)
-        output_file.close()
-      return file_path
+    read = request.environ['wsgi.input'].read
+    # pylint: disable=protected-access
+    if request.chunked:
+      self.parts = request._iter_chunked(read, 2**16)
     else:
-      return None
-  # not used
-  def __exit__(self, type_, value, traceback_):
-    shutil.rmtree(self.temp_dir)
+      self.parts = request._iter_body(read, 2**16)
+    self.buffer = b''
+
+  def read(self, size=-1):
+    parts = [self.buffer]
+    length = len(self.buffer)
+    while size < 0 or length < size:
+      part = next(self.parts, None)
+      if part is None:
+        break
+      parts.append(part)
+      length += len(part)
+    data = b''.join(parts)
+    if size < 0:
+      size = length
+    data, self.buffer = data[:size], data[size:]
+    return data
+
+
+def ranged_body(size, etag, body_of):
+  """Returns a body of size bytes, or the part of it the Range asks for.
+
+  body_of(start, end) returns the bytes of the body from start to end, as
+  an iterable or a file object. A Range is honored as long as an If-Range
+  sent with it still matches the ETag; requests for several ranges get the
+  whole body.
+  """
+  etag = '"%s"' % etag
+  response.headers['Accept-Ranges'] = 'bytes'
+  response.headers['ETag'] = etag
+  if http_cache.etag_matches(request.environ.get('HTTP_IF_NONE_MATCH'),
+                             etag):
+    response.status = 304
+    return b''
+  start, end = 0, size
+  range_header = request.environ.get('HTTP_RANGE')
+  if_range = request.environ.get('HTTP_IF_RANGE')
+  if range_header and if_range in (None, etag):
+    ranges = list(parse_range_header(range_header, size))
+    if not ranges:
+      return HTTPResponse(status=416,
+                          headers={'Content-Range': 'bytes */%d' % size})
+    if len(ranges) == 1:
+      start, end = ranges[0]
+      response.status = 206
+      response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+          start, end - 1, size)
+  response.headers['Content-Length'] = str(end - start)
+  return body_of(start, end)
+
+
+def send_file(file_path, content_type=None, download=None):
+  """Returns a file, or the byte range of it the request asks for.
+
+  The body is a FileRange, which servers with wsgi.file_wrapper, like this
+  one, send with sendfile(). download is the file name to save it as.
+  """
+  try:
+    st = os.stat(file_path)
+  except OSError:
+    response.status = 404
+    return json.dumps({"msg": "File not found"})
+  response.content_type = (content_type or
+                           http_cache.content_type_of(file_path))
+  if download:
+    response.headers['Content-Disposition'] = (
+        'attachment; filename="%s"' % os.path.basename(download))
+  response.headers['Last-Modified'] = email.utils.formatdate(st.st_mtime,
+                                                             usegmt=True)
+  return ranged_body(st.st_size, '%x-%x' % (st.st_mtime_ns, st.st_size),
+                     lambda start, end: FileRange(file_path, start, end))
+
+
+class FileRange(object):
+  """File object reading a byte range of a file.
+
+  Servers that send files with sendfile() find the range from fileno(),
+  tell() and the Content-Length, or from start and remaining.
+  """
+  def __init__(self, file_path, start, end):
+    self.file = open(file_path, 'rb')
+    self.file.seek(start)
+    self.remaining = end - start
+
+  def read(self, size=-1):
+    if size < 0 or size > self.remaining:
+      size = self.remaining
+    data = self.file.read(size)
+    self.remaining -= len(data)
+    return data
+
+  def fileno(self):
+    return self.file.fileno()
+
+  def tell(self):
+    return self.file.tell()
+
+  def close(self):
+    self.file.close()
+
+
+def cached_body(body, etag, cache_control=http_cache.REVALIDATE,
+                bodies=None):
+  """Returns a body in the encoding the client prefers, or a 304.
+
+  bodies maps encodings to the body compressed in advance; without them,
+  text bodies are compressed here. etag is the hash of the uncompressed
+  body.
+  """
+  if bodies is None:
+    available = []
+    if http_cache.compressible(response.content_type, len(body)):
+      available = http_cache.ENCODINGS
+  else:
+    available = [encoding for encoding in bodies if encoding]
+  encoding = http_cache.negotiate(
+      request.environ.get('HTTP_ACCEPT_ENCODING'), available)
+  etag = http_cache.representation_etag(etag, encoding)
+  response.headers['ETag'] = etag
+  response.headers['Cache-Control'] = cache_control
+  if available:
+    response.headers['Vary'] = 'Accept-Encoding'
+  if http_cache.etag_matches(request.environ.get('HTTP_IF_NONE_MATCH'),
+                             etag):
+    response.status = 304
+    return b''
+  if encoding:
+    response.headers['Content-Encoding'] = encoding
+    body = (bodies[encoding] if bodies else
+            http_cache.compress(body, encoding))
+  return body
+
+
+class ZipStream(object):
+  """Unseekable file collecting what a ZipFile writes, to stream it."""
+  def __init__(self):
+    self.chunks = []
+    self.position = 0
+
+  def write(self, data):
+    self.chunks.append(bytes(data))
+    self.position += len(data)
+    return len(data)
+
+  def tell(self):
+    return self.position
+
+  def flush(self):
+    pass
+
+  def pop(self):
+    data = b''.join(self.chunks)
+    self.chunks = []
+    return data
+
+
+def iter_zip(files, buffer_size=2**16):
+  """Yields a zip of (name in the zip, file path) files as it is written.
+
+  Files are compressed one chunk at a time, so the download starts at once
+  and nothing but the current chunk is held in memory.
+  """
+  stream = ZipStream()
+  with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+    for name, file_path in files:
+      with open(file_path, 'rb') as f, zip_file.open(name, 'w') as member:
+        buf = f.read(buffer_size)
+        while buf:
+          member.write(buf)
+          data = stream.pop()
+          if data:
+            yield data
+          buf = f.read(buffer_size)
+  yield stream.pop()
+
+
+def iter_shards_zip(shards_dir):
+  """Yields the zip of the shards of an export, then removes them.
+
+  The shards are removed once the zip is sent, or the download stopped.
+  """
+  try:
+    files = [(os.path.basename(file_path), file_path)
+             for file_path in g_ads_editor.shard_files(shards_dir)]
+    for data in iter_zip(files):
+      yield data
+  finally:
+    g_ads_editor.remove_shards_dir(shards_dir)
+
+
+################################################################################
+# Serving
+################################################################################
+
+class SendfileHandler(ServerHandler):
+  """wsgiref handler sending FileRange bodies with socket.sendfile()."""
+
+  def sendfile(self):
+    filelike = self.result.filelike
+    if not isinstance(filelike, FileRange):
+      return False
+    if not self.headers_sent:
+      self.send_headers()
+    # zero copy where the OS has sendfile, plain sends elsewhere
+    sent = self.request_handler.connection.sendfile(
+        filelike.file, filelike.tell(), filelike.remaining)
+    filelike.remaining -= sent
+    self.bytes_sent += sent
+    return True
+
+
+class QuietHandler(WSGIRequestHandler):
+  """Request handler that logs client addresses without reverse DNS."""
+  def address_string(self):
+    return self.client_address[0]
+
+  def handle(self):
+    # WSGIRequestHandler.handle(), with the SendfileHandler
+    self.raw_requestline = self.rfile.readline(65537)
+    if len(self.raw_requestline) > 65536:
+      self.requestline = ''
+      self.request_version = ''
+      self.command = ''
+      self.send_error(414)
+      return
+    if not self.parse_request():
+      return
+    handler = SendfileHandler(
+        self.rfile, self.wfile, self.get_stderr(), self.get_environ(),
+        multithread=isinstance(self.server, ThreadPoolWSGIServer))
+    handler.request_handler = self
+    handler.run(self.server.get_app())
+
+
+class ThreadPoolWSGIServer(WSGIServer):
+  """wsgiref server that handles each request on a bounded thread pool."""
+  threads = 16
+  request_queue_size = 64
+
+  def process_request(self, request, client_address):
+    # the pool is created on the first request, so each forked worker owns one
+    if getattr(self, 'pool', None) is None:
+      self.pool = concurrent.futures.ThreadPoolExecutor(self.threads)
+    metrics.HTTP_QUEUED_REQUESTS.inc()
+    self.pool.submit(self.process_request_thread, request, client_address)
+
+  def process_request_thread(self, request, client_address):
+    metrics.HTTP_QUEUED_REQUESTS.dec()
+    try:
+      self.finish_request(request, client_address)
+    except Exception:  # pylint: disable=broad-except
+      self.handle_error(request, client_address)
+    finally:
+      self.shutdown_request(request)
+
+
+class PreforkWSGIServer(ThreadPoolWSGIServer):
+  """Threaded wsgiref server forking worker processes on a shared socket.
+
+  A request may reach any worker, so the state of the jobs a worker runs
+  must be found by the others: running and cancelled jobs are shared
+  through progress.JobMarker files, their progress through the state files
+  of the progress module, and a preview being played is found by its file.
+  Simultaneous renders of the same preview are only shared within a
+  worker, and /metrics reports the worker that answers.
+
+  The project sizes of disk_usage are also kept by each worker, which only
+  counts its own writes: the sizes listed by a worker miss what the others
+  wrote until its reconciler measures the projects again, within
+  disk_usage.RECONCILE_INTERVAL.
+  """
+  workers = 4
+
+  def serve_forever(self, poll_interval=0.5):
+    children = []
+    for _ in range(self.workers):
+      pid = os.fork()
+      if pid == 0:
+        try:
+          ThreadPoolWSGIServer.serve_forever(self, poll_interval)
+        finally:
+          os._exit(0)
+      children.append(pid)
+    # stops the workers along with the parent process
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+      for pid in children:
+        os.waitpid(pid, 0)
+    finally:
+      for pid in children:
+        try:
+          os.kill(pid, signal.SIGTERM)
+        except OSError:
+          pass
+
+
+def server_class_for(mode, threads, workers):
+  """Returns the wsgiref server class of a serving mode."""
+  if mode == 'wsgiref':
+    return WSGIServer
+  attrs = {'threads': threads, 'workers': workers}
+  if mode == 'workers':
+    return type('PreforkWSGIServer', (PreforkWSGIServer,), attrs)
+  return type('ThreadPoolWSGIServer', (ThreadPoolWSGIServer,), attrs)
+
+
+################################################################################
+# Metrics
+################################################################################
+
+@get('/metrics')
+def get_metrics():
+  """Metrics of this process, in the Prometheus text exposition format."""
+  response.headers['Content-Type'] = metrics.CONTENT_TYPE
+  return metrics.render()
+
+
+class MetricsPlugin(object):
+  """Bottle plugin timing the requests of each route."""
+  name = 'metrics'
+  api = 2
+
+  def apply(self, callback, route):
+    def wrapper(*args, **kwargs):
+      start = time.monotonic()
+      status = 500
+      try:
+        result = callback(*args, **kwargs)
+        if isinstance(result, HTTPResponse):
+          status = result.status_code
+        else:
+          status = response.status_code
+        return result
+      except HTTPResponse as e:
+        status = e.status_code
+        raise
+      finally:
+        metrics.HTTP_REQUEST_SECONDS.observe(
+            time.monotonic() - start, method=route.method, route=route.rule,
+            status=status)
+    return wrapper
+
+
+class CachingPlugin(object):
+  """Bottle plugin adding ETags and compression to buffered responses.
+
+  Streamed responses, like downloads and NDJSON, and responses that set
+  their own ETag are sent as they are.
+  """
+  name = 'caching'
+  api = 2
+
+  def apply(self, callback, route):
+    def wrapper(*args, **kwargs):
+      result = callback(*args, **kwargs)
+      if (request.method not in ('GET', 'HEAD') or
+          not isinstance(result, (str, bytes)) or
+          response.status_code != 200 or 'ETag' in response.headers):
+        return result
+      if isinstance(result, str):
+        result = result.encode(response.charset or 'utf-8')
+      return cached_body(result, http_cache.content_hash(result))
+    return wrapper
+
+
+def render_queue_depth():
+  with preview_jobs_lock:
+    previews = len(preview_jobs)
+  generations = sum(len(gen_ids)
+                    for gen_ids in list(vogon.running_gen_threads.values()))
+  return [({'queue': 'preview'}, previews),
+          ({'queue': 'video_generation'}, generations)]
+
+
+def youtube_metric(name, labelname=None):
+  """Returns a collect function of a counter of yt_retry.get_metrics()."""
+  def collect():
+    value = yt_retry.get_metrics()[name]
+    if labelname is None:
+      return [({}, value)]
+    return [({labelname: key}, v) for key, v in value.items()]
+  return collect
+
+
+metrics.CollectedMetric(
+    'vogon_render_queue_depth',
+    'Renders queued or running, by queue.',
+    'gauge', render_queue_depth, labelnames=('queue',))
+metrics.CollectedMetric(
+    'vogon_youtube_api_calls_total',
+    'YouTube API calls, by operation.',
+    'counter', youtube_metric('api_calls', 'operation'),
+    labelnames=('operation',))
+metrics.CollectedMetric(
+    'vogon_youtube_api_errors_total',
+    'Failed YouTube API calls, by the reason YouTube reported.',
+    'counter', youtube_metric('api_errors', 'reason'),
+    labelnames=('reason',))
+metrics.CollectedMetric(
+    'vogon_youtube_api_retries_total',
+    'Retried YouTube API calls.',
+    'counter', youtube_metric('api_retries'))
+metrics.CollectedMetric(
+    'vogon_youtube_breaker_trips_total',
+    'Times a YouTube API circuit breaker opened.',
+    'counter', youtube_metric('breaker_trips'))
+metrics.CollectedMetric(
+    'vogon_youtube_quota_units',
+    'YouTube quota units spent today, by OAuth client.',
+    'gauge', youtube_metric('quota_units', 'client'),
+    labelnames=('client',))
+metrics.CollectedMetric(
+    'vogon_youtube_breaker_open',
+    'Whether the YouTube API circuit breaker of an OAuth client is open.',
+    'gauge',
+    lambda: [({'client': client}, int(state == 'open'))
+             for client, state
+             in yt_retry.get_metrics()['breakers'].items()],
+    labelnames=('client',))
+
+install(CachingPlugin())
+install(MetricsPlugin())
 
 
 ################################################################################
@@ -403,8 +1181,30 @@ def main():
     parser.add_argument("--debug",
             help="Enable debug mode",
             action="store_true")
+    parser.add_argument("--server",
+            help="'threaded' serves requests on a thread pool, 'workers' "
+                 "forks worker processes, each with its own thread pool, "
+                 "sharing job state through files in the project folders "
+                 "(two workers may render the same preview at once, "
+                 "/metrics is per worker, and project sizes may miss the "
+                 "writes of other workers for 15 minutes), and 'wsgiref' "
+                 "serves one request at a time",
+            choices=['threaded', 'workers', 'wsgiref'],
+            default='threaded')
+    parser.add_argument("--threads",
+            help="Request threads per process",
+            type=int,
+            default=16)
+    parser.add_argument("--workers",
+            help="Worker processes, when serving with --server workers",
+            type=int,
+            default=4)
     args = parser.parse_args()
-    run(host='0.0.0.0', port=8080, debug=args.debug)
+    server_class = server_class_for(args.server, args.threads, args.workers)
+    # compresses the UI once, before forking any worker
+    static_files.load()
+    run(host='0.0.0.0', port=8080, debug=args.debug, server='wsgiref',
+        server_class=server_class, handler_class=QuietHandler)
 
 if __name__=='__main__':
     main()
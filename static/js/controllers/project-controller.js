@@ -42,6 +42,8 @@ app.controller('ProjectController',
     $scope.generate_all_variations = generateAllVariations;
     $scope.cancel_video_generation = cancelVideoGeneration;
     $scope.is_updating_video_generation = false;
+    $scope.video_generation_version = 0;
+    $scope.video_generation_wait_version = -1;
 
     // Assets
     $scope.assets = [];
@@ -76,6 +78,8 @@ app.controller('ProjectController',
     };
 
     $scope.is_updating_video_upload = false;
+    $scope.video_upload_version = 0;
+    $scope.video_upload_wait_version = -1;
     $scope.youtube_channel = undefined;
     $scope.video_upload = {
       current_state: "--"
@@ -122,7 +126,7 @@ app.controller('ProjectController',
         return;
       }*/
 
-      updateVideoUpload();
+      updateVideoUpload(true);
       YouTubeApi.startVideoUpload(
         $cookies.get('yt_access_token'),
         $cookies.get('yt_refresh_token'),
@@ -133,7 +137,7 @@ app.controller('ProjectController',
     }
 
     $scope.remove_uploaded_videos = function() {
-      updateVideoUpload();
+      updateVideoUpload(true);
       YouTubeApi.removeUploadedVideos(
         $cookies.get('yt_access_token'),
         $cookies.get('yt_refresh_token'),
@@ -256,7 +260,7 @@ app.controller('ProjectController',
     function generateAllVariations(){
       var uri = "/api/projects/" + $scope.project_id + "/generate_all_videos";
       $http.post(uri).then(function(data) {
-        updateVideoGeneration();
+        updateVideoGeneration(true);
       });
     }
 
@@ -267,43 +271,92 @@ app.controller('ProjectController',
       });
     }
 
-    function updateVideoGeneration(){
+    // Polling stops once the job is finished. A job just started by the
+    // user is waited for until it publishes a state newer than the one of
+    // the previous job, which is finished.
+    function updateVideoGeneration(new_job){
+      $scope.video_generation_wait_version =
+          new_job ? $scope.video_generation_version : -1;
       if($scope.is_updating_video_generation === false){
         $scope.is_updating_video_generation = true;
         __loopUpdateVideoGeneration();
       }
     }
 
-    function updateVideoUpload(){
+    function updateVideoUpload(new_job){
+      $scope.video_upload_wait_version =
+          new_job ? $scope.video_upload_version : -1;
       if($scope.is_updating_video_upload === false){
         $scope.is_updating_video_upload = true;
         setTimeout(__loopUpdateVideoUpload, 1000);
       }
     }
 
+    $scope.$on('$destroy', function() {
+      $scope.is_updating_video_generation = false;
+      $scope.is_updating_video_upload = false;
+    });
+
+    // The progress endpoint answers as soon as the job publishes a newer
+    // state, so an answer with a newer version immediately starts the next
+    // request. Servers which do not wait answer at once with the same
+    // version, and are asked again a second later.
     function __loopUpdateVideoUpload(){
       var scope = $scope;
       if(scope.is_updating_video_upload){
-        if(!scope.tabs["youtube_conf_tab"]){
-          var uri = "/api/youtube/read_log/" + scope.project_id;
-          $http.get(uri).then(function(data) {
-            scope.video_upload.current_state = data.data;
-          });
+        if(scope.tabs["youtube_conf_tab"]){
+          setTimeout(__loopUpdateVideoUpload, 1000);
+          return;
         }
-        setTimeout(__loopUpdateVideoUpload, 5000);
+        var uri = "/api/projects/" + scope.project_id + "/progress/youtube" +
+                  "?since=" + scope.video_upload_version;
+        $http.get(uri).then(function(data) {
+          var advanced = data.data.version > scope.video_upload_version;
+          scope.video_upload_version = data.data.version;
+          scope.video_upload.current_state = data.data.current_state;
+          if(data.data.finished &&
+             data.data.version > scope.video_upload_wait_version){
+            scope.is_updating_video_upload = false;
+            return;
+          }
+          if(advanced){
+            __loopUpdateVideoUpload();
+          } else {
+            setTimeout(__loopUpdateVideoUpload, 1000);
+          }
+        }, function() {
+          setTimeout(__loopUpdateVideoUpload, 5000);
+        });
       }
     }
 
     function __loopUpdateVideoGeneration(){
       var scope = $scope;
       if(scope.is_updating_video_generation){
-        if(!scope.tabs['video_conf_tab']){
-          var uri = "/api/projects/" + scope.project_id + "/update_on_video_generation";
-          $http.get(uri).then(function(data) {
-            scope.video_generation = data.data;
-          });
+        if(scope.tabs['video_conf_tab']){
+          setTimeout(__loopUpdateVideoGeneration, 1000);
+          return;
         }
-        setTimeout(__loopUpdateVideoGeneration, 5000);
+        var uri = "/api/projects/" + scope.project_id +
+                  "/progress/video_generation?since=" +
+                  scope.video_generation_version;
+        $http.get(uri).then(function(data) {
+          var advanced = data.data.version > scope.video_generation_version;
+          scope.video_generation_version = data.data.version;
+          scope.video_generation = data.data;
+          if(data.data.finished &&
+             data.data.version > scope.video_generation_wait_version){
+            scope.is_updating_video_generation = false;
+            return;
+          }
+          if(advanced){
+            __loopUpdateVideoGeneration();
+          } else {
+            setTimeout(__loopUpdateVideoGeneration, 1000);
+          }
+        }, function() {
+          setTimeout(__loopUpdateVideoGeneration, 5000);
+        });
       }
     }
 
@@ -437,6 +490,9 @@ app.controller('ProjectController',
             'path': assets[i],
             'icon': get_icon(assets[i])
           }
+          if (asset.icon == 'photo' || asset.icon == 'videocam')
+            asset.thumbnail = $scope.project_url + 'thumbnails/?asset_path=' +
+                encodeURIComponent(assets[i]);
           $scope.assets.push(asset);
           if(asset.icon == "photo")
             $scope.image_assets.push(asset.name)
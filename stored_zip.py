@@ -0,0 +1,239 @@
+# vim: set fileencoding=utf-8 :
+
+# Copyright 2019 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Zip archives of files, streamed without compression from any offset.
+
+Members are stored, not compressed, and their CRCs are written after their
+data, in data descriptors, so the position of every byte of the archive is
+known from the names and sizes of the files alone. An archive has a size
+before anything is read, and any range of it can be streamed, which lets
+HTTP downloads of it be resumed. Videos do not compress anyway.
+
+CRCs are computed while members are streamed, and kept, so only a download
+resumed in a new process reads the files before the resumed range again.
+Archives and members of 4 GB or more are written as Zip64.
+"""
+
+import hashlib
+import os
+import struct
+import threading
+import time
+import zlib
+
+BUFFER_SIZE = 2**16
+ZIP64_LIMIT = 0xFFFFFFFF
+# what 4 byte sizes and offsets are set to when in the Zip64 extra field
+IN_ZIP64 = 0xFFFFFFFF
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+DESCRIPTOR = struct.Struct('<IIII')
+DESCRIPTOR64 = struct.Struct('<IIQQ')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+END_RECORD = struct.Struct('<IHHHHIIH')
+END_RECORD64 = struct.Struct('<IQHHIIQQQQ')
+END_LOCATOR64 = struct.Struct('<IIQI')
+
+# CRCs on the data descriptor, UTF-8 names
+FLAGS = 0x08 | 0x800
+VERSION = 20
+VERSION64 = 45
+# made by: unix, so the external attributes are file modes
+MADE_BY = (3 << 8) | VERSION64
+FILE_MODE = 0o100644
+
+# CRCs of the files streamed, by (path, size, mtime)
+crcs = {}
+crcs_lock = threading.Lock()
+
+
+class Member(object):
+  """A file of the archive, and where its parts start."""
+
+  def __init__(self, name, path):
+    st = os.stat(path)
+    self.name = name.encode('utf-8')
+    self.path = path
+    self.size = st.st_size
+    self.mtime = st.st_mtime
+    self.key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    self.zip64 = self.size >= ZIP64_LIMIT
+    self.offset = None
+
+  def dos_time(self):
+    t = time.localtime(self.mtime)
+    if t.tm_year < 1980:
+      t = time.localtime(time.mktime((1980, 1, 1, 0, 0, 0, 0, 0, -1)))
+    return (t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2,
+            (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday)
+
+  def local_header(self):
+    extra = b''
+    size = self.size
+    if self.zip64:
+      extra = struct.pack('<HHQQ', 1, 16, self.size, self.size)
+      size = IN_ZIP64
+    mod_time, mod_date = self.dos_time()
+    return LOCAL_HEADER.pack(
+        0x04034b50, VERSION64 if self.zip64 else VERSION, FLAGS, 0,
+        mod_time, mod_date, 0, size, size, len(self.name),
+        len(extra)) + self.name + extra
+
+  def descriptor(self, crc):
+    if self.zip64:
+      return DESCRIPTOR64.pack(0x08074b50, crc, self.size, self.size)
+    return DESCRIPTOR.pack(0x08074b50, crc, self.size, self.size)
+
+  def descriptor_size(self):
+    return (DESCRIPTOR64 if self.zip64 else DESCRIPTOR).size
+
+  def central_header(self, crc):
+    fields = []
+    size = self.size
+    offset = self.offset
+    if self.zip64:
+      fields += [self.size, self.size]
+      size = IN_ZIP64
+    if self.offset >= ZIP64_LIMIT:
+      fields.append(self.offset)
+      offset = IN_ZIP64
+    extra = b''
+    if fields:
+      extra = struct.pack('<HH%dQ' % len(fields), 1, 8 * len(fields),
+                          *fields)
+    mod_time, mod_date = self.dos_time()
+    return CENTRAL_HEADER.pack(
+        0x02014b50, MADE_BY, VERSION64 if fields else VERSION, FLAGS, 0,
+        mod_time, mod_date, crc, size, size, len(self.name), len(extra), 0,
+        0, 0, FILE_MODE << 16, offset) + self.name + extra
+
+  def central_header_size(self):
+    fields = (2 if self.zip64 else 0) + (self.offset >= ZIP64_LIMIT)
+    return CENTRAL_HEADER.size + len(self.name) + (4 + 8 * fields
+                                                   if fields else 0)
+
+  def crc(self):
+    """Returns the CRC of the file, reading it unless it is known."""
+    with crcs_lock:
+      crc = crcs.get(self.key)
+    if crc is None:
+      crc = 0
+      for data in self.read(0, self.size):
+        crc = zlib.crc32(data, crc)
+      with crcs_lock:
+        crcs[self.key] = crc
+    return crc
+
+  def read(self, start, end):
+    """Yields the bytes of the file from start to end."""
+    with open(self.path, 'rb') as f:
+      f.seek(start)
+      position = start
+      while position < end:
+        data = f.read(min(BUFFER_SIZE, end - position))
+        if not data:
+          raise IOError('%s was truncated while zipping it' % self.path)
+        position += len(data)
+        yield data
+
+
+class StoredZip(object):
+  """A zip archive of (name in the zip, file path) files.
+
+  The files are listed when the archive is created, and must not change
+  while it is streamed.
+  """
+
+  def __init__(self, files):
+    self.members = [Member(name, path) for name, path in files]
+    # (start, size, kind, member) of each part of the archive
+    self.parts = []
+    position = 0
+    for member in self.members:
+      member.offset = position
+      header = len(member.local_header())
+      self.parts.append((position, header, 'header', member))
+      self.parts.append((position + header, member.size, 'data', member))
+      position += header + member.size
+      self.parts.append((position, member.descriptor_size(), 'descriptor',
+                         member))
+      position += member.descriptor_size()
+    self.directory_offset = position
+    for member in self.members:
+      self.parts.append((position, member.central_header_size(), 'central',
+                         member))
+      position += member.central_header_size()
+    self.directory_size = position - self.directory_offset
+    end = len(self.end_records())
+    self.parts.append((position, end, 'end', None))
+    self.size = position + end
+
+  @property
+  def etag(self):
+    """Changes whenever the bytes of the archive would."""
+    sha = hashlib.sha1()
+    for member in self.members:
+      sha.update(repr((member.name, member.key)).encode('utf-8'))
+    return sha.hexdigest()
+
+  def end_records(self):
+    count = len(self.members)
+    records = b''
+    if (count >= 0xFFFF or self.directory_size >= ZIP64_LIMIT or
+        self.directory_offset >= ZIP64_LIMIT):
+      end64_offset = self.directory_offset + self.directory_size
+      records = END_RECORD64.pack(
+          0x06064b50, END_RECORD64.size - 12, MADE_BY, VERSION64, 0, 0,
+          count, count, self.directory_size, self.directory_offset)
+      records += END_LOCATOR64.pack(0x07064b50, 0, end64_offset, 1)
+    return records + END_RECORD.pack(
+        0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+        self.directory_size if not records else IN_ZIP64,
+        self.directory_offset if not records else IN_ZIP64, 0)
+
+  def iter_bytes(self, start=0, end=None):
+    """Yields the bytes of the archive from start to end, not included."""
+    end = self.size if end is None else end
+    for part_start, size, kind, member in self.parts:
+      part_end = part_start + size
+      if part_end <= start or size == 0:
+        continue
+      if part_start >= end:
+        break
+      offset = max(start, part_start) - part_start
+      stop = min(end, part_end) - part_start
+      if kind == 'data':
+        if offset == 0 and stop == size:
+          # the whole member is streamed, so its CRC comes for free
+          crc = 0
+          for data in member.read(0, size):
+            crc = zlib.crc32(data, crc)
+            yield data
+          with crcs_lock:
+            crcs[member.key] = crc
+        else:
+          for data in member.read(offset, stop):
+            yield data
+        continue
+      if kind == 'header':
+        data = member.local_header()
+      elif kind == 'descriptor':
+        data = member.descriptor(member.crc())
+      elif kind == 'central':
+        data = member.central_header(member.crc())
+      else:
+        data = self.end_records()
+      yield data[offset:stop]
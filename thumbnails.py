@@ -0,0 +1,239 @@
+# vim: set fileencoding=utf-8 :
+
+# Copyright 2019 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Thumbnails of the image and video assets of projects.
+
+Thumbnails are made by ffmpeg, on a pool of THUMBNAIL_WORKERS threads:
+images and GIFs are scaled down, and videos give a poster frame, taken
+POSTER_TIME seconds in, or the first frame of shorter videos. Simultaneous
+requests for the same thumbnail share its job.
+
+Thumbnails are named after the sha256 of their asset, from asset_store, and
+their size, so an asset shared by projects has one thumbnail, and a changed
+asset gets a new name: a name can be cached by browsers for good. They are
+kept in projects/.thumbnails, which is bounded to MAX_CACHE_BYTES by
+deleting the thumbnails used least recently.
+"""
+
+import collections
+import concurrent.futures
+import os
+import re
+import subprocess
+import tempfile
+import threading
+
+import asset_store
+
+CACHE_DIR = os.path.join('projects', '.thumbnails')
+MAX_CACHE_BYTES = 256 * 2**20
+THUMBNAIL_WORKERS = 2
+# the longest side of a thumbnail, in pixels
+SIZE = 320
+POSTER_TIME = 1
+FFMPEG_TIMEOUT = 120
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.flv', '.avi', '.mkv', '.m4v', '.webm')
+# images which may be transparent keep it in PNG thumbnails
+TRANSPARENT_EXTENSIONS = ('.png', '.gif', '.webp')
+NAME_PATTERN = re.compile(r'^[0-9a-f]{64}_\d+\.(jpg|png)$')
+
+
+class ThumbnailError(Exception):
+  """ffmpeg could not make the thumbnail of an asset."""
+
+
+def kind_of(asset_path):
+  """Returns 'image', 'video' or None for assets without thumbnails."""
+  extension = os.path.splitext(asset_path)[1].lower()
+  if extension in IMAGE_EXTENSIONS:
+    return 'image'
+  if extension in VIDEO_EXTENSIONS:
+    return 'video'
+  return None
+
+
+def thumbnail_name(digest, asset_path, size=SIZE):
+  extension = os.path.splitext(asset_path)[1].lower()
+  return '%s_%d.%s' % (digest, size, 'png' if extension in
+                       TRANSPARENT_EXTENSIONS else 'jpg')
+
+
+class ThumbnailCache(object):
+  """Thumbnail files, deleted least recently used first over max_bytes.
+
+  Use is tracked in memory and in the mtimes of the files, so a restarted
+  server knows which thumbnails were used last.
+  """
+
+  def __init__(self, directory=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.lock = threading.Lock()
+    self.sizes = None  # name -> bytes, the least recently used first
+    self.total = 0
+
+  def path(self, name):
+    return os.path.join(self.directory, name[:2], name)
+
+  def load(self):
+    found = []
+    for root, dirnames, filenames in os.walk(self.directory):
+      for filename in filenames:
+        if not NAME_PATTERN.match(filename):
+          continue
+        try:
+          st = os.stat(os.path.join(root, filename))
+        except OSError:
+          continue
+        found.append((st.st_mtime, filename, st.st_size))
+    self.sizes = collections.OrderedDict(
+        (name, size) for _, name, size in sorted(found))
+    self.total = sum(self.sizes.values())
+
+  def get(self, name):
+    """Returns the path of a cached thumbnail, marking it used, or None."""
+    path = self.path(name)
+    with self.lock:
+      if self.sizes is None:
+        self.load()
+      if name in self.sizes:
+        self.sizes.move_to_end(name)
+      else:
+        # thumbnails made by other processes are only on disk
+        try:
+          size = os.path.getsize(path)
+        except OSError:
+          return None
+        self.sizes[name] = size
+        self.total += size
+    try:
+      os.utime(path)
+    except OSError:
+      with self.lock:
+        self.forget(name)
+      return None
+    return path
+
+  def add(self, name, temp_path):
+    """Moves a new thumbnail into the cache, making room for it."""
+    path = self.path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    size = os.path.getsize(temp_path)
+    os.replace(temp_path, path)
+    with self.lock:
+      if self.sizes is None:
+        self.load()
+      self.forget(name)
+      self.sizes[name] = size
+      self.total += size
+      while self.total > self.max_bytes and len(self.sizes) > 1:
+        old_name = next(iter(self.sizes))
+        self.forget(old_name)
+        try:
+          os.unlink(self.path(old_name))
+        except OSError:
+          pass
+    return path
+
+  def forget(self, name):
+    """Drops a thumbnail from the accounting. Must hold self.lock."""
+    self.total -= self.sizes.pop(name, 0)
+
+
+cache = ThumbnailCache()
+executor = concurrent.futures.ThreadPoolExecutor(THUMBNAIL_WORKERS)
+jobs = {}  # thumbnail name -> future of its path
+jobs_lock = threading.Lock()
+
+
+def thumbnail(asset_path, ffmpeg='ffmpeg'):
+  """Returns the name of the thumbnail of an asset, making it if needed.
+
+  Returns None for assets that are not images or videos. Raises
+  ThumbnailError if ffmpeg fails.
+  """
+  kind = kind_of(asset_path)
+  if kind is None:
+    return None
+  name = thumbnail_name(asset_store.asset_digest(asset_path), asset_path)
+  if cache.get(name):
+    return name
+  with jobs_lock:
+    job = jobs.get(name)
+    if job is None:
+      job = executor.submit(make_thumbnail, asset_path, kind, name, ffmpeg)
+      jobs[name] = job
+      job.add_done_callback(lambda _: forget_job(name))
+  job.result()
+  return name
+
+
+def forget_job(name):
+  with jobs_lock:
+    jobs.pop(name, None)
+
+
+def make_thumbnail(asset_path, kind, name, ffmpeg):
+  # the asset may be thumbnailed by another job, or process, already
+  if cache.get(name):
+    return cache.path(name)
+  os.makedirs(cache.directory, exist_ok=True)
+  fd, temp_path = tempfile.mkstemp(prefix='.thumbnail_',
+                                   suffix=os.path.splitext(name)[1],
+                                   dir=cache.directory)
+  os.close(fd)
+  try:
+    if kind == 'video':
+      # videos shorter than POSTER_TIME give no frame at it
+      if not run_ffmpeg(ffmpeg, asset_path, temp_path, POSTER_TIME):
+        run_ffmpeg(ffmpeg, asset_path, temp_path, None, check=True)
+    else:
+      run_ffmpeg(ffmpeg, asset_path, temp_path, None, check=True)
+    return cache.add(name, temp_path)
+  finally:
+    if os.path.exists(temp_path):
+      os.unlink(temp_path)
+
+
+def run_ffmpeg(ffmpeg, input_path, output_path, seek, check=False):
+  """Writes the first frame of input_path, after seek seconds, scaled down.
+
+  Returns whether a frame was written; raises ThumbnailError if none was
+  and check is true.
+  """
+  args = [ffmpeg, '-nostdin', '-v', 'error', '-y']
+  if seek:
+    args += ['-ss', str(seek)]
+  args += [
+      '-i', input_path, '-frames:v', '1', '-an',
+      # fits in SIZE x SIZE, never scaled up
+      '-vf', "scale='min(iw,%d)':'min(ih,%d)':"
+             "force_original_aspect_ratio=decrease" % (SIZE, SIZE),
+      '-q:v', '4', output_path
+  ]
+  try:
+    result = subprocess.run(args, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, timeout=FFMPEG_TIMEOUT)
+    error = result.stderr.decode('utf-8', 'replace').strip()
+    written = result.returncode == 0 and os.path.getsize(output_path) > 0
+  except (OSError, subprocess.TimeoutExpired) as e:
+    error = '%s' % e
+    written = False
+  if not written and check:
+    raise ThumbnailError('No thumbnail of %s: %s' % (input_path, error))
+  return written
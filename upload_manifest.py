@@ -0,0 +1,269 @@
+# vim: set fileencoding=utf-8 :
+
+# Copyright 2019 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Durable manifest of the videos uploaded to YouTube for a project.
+
+Every upload is recorded in a SQLite database under the project's youtube
+folder, keyed by feed row, channel and the hash of the rendered output file.
+This lets a new upload run skip videos that were already uploaded to the same
+channel, and lets the Ads Editor CSV look up video IDs without parsing the
+upload text files.
+"""
+
+import datetime
+import glob
+import hashlib
+import os
+import sqlite3
+import urllib.parse
+
+MANIFEST_FILE = 'uploads.sqlite3'
+
+STATUS_UPLOADED = 'uploaded'
+STATUS_REMOVED = 'removed'
+
+REMOVAL_REMOVED = 'removed'
+REMOVAL_NOT_FOUND = 'not_found'
+REMOVAL_FAILED = 'failed'
+
+HASH_BUFFER_SIZE = 2**20  # 1MB
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  row_number INTEGER NOT NULL,
+  filename TEXT NOT NULL,
+  output_hash TEXT,
+  channel_id TEXT NOT NULL,
+  video_id TEXT NOT NULL,
+  status TEXT NOT NULL,
+  gen_id TEXT,
+  updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS uploads_by_hash
+  ON uploads (channel_id, output_hash, status);
+DROP INDEX IF EXISTS uploads_by_row;
+CREATE INDEX IF NOT EXISTS uploads_by_channel_row
+  ON uploads (channel_id, row_number, status, id);
+CREATE INDEX IF NOT EXISTS uploads_by_video
+  ON uploads (channel_id, video_id);
+CREATE TABLE IF NOT EXISTS removals (
+  channel_id TEXT NOT NULL,
+  video_id TEXT NOT NULL,
+  outcome TEXT NOT NULL,
+  detail TEXT,
+  gen_id TEXT,
+  updated_at TEXT NOT NULL,
+  PRIMARY KEY (channel_id, video_id)
+);
+"""
+
+
+def manifest_path(project_id):
+  return os.path.join('projects', project_id, 'youtube', MANIFEST_FILE)
+
+
+def file_hash(file_path):
+  """Returns the sha256 hex digest of a file, read in 1MB chunks."""
+  digest = hashlib.sha256()
+  with open(file_path, 'rb') as f:
+    buf = f.read(HASH_BUFFER_SIZE)
+    while buf:
+      digest.update(buf)
+      buf = f.read(HASH_BUFFER_SIZE)
+    f.close()
+  return digest.hexdigest()
+
+
+def row_number_from_filename(filename):
+  """Extracts the feed row from names like 'output_video_row_12.mp4'."""
+  row_number = filename.replace('output_video_row_', '').replace('.mp4', '')
+  try:
+    return int(row_number)
+  except ValueError:
+    return None
+
+
+def legacy_files(youtube_dir):
+  """Returns the upload text files of previous versions, oldest first."""
+  return sorted(glob.glob(os.path.join(youtube_dir, '*.txt')),
+                key=os.path.getctime)
+
+
+class UploadManifest(object):
+  """Upload records of a project, usable on 'with' statements.
+
+  A manifest holds its own SQLite connection, so each thread should open its
+  own instance.
+  """
+
+  def __init__(self, project_id, read_only=False):
+    """Opens the manifest of a project, creating it unless read_only.
+
+    A read_only manifest that does not exist yet is loaded in memory from
+    the legacy upload files, see open_existing.
+    """
+    self.project_id = project_id
+    self.db_path = manifest_path(project_id)
+    if read_only and not os.path.exists(self.db_path):
+      self.conn = sqlite3.connect(':memory:')
+      self.conn.executescript(SCHEMA)
+      self.import_legacy_files()
+      return
+    if read_only:
+      self.conn = sqlite3.connect(
+          'file:%s?mode=ro' % urllib.parse.quote(os.path.abspath(
+              self.db_path)), timeout=30, uri=True)
+      return
+    dir_path = os.path.dirname(self.db_path)
+    if not os.path.exists(dir_path):
+      os.makedirs(dir_path)
+    is_new = not os.path.exists(self.db_path)
+    self.conn = sqlite3.connect(self.db_path, timeout=30)
+    self.conn.executescript(SCHEMA)
+    if is_new:
+      self.import_legacy_files()
+
+  @classmethod
+  def open_existing(cls, project_id):
+    """Returns the manifest of a project opened read-only, or None.
+
+    Reads have no side effects: a project that never uploaded has no
+    manifest, and legacy upload files are imported by the next upload run.
+    Until then, they are read into a manifest kept in memory.
+    """
+    if (not os.path.exists(manifest_path(project_id)) and
+        not legacy_files(os.path.dirname(manifest_path(project_id)))):
+      return None
+    return cls(project_id, read_only=True)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type_, value, traceback_):
+    self.close()
+
+  def close(self):
+    self.conn.close()
+
+  def import_legacy_files(self):
+    """Loads the '<channel_id>_<gen_id>.txt' files of previous versions."""
+    for file_path in legacy_files(os.path.dirname(self.db_path)):
+      name = os.path.basename(file_path)[:-4]
+      # gen_id looks like 2019-11-07_10-30-00, so the channel is what is
+      # left before its two last underscore separated parts.
+      name_parts = name.rsplit('_', 2)
+      if len(name_parts) != 3:
+        continue
+      channel_id = name_parts[0]
+      gen_id = '_'.join(name_parts[1:])
+      with open(file_path, 'r') as f:
+        lines = f.readlines()
+        f.close()
+      for line in lines:
+        if len(line.split(',')) != 2:
+          continue
+        filename, video_id = [v.strip() for v in line.split(',')]
+        row_number = row_number_from_filename(filename)
+        if row_number is None or not video_id:
+          continue
+        self._insert(row_number, filename, None, channel_id, video_id,
+                     STATUS_UPLOADED, gen_id)
+    self.conn.commit()
+
+  def _insert(self, row_number, filename, output_hash, channel_id, video_id,
+              status, gen_id):
+    self.conn.execute(
+        'INSERT INTO uploads (row_number, filename, output_hash, channel_id, '
+        'video_id, status, gen_id, updated_at) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (row_number, filename, output_hash, channel_id, video_id, status,
+         gen_id, datetime.datetime.now().isoformat()))
+
+  def record_upload(self, row_number, filename, output_hash, channel_id,
+                    video_id, gen_id):
+    """Records that the output of a row is available as a YouTube video."""
+    self._insert(row_number, filename, output_hash, channel_id, video_id,
+                 STATUS_UPLOADED, gen_id)
+    self.conn.commit()
+
+  def find_uploaded_video(self, channel_id, output_hash):
+    """Returns the video ID of an output already uploaded to the channel."""
+    cursor = self.conn.execute(
+        'SELECT video_id FROM uploads '
+        'WHERE channel_id = ? AND output_hash = ? AND status = ? '
+        'ORDER BY id DESC LIMIT 1',
+        (channel_id, output_hash, STATUS_UPLOADED))
+    found = cursor.fetchone()
+    return found[0] if found else None
+
+  def video_id_for_row(self, channel_id, row_number):
+    """Returns the latest video ID of a feed row on a channel, or None."""
+    cursor = self.conn.execute(
+        'SELECT video_id FROM uploads '
+        'WHERE channel_id = ? AND row_number = ? AND status = ? '
+        'ORDER BY id DESC LIMIT 1',
+        (channel_id, row_number, STATUS_UPLOADED))
+    found = cursor.fetchone()
+    return found[0] if found else None
+
+  def last_channel(self):
+    """Returns the channel of the latest upload still uploaded, or None."""
+    cursor = self.conn.execute(
+        'SELECT channel_id FROM uploads WHERE status = ? '
+        'ORDER BY id DESC LIMIT 1', (STATUS_UPLOADED,))
+    found = cursor.fetchone()
+    return found[0] if found else None
+
+  def uploaded_video_ids(self, channel_id):
+    """Returns the distinct video IDs still uploaded to a channel."""
+    cursor = self.conn.execute(
+        'SELECT DISTINCT video_id FROM uploads '
+        'WHERE channel_id = ? AND status = ? ORDER BY video_id',
+        (channel_id, STATUS_UPLOADED))
+    return [r[0] for r in cursor.fetchall()]
+
+  def mark_removed(self, channel_id, video_id):
+    """Flags every record of a video as removed from the channel."""
+    self.conn.execute(
+        'UPDATE uploads SET status = ?, updated_at = ? '
+        'WHERE channel_id = ? AND video_id = ?',
+        (STATUS_REMOVED, datetime.datetime.now().isoformat(), channel_id,
+         video_id))
+    self.conn.commit()
+
+  def record_removal(self, channel_id, video_id, outcome, gen_id, detail=''):
+    """Records the outcome of removing a video from the channel.
+
+    Removed and not found videos are flagged as removed, while failed ones
+    stay uploaded so the next removal run retries only them.
+    """
+    self.conn.execute(
+        'INSERT OR REPLACE INTO removals (channel_id, video_id, outcome, '
+        'detail, gen_id, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+        (channel_id, video_id, outcome, detail, gen_id,
+         datetime.datetime.now().isoformat()))
+    if outcome == REMOVAL_FAILED:
+      self.conn.commit()
+    else:
+      self.mark_removed(channel_id, video_id)
+
+  def removal_outcomes(self, channel_id):
+    """Returns a dict of video ID to the outcome of its last removal."""
+    cursor = self.conn.execute(
+        'SELECT video_id, outcome FROM removals WHERE channel_id = ?',
+        (channel_id,))
+    return dict(cursor.fetchall())
@@ -48,45 +48,56 @@ import time
 from oauth2client.tools import argparser
 from apiclient.errors import HttpError
 
+import disk_usage
+import font_index
+import job_events
+import progress
+import render_graph
+
 program_dir = os.path.abspath(os.path.dirname(__file__))
-stop_gen_threads = {}
+# gen_ids of the generations running in this process, by project
 running_gen_threads = {}
 
 def stop_video_generation(project_dir):
-  global stop_gen_threads, running_gen_threads
+  """Stops the video generations of a project and waits for them to end.
+
+  Generations run by other server processes are stopped too, see
+  progress.JobMarker.
+  """
   print("cancelling video generation for %s"%project_dir)
-  stop_gen_threads[project_dir] = True
-  while True:
-    if project_dir not in running_gen_threads or \
-       len(running_gen_threads[project_dir]) == 0:
-      stop_gen_threads[project_dir] = False
-      print("cancelled video generation for %s"%project_dir)
-      break
-    else:
+  with progress.JobMarker(project_dir, progress.STOPPING,
+                          progress.VIDEO_GENERATION):
+    while progress.is_running(project_dir, progress.VIDEO_GENERATION):
       time.sleep(1)
+  print("cancelled video generation for %s"%project_dir)
+
+def started_at_from_gen_id(gen_id):
+  """Turns a gen_id like 2019-11-07_10-30-00 into 2019-11-07 10:30:00."""
+  return gen_id.split("_")[0] + " " + gen_id.split("_")[1].replace("-", ":")
 
 def get_video_generation_percent(project_dir):
-  global stop_gen_threads, running_gen_threads
+  state = progress.latest(project_dir, progress.VIDEO_GENERATION)
+  if state is not None:
+    return state['started_at'], state['current_state']
+
+  # jobs from before the server started are only found in their logs
   logs_dir = os.path.join("projects", project_dir, "logs")
   try:
     logs = list(os.listdir(logs_dir))
   except Exception as e:
     logs = []
-  for log in logs:
-    if log[-4:] != ".log" or log[:17] != "video_generation_":
-      logs.remove(log)
+  logs = [log for log in logs
+          if log[-4:] == ".log" and log[:17] == "video_generation_"]
   if len(logs):
     latest_log = sorted(logs)[-1]
-    name = latest_log[17:-4]
-    name = name.split("_")[0] + " " + name.split("_")[1].replace("-", ":")
-    percent = subprocess.check_output(['tail', '-1',
-                                        os.path.join(logs_dir, latest_log)])
+    name = started_at_from_gen_id(latest_log[17:-4])
+    percent = progress.last_line(os.path.join(logs_dir, latest_log))
     return name, percent
   else:
     return "--", "--"
 
 def generate_all_video_variations(project_dir):
-  global stop_gen_threads, running_gen_threads
+  global running_gen_threads
   gen_id = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 
 
@@ -95,12 +106,21 @@ def generate_all_video_variations(project_dir):
   if not os.path.isdir(logs_uri):
     os.mkdir(logs_uri)
   current_log_uri = os.path.join(logs_uri, "video_generation_%s.log" % gen_id)
-  def logv(msg, log_type='a'):
-    with open(current_log_uri, log_type) as log_file:
-      if log_type == "a":
-        log_file.write("\n")
-      log_file.write("%s - %s!" % (msg,datetime.datetime.now()))
-      log_file.close()
+  log_file = open(current_log_uri, 'w')
+  def logv(msg):
+    line = "%s - %s!" % (msg,datetime.datetime.now())
+    if log_file.tell():
+      log_file.write("\n")
+    log_file.write(line)
+    log_file.flush()
+    progress.publish(project_dir, progress.VIDEO_GENERATION,
+                     started_at_from_gen_id(gen_id), line.split("\n")[-1])
+  running = progress.JobMarker(project_dir, progress.RUNNING,
+                               progress.VIDEO_GENERATION)
+  # one JSON object per line, with the stage durations of each row
+  events = job_events.JobEventLog(
+      os.path.join(logs_uri, "video_generation_%s.jsonl" % gen_id),
+      project_id=project_dir, gen_id=gen_id)
 
 
   try:
@@ -116,35 +136,70 @@ def generate_all_video_variations(project_dir):
 
     # clears generated videos
     output_uri = os.path.join("projects", project_dir, "output")
-    shutil.rmtree(output_uri)
-    os.mkdir(output_uri)
+    with disk_usage.tracking(output_uri):
+      shutil.rmtree(output_uri)
+      os.mkdir(output_uri)
 
     # handle video generation threads
-    logv("[STARTED]", log_type="w")
     stop_video_generation(project_dir)
 
-    # adds thread as runnig for project
+    # adds thread as runnig for project, seen by every server process
+    running.acquire()
+    logv("[STARTED]")
+    events.write('job_started', rows=int(total_lines))
     if project_dir not in running_gen_threads:
       running_gen_threads[project_dir] = [gen_id]
     else:
       running_gen_threads[project_dir].append(gen_id)
 
     # creates videos
+    estimator = progress.EtaEstimator(int(total_lines))
     for i, row in lines:
-      if project_dir in stop_gen_threads and stop_gen_threads[project_dir]:
+      if progress.stop_requested(project_dir, progress.VIDEO_GENERATION):
         raise Exception("Receive request to cancel video generation.")
-      video = generate_video(config, row, (i + 1), project_dir)
-
-      msg = "[RUNNIG] \n %s of %s (%.1f%%)"
-      logv(msg % (i , total_lines, (100*i/total_lines)))
+      row_start = time.monotonic()
+      def publish_row_progress(fraction, block, i=i, row_start=row_start):
+        # published on every ffmpeg progress block, but only logged per row
+        eta = estimator.eta(i, fraction, time.monotonic() - row_start)
+        percent = 100 * (i + fraction) / total_lines
+        progress.publish(
+            project_dir, progress.VIDEO_GENERATION,
+            started_at_from_gen_id(gen_id),
+            "[RUNNIG] row %s of %s at %.1f%% (%.1f%%), ETA %s" % (
+                i + 1, int(total_lines), 100 * fraction, percent,
+                progress.format_eta(eta)),
+            percent=round(percent, 2), rows_done=i,
+            total_rows=int(total_lines), row_percent=round(100 * fraction, 2),
+            speed=block.get('speed'), eta_seconds=eta)
+      with job_events.RowTimer(i + 1) as timer:
+        video = generate_video(config, row, (i + 1), project_dir,
+                               progress_callback=publish_row_progress)
+      estimator.add_row(time.monotonic() - row_start)
+      output_bytes = None
+      if os.path.exists(video):
+        output_bytes = os.path.getsize(video)
+      events.write('row_done', output=os.path.basename(video),
+                   output_bytes=output_bytes, **timer.event_fields())
+
+      msg = "[RUNNIG] \n %s of %s (%.1f%%), ETA %s"
+      logv(msg % (i , total_lines, (100*i/total_lines),
+                  progress.format_eta(estimator.eta(i + 1))))
 
     if project_dir in running_gen_threads:
       running_gen_threads[project_dir].remove(gen_id)
     logv("[DONE]")
+    events.write('job_done')
   except Exception as e:
     if project_dir in running_gen_threads:
       running_gen_threads[project_dir].remove(gen_id)
     logv("[FAIL] '%s'" % e)
+    events.write('job_failed', error='%s' % e)
+  finally:
+    if running.file is not None:
+      running.release()
+    log_file.close()
+    events.close()
+    disk_usage.created(current_log_uri, events.file_path)
 
 def generate_videos(config_file, youtube_upload, preview_line, project_dir,
                     flags):
@@ -196,25 +251,117 @@ def generate_preview(config_file, preview_line, project_dir):
   return video
 
 
-def generate_video(config, row, row_num, project_dir):
-  row['$id'] = str(row_num)
+def preview_video_path(config_file, preview_line, project_dir):
+  """Returns the file generate_preview renders a row to, or None."""
+  config = load_config(config_file)
+  feed = os.path.join("projects", project_dir, config['data_file'])
+  for i, row in enumerate(iter_csv_file(feed, ',')):
+    if i + 1 == preview_line:
+      return os.path.join("projects", project_dir, "output",
+                          output_video_name(config, row, preview_line))
+  return None
+
+
+def generate_video(config, row, row_num, project_dir, progress_callback=None):
+  """Renders the video of a feed row and returns its file name.
+
+  progress_callback, if given, is called with the fraction of the video
+  rendered, from 0 to 1, and ffmpeg's progress block, as ffmpeg reports it.
+  """
   print()
+  render = build_render(config, row, row_num, project_dir)
+  job_events.record(images=len(render['image_overlays']),
+                    texts=len(render['text_overlays']))
+  out_file = render['output_video']
+  base_video = render['base_video']
+  ffmpeg = render['executable']
+
+  ffmpeg_callback = None
+  if progress_callback is not None:
+    # the output lasts as long as the base video, which gives the fraction
+    duration = video_duration(base_video, ffprobe_executable(ffmpeg))
+    def on_progress(block):
+      progress_callback(ffmpeg_progress_fraction(block, duration), block)
+    ffmpeg_callback = on_progress
+  with disk_usage.tracking(out_file):
+    run_ffmpeg(render['img_args'], render['filters'], base_video, out_file,
+               render['out_audio_filter'], render['out_video_filter'],
+               executable=ffmpeg, progress_callback=ffmpeg_callback)
+  return out_file
+
+
+def build_render(config, row, row_num, project_dir, dry_run=False):
+  """Compiles a feed row into everything needed to render its video.
+
+  With dry_run, text images are not rasterized, and their inputs get
+  placeholder paths, so nothing is written to disk.
+
+  Returns:
+    A dict with the overlays of the row, the ffmpeg inputs and filters, and
+    the base and output video paths.
+  """
+  row['$id'] = str(row_num)
   image_overlays = replace_vars_in_overlay(config['images'], row)
   text_overlays = replace_vars_in_overlay(config['text_lines'], row)
-  filters, txt_in_files, out_audio_filter, out_video_filter = complex_filter_strings(image_overlays, text_overlays)
+  filters, txt_in_files, out_audio_filter, out_video_filter = (
+      complex_filter_strings(image_overlays, text_overlays, dry_run=dry_run))
   img_args = image_and_video_inputs(image_overlays, project_dir, txt_in_files)
-  out_file = replace_vars(config['output_video'], row)
-  out_file = os.path.join("projects", project_dir, "output", out_file)
-  base_video = os.path.join("projects", project_dir, "assets", config['video'])
-
-  if 'ffmpeg_path' in config:
-    ffmpeg = config['ffmpeg_path']
-    run_ffmpeg(img_args, filters, base_video, out_file, out_audio_filter,
-               out_video_filter, executable=ffmpeg)
-  else:
-    run_ffmpeg(img_args, filters, base_video, out_file, out_audio_filter,
-               out_video_filter)
-  return out_file
+  out_file = output_video_name(config, row, row_num)
+  return {
+      'image_overlays': image_overlays,
+      'text_overlays': text_overlays,
+      'filters': filters,
+      'text_inputs': txt_in_files,
+      'img_args': img_args,
+      'out_audio_filter': out_audio_filter,
+      'out_video_filter': out_video_filter,
+      'output_video': os.path.join("projects", project_dir, "output", out_file),
+      'base_video': os.path.join("projects", project_dir, "assets",
+                                 config['video']),
+      'executable': config.get('ffmpeg_path', 'ffmpeg')
+  }
+
+
+video_durations = {}
+
+def video_duration(video_file, executable='ffprobe'):
+  """Returns the duration of a video in seconds, or None if unknown.
+
+  Durations are cached by path and modification time, as every row of a
+  project is rendered over the same base video.
+  """
+  try:
+    key = (os.path.abspath(video_file), os.path.getmtime(video_file))
+  except OSError:
+    return None
+  if key not in video_durations:
+    args = [executable, '-v', 'error', '-show_entries', 'format=duration',
+            '-of', 'default=noprint_wrappers=1:nokey=1', video_file]
+    try:
+      video_durations[key] = float(subprocess.check_output(args).strip())
+    except (OSError, subprocess.CalledProcessError, ValueError):
+      video_durations[key] = None
+  return video_durations[key]
+
+
+def ffprobe_executable(ffmpeg_executable):
+  """Returns the ffprobe executable installed next to an ffmpeg one."""
+  directory, name = os.path.split(ffmpeg_executable)
+  return os.path.join(directory, name.replace('ffmpeg', 'ffprobe'))
+
+
+def ffmpeg_progress_fraction(block, duration):
+  """Returns how much of a video of the given duration ffmpeg has written."""
+  if block.get('progress') == 'end':
+    return 1.0
+  # out_time_ms is in microseconds too, and the only one older ffmpegs write
+  out_time = block.get('out_time_us') or block.get('out_time_ms')
+  if not duration or not out_time:
+    return 0.0
+  try:
+    return min(max(int(out_time) / 1e6 / duration, 0.0), 1.0)
+  except ValueError:  # N/A before the first frame
+    return 0.0
 
 
 def is_file_an_image(filename):
@@ -223,16 +370,28 @@ def is_file_an_image(filename):
   return True if file_format in img_formats else False
 
 
-def complex_filter_strings(images, text_lines):
+@job_events.timed('filter_graph')
+def complex_filter_strings(images, text_lines, dry_run=False):
   """Generate a complex filter specification for ffmpeg.
 
+  The filters are built as a render_graph.RenderGraph, optimized and then
+  serialized.
+
   Arguments:
   images -- a list of image overlay objects
   text_lines -- a list of text overlay objects
+  dry_run -- whether to leave the text images unwritten
+
+  Returns:
+  The filter chains, the text image inputs, and the names of the audio and
+  video outputs.
   """
-  first_audio_filter = "[0:a]aformat=sample_fmts=fltp:sample_rates=44100:"
-  first_audio_filter += "channel_layouts=stereo,volume=1.0[audout0]"
-  complex_filters = [first_audio_filter]
+  graph = render_graph.RenderGraph()
+  graph.add('aformat', [('sample_fmts', 'fltp'), ('sample_rates', 44100),
+                        ('channel_layouts', 'stereo')],
+            ['0:a'], ['audformated0'], media=render_graph.AUDIO)
+  graph.add('volume', [(None, 1.0)], ['audformated0'], ['audout0'],
+            media=render_graph.AUDIO)
   overlays = (images + text_lines)
   input_stream = '0:v'
   last_audio_filter = 'audout0'
@@ -242,80 +401,142 @@ def complex_filter_strings(images, text_lines):
     if 'image' in ovr:
       is_img = is_file_an_image(ovr['image'])
       audio_filter = None if is_img else last_audio_filter
-      c_filter = image_and_video_filter(input_stream,
-                                        (i+1),
-                                        ovr['x'],
-                                        ovr['y'],
-                                        float(ovr['start_time']),
-                                        float(ovr['end_time']),
-                                        ovr.get('width', None),
-                                        ovr.get('height', None),
-                                        ovr['angle'],
-                                        float(ovr['fade_in_duration']),
-                                        float(ovr['fade_out_duration']),
-                                        ovr['h_align'],
-                                        output_stream,
-                                        is_text=False,
-                                        previous_audio_filter=audio_filter
-                                       )
+      image_and_video_filter(graph,
+                             input_stream,
+                             (i+1),
+                             ovr['x'],
+                             ovr['y'],
+                             float(ovr['start_time']),
+                             float(ovr['end_time']),
+                             ovr.get('width', None),
+                             ovr.get('height', None),
+                             ovr['angle'],
+                             float(ovr['fade_in_duration']),
+                             float(ovr['fade_out_duration']),
+                             ovr['h_align'],
+                             output_stream,
+                             is_text=False,
+                             previous_audio_filter=audio_filter
+                            )
       if audio_filter:
         last_audio_filter = 'audout%s' % (i+1)
 
     else:
-      c_filter, i_file = text_filter(input_stream,
-                                     (i+1),
-                                     ovr['text'],
-                                     ovr['font'],
-                                     ovr['font_size'],
-                                     ovr['font_color'],
-                                     ovr['x'],
-                                     ovr['y'],
-                                     ovr['h_align'],
-                                     float(ovr['start_time']),
-                                     float(ovr['end_time']),
-                                     float(ovr['fade_in_duration']),
-                                     float(ovr['fade_out_duration']),
-                                     ovr.get('angle', None),
-                                     ovr.get('is_cropped_text', False),
-                                     output_stream)
+      i_file = text_filter(graph,
+                           input_stream,
+                           (i+1),
+                           ovr['text'],
+                           ovr['font'],
+                           ovr['font_size'],
+                           ovr['font_color'],
+                           ovr['x'],
+                           ovr['y'],
+                           ovr['h_align'],
+                           float(ovr['start_time']),
+                           float(ovr['end_time']),
+                           float(ovr['fade_in_duration']),
+                           float(ovr['fade_out_duration']),
+                           ovr.get('angle', None),
+                           ovr.get('is_cropped_text', False),
+                           output_stream,
+                           dry_run=dry_run)
       txt_input_files.append(i_file)
 
-
-    last_video_filter = output_stream
-    complex_filters.append(c_filter)
     input_stream = output_stream
 
-  return complex_filters, txt_input_files, last_audio_filter, last_video_filter
+  graph.video_output = input_stream
+  graph.audio_output = last_audio_filter
+  graph.optimize()
+  return (graph.serialize(), txt_input_files, graph.audio_output,
+          graph.video_output)
 
+@job_events.timed('ffmpeg_encode')
 def run_ffmpeg(img_args, filters, input_video, output_video, out_audio_filter,
-               out_video_filter, executable='ffmpeg'):
+               out_video_filter, executable='ffmpeg', progress_callback=None):
     """Run the ffmpeg executable for the given input and filter spec.
 
+    Records ffmpeg's exit code and the frames and fps it reports through
+    -progress on the row's job event.
+
     Arguments:
     img_args -- a list of '-i' input arguments for the images
     filters -- complex filter specification
     input_video -- main input video file name
     output_video -- output video file name
+    progress_callback -- called with each progress block of ffmpeg, a dict
+
+    Returns:
+    ffmpeg's exit code, or None if it could not run.
     """
+    args = ffmpeg_args(img_args, filters, input_video, output_video,
+                       out_audio_filter, out_video_filter, executable)
+    print(args)
+    print(" ".join(args))
+    exit_code = None
+    stats = {}
+    try:
+        process = subprocess.Popen(args, stdout=subprocess.PIPE)
+        stats = read_ffmpeg_progress(process.stdout, progress_callback)
+        exit_code = process.wait()
+    except Exception as e:
+        print(e)
+    try:
+        encode_fps = float(stats.get('fps', ''))
+    except ValueError:
+        encode_fps = None
+    job_events.record(exit_code=exit_code,
+                      frames=int(stats.get('frame', 0) or 0),
+                      encode_fps=encode_fps)
+    return exit_code
+
+def ffmpeg_args(img_args, filters, input_video, output_video, out_audio_filter,
+                out_video_filter, executable='ffmpeg'):
+    """Returns the ffmpeg command line run_ffmpeg runs."""
     if input_video[0] != "/":
         input_video = os.path.join(program_dir, input_video)
 
     extra_end_args = []
-    extra_end_args += ['-map', '[%s]' % out_video_filter]
-    extra_end_args += ['-map', '[%s]' % out_audio_filter]
+    extra_end_args += ['-map', map_label(out_video_filter)]
+    extra_end_args += ['-map', map_label(out_audio_filter)]
     extra_end_args += ['-shortest', '-y']
 
-    args = ([executable, '-y', '-i', input_video] +
+    # progress is written to stdout as blocks of key=value lines
+    return ([executable, '-y', '-progress', 'pipe:1', '-nostats',
+             '-i', input_video] +
              img_args +
             ['-filter_complex', ';'.join(filters)] +
              extra_end_args +
             [output_video])
-    print(args)
-    print(" ".join(args))
-    try:
-        subprocess.call(args)
-    except Exception as e:
-        print(e)
+
+def map_label(stream):
+    """Returns the -map argument of a filter output or of an input stream."""
+    # a graph without overlays leaves the base video untouched, as 0:v
+    return stream if ':' in stream else '[%s]' % stream
+
+def read_ffmpeg_progress(stream, callback=None):
+    """Reads the -progress output of ffmpeg and returns its last block.
+
+    Each block, like {'frame': '250', 'out_time_us': '10000000',
+    'speed': '2.5x', ..., 'progress': 'continue'}, is passed to the callback
+    as soon as it is complete.
+    """
+    block = {}
+    last_block = {}
+    for line in stream:
+        key, _, value = line.decode('utf-8', 'replace').strip().partition('=')
+        if not key:
+            continue
+        block[key] = value
+        # each block ends with progress=continue, or progress=end
+        if key == 'progress':
+            last_block = block
+            block = {}
+            if callback is not None:
+                try:
+                    callback(last_block)
+                except Exception as e:
+                    print(e)
+    return last_block
 
 def image_and_video_inputs(images_and_videos, data_dir, text_tmp_images):
   """Generates a list of input arguments for ffmpeg with input images/videos."""
@@ -385,6 +606,7 @@ def image_input(ovl, data_dir, filename):
 
 
 def image_and_video_filter(
+      graph,
       input_stream, image_stream_index,
       x, y,
       t_start, t_end,
@@ -396,9 +618,10 @@ def image_and_video_filter(
       is_text=False,
       previous_audio_filter=None,
   ):
-  """Generates a ffmeg filter specification for image and video inputs.
+  """Adds the filters of an image or video overlay to a render graph.
 
   Args:
+    graph: the render_graph.RenderGraph of the row
     input_stream: name of the input stream
     image_stream_index: index of the input image among the -i arguments
     x: horizontal position where to overlay the image on the video
@@ -412,17 +635,13 @@ def image_and_video_filter(
     output_stream: name of output_stream
     is_text: boolean if the filter is for a text converted to video
     previous_audio_filter: audio track to put video track on top of
-
-  Returns:
-    A string that represents an image/video filter specification, ready to be
-    passed into ffmpeg.
   """
-  out_str = ('[%s]' % output_stream) if output_stream else ''
-  image_str = '[%s:v]' % image_stream_index
-  resize_str = '[vid_%s_resized]' % image_stream_index
-  rotate_str = '[vid_%s_rotated]' % image_stream_index
-  fadein_str = '[vid_%s_fadedin]' % image_stream_index
-  fadeout_str = '[vid_%s_fadedout]' % image_stream_index
+  image_str = '%s:v' % image_stream_index
+  format_str = 'vid_%s_rgba' % image_stream_index
+  resize_str = 'vid_%s_resized' % image_stream_index
+  rotate_str = 'vid_%s_rotated' % image_stream_index
+  fadein_str = 'vid_%s_fadedin' % image_stream_index
+  fadeout_str = 'vid_%s_fadedout' % image_stream_index
 
   if h_align == 'center':
     x = '%s-overlay_w/2' % x
@@ -439,71 +658,70 @@ def image_and_video_filter(
     height = 'ih/4'
 
   #scale image
-  img = '%s format=rgba,scale=%s:%s %s;' % (image_str, width, height,resize_str)
+  graph.add('format', [(None, 'rgba')], [image_str], [format_str])
+  graph.add('scale', [(None, width), (None, height)], [format_str],
+            [resize_str])
 
   if angle and str(angle) != '0':
-    img += '%s rotate=%s*PI/180:' % (resize_str, angle)
-    img += 'ow=\'hypot(iw,ih)\':'
-    img += 'oh=ow:'
-    img += 'c=none'
-    img += ' %s;' % rotate_str
+    graph.add('rotate', [(None, '%s*PI/180' % angle),
+                         ('ow', "'hypot(iw,ih)'"),
+                         ('oh', 'ow'),
+                         ('c', 'none')],
+              [resize_str], [rotate_str])
   else:
     rotate_str = resize_str
 
   #adds fade in to image
   if float(fade_in_duration) > 0:
-    fadein_start = t_start
-    img += '%s fade=t=in:st=%s:d=%s:alpha=1 %s;' % (rotate_str,
-                                                    fadein_start,
-                                                    fade_in_duration,
-                                                    fadein_str)
+    graph.add('fade', [('t', 'in'), ('st', t_start), ('d', fade_in_duration),
+                       ('alpha', 1)],
+              [rotate_str], [fadein_str])
   else:
-    img += '%s copy %s;' % (rotate_str, fadein_str)
+    graph.add('copy', [], [rotate_str], [fadein_str])
 
   #adds fade out to image
   if float(fade_out_duration) > 0:
     fadeout_start = float(t_end) - float(fade_out_duration)
-    img += '%s fade=t=out:st=%s:d=%s:alpha=1 %s;' % (fadein_str,
-                                                     fadeout_start,
-                                                     fade_out_duration,
-                                                     fadeout_str)
+    graph.add('fade', [('t', 'out'), ('st', fadeout_start),
+                       ('d', fade_out_duration), ('alpha', 1)],
+              [fadein_str], [fadeout_str])
   else:
-    img += '%s copy %s;' % (fadein_str, fadeout_str)
+    graph.add('copy', [], [fadein_str], [fadeout_str])
 
   # place adds image to overall overlays
-  start_at = t_start
-  end_at = float(t_end)
-  img += '[%s]%s overlay=%s:%s:enable=\'between(t,%s,%s)\' %s'
-  img %= (input_stream, fadeout_str, x, y, start_at, end_at, out_str)
+  graph.add('overlay', [(None, x), (None, y),
+                        ('enable', "'between(t,%s,%s)'" % (t_start,
+                                                           float(t_end)))],
+            [input_stream, fadeout_str], [output_stream])
 
   # adds audio track case it is a video
   if previous_audio_filter:
-    aud = audio_filter(previous_audio_filter, image_stream_index, 100, t_start)
-    img += ";%s" % aud
+    audio_filter(graph, previous_audio_filter, image_stream_index, 100,
+                 t_start)
 
-  return img
 
-
-def audio_filter(previous_filter, stream_index, volume, start_time):
-
-  # holder for audio filter complex
-  audio_filter = ''
+def audio_filter(graph, previous_filter, stream_index, volume, start_time):
+  """Adds the filters mixing the audio of a video overlay to a render graph."""
 
   # formats current audio file
-  audio_filter += '[%s:a]aformat=sample_fmts=fltp:sample_rates=44100:'
-  audio_filter += 'channel_layouts=stereo,volume=%s [audformated%s];'
-  audio_filter %= (stream_index, float(volume) / 100, stream_index)
+  graph.add('aformat', [('sample_fmts', 'fltp'), ('sample_rates', 44100),
+                        ('channel_layouts', 'stereo')],
+            ['%s:a' % stream_index], ['audformated%s_raw' % stream_index],
+            media=render_graph.AUDIO)
+  graph.add('volume', [(None, float(volume) / 100)],
+            ['audformated%s_raw' % stream_index],
+            ['audformated%s' % stream_index], media=render_graph.AUDIO)
 
   # makes audio start when it is supposed to
   delay = float(start_time) * 1000 + 1
-  audio_filter += '[audformated%s]adelay=%s|%s[aud%s];'
-  audio_filter %= (stream_index, delay, delay, stream_index)
+  graph.add('adelay', [(None, '%s|%s' % (delay, delay))],
+            ['audformated%s' % stream_index], ['aud%s' % stream_index],
+            media=render_graph.AUDIO)
 
   # overlays this audio on previous audio overlay
-  audio_filter += ('[%s][aud%s] amix=inputs=2:duration=first[audout%s]')
-  audio_filter %= (previous_filter, stream_index, stream_index)
-
-  return audio_filter
+  graph.add('amix', [('inputs', 2), ('duration', 'first')],
+            [previous_filter, 'aud%s' % stream_index],
+            ['audout%s' % stream_index], media=render_graph.AUDIO)
 
 
 def process_screenshot(config, screenshot_time, video_path, output_path):
@@ -568,7 +786,8 @@ def get_video_duration(video_file_path):
   else:
     return None
 
-def text_filter(input_stream,
+def text_filter(graph,
+                input_stream,
                 image_stream_index,
                 text,
                 font, font_size, font_color,
@@ -578,10 +797,14 @@ def text_filter(input_stream,
                 fade_in_duration, fade_out_duration,
                 angle,
                 is_cropped_text,
-                output_stream):
-    """Generate a ffmeg filter specification for a text overlay.
+                output_stream,
+                dry_run=False):
+    """Adds the filters of a text overlay to a render graph.
+
+    Returns the input of the text's image, a dict with its path and timing.
 
     Arguments:
+    graph -- the render_graph.RenderGraph of the row
     input_stream -- name of the input stream
     text -- the text to overlay on the video
     font -- the file name of the font to be used
@@ -590,18 +813,23 @@ def text_filter(input_stream,
     h_align -- horizontal text alignment ("left" or "center")
     t_start, t_end -- start and end time of the image's appearance
     output_stream -- name of the output stream
+    dry_run -- whether to skip writing the text image, naming a placeholder
     """
 
-    # Write the text to a file to avoid the special character escaping mess
-    text_file_name = write_to_temp_file(text)
-
-    # If we have an angle, create an image with the text
-    temp_image_name = write_temp_image(font_color,
-                                       font,
-                                       str(font_size),
-                                       text_file_name,
-                                       is_cropped_text)
-    filters = image_and_video_filter(
+    if dry_run:
+      temp_image_name = '<text image %s>' % image_stream_index
+    else:
+      # Write the text to a file to avoid the special character escaping mess
+      text_file_name = write_to_temp_file(text)
+
+      # If we have an angle, create an image with the text
+      temp_image_name = write_temp_image(font_color,
+                                         font,
+                                         str(font_size),
+                                         text_file_name,
+                                         is_cropped_text)
+    image_and_video_filter(
+      graph,
       input_stream=input_stream,
       image_stream_index=image_stream_index,
       x=x,
@@ -618,7 +846,7 @@ def text_filter(input_stream,
       is_text=True
     )
 
-    return filters, {
+    return {
       'start_time':t_start,
       'end_time':t_end,
       'path':temp_image_name
@@ -636,6 +864,7 @@ def write_to_temp_file(text):
         f.close()
     return text_file_name
 
+@job_events.timed('text_rasterization')
 def write_temp_image(t_color, t_font, t_size, text_file_name, is_cropped_text):
     """Writes a text to a temporary image with transparent background."""
 
@@ -645,9 +874,7 @@ def write_temp_image(t_color, t_font, t_size, text_file_name, is_cropped_text):
                                             )
 
     #setup args to construct image
-    font_full = t_font + ""
-    if t_font[0] != "/":
-      font_full = os.path.join(program_dir, t_font)
+    font_full = resolve_font(t_font)
 
     # imagemagik
     args = ['convert']
@@ -682,6 +909,22 @@ def write_temp_image(t_color, t_font, t_size, text_file_name, is_cropped_text):
     # return exported image
     return temp_file_name
 
+def resolve_font(t_font):
+    """Returns the font file of a font given by path or by name.
+
+    Paths are relative to the program dir. Anything else, like 'Open Sans
+    Bold', is looked up in the font index, and passed on to ImageMagick as it
+    is if not found there.
+    """
+    font_full = t_font
+    if t_font[0] != "/":
+      font_full = os.path.join(program_dir, t_font)
+    if not os.path.isfile(font_full):
+      found = font_index.find_font(t_font)
+      if found is not None:
+        font_full = os.path.abspath(found)
+    return font_full
+
 def escape_path(path):
     """Escape Windows path slashes, colons and spaces, adding extra escape for ffmpeg."""
     return path.replace('\\','\\\\\\\\').replace(':','\\\\:').replace(' ','\\\\ ')
@@ -711,16 +954,24 @@ def read_csv_file(file_name, delimiter):
     delimiter -- character to be used as column delimiter
     """
     data = []
+    for row in iter_csv_file(file_name, delimiter):
+        print(row)
+        data.append(row)
+    return data
+
+def iter_csv_file(file_name, delimiter):
+    """Read a CSV file one record at a time, without keeping it in memory.
+
+    Yield the same dictionaries read_csv_file returns.
+    """
     with codecs.open(file_name, 'r',  errors='backslashreplace') as csv_file:
         csv_data = csv.DictReader((l.replace('\0', '') for l in csv_file))
         for line in csv_data:
             row = {}
             for field in line:
               row[field] = line[field]
-            print(row)
-            data.append(row)
+            yield row
         csv_file.close()
-    return data
 
 def test_replace_vars():
     config = load_config('sample.json')
@@ -729,6 +980,7 @@ def test_replace_vars():
         print(replace_vars_in_overlay(config['images'], row))
         print(replace_vars_in_overlay(config['text_lines'], row))
 
+@job_events.timed('replace_vars')
 def replace_vars_in_overlay(overlay_configs, values):
     """Replace all occurrences of variables in the configs with the values."""
     retval = []
@@ -752,6 +1004,12 @@ def replace_vars_in_targets(targets, values):
         retval.append(replace_vars_in_dict(o, values))
     return retval
 
+def output_video_name(config, row, row_num):
+    """Returns the name of the file, under output/, a row renders to."""
+    values = dict(row)
+    values['$id'] = str(row_num)
+    return replace_vars(config['output_video'], values)
+
 def replace_vars(s, values):
     """Replace all occurrences of variables in the given string with values"""
     retval = s
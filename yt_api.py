@@ -16,53 +16,50 @@
 # limitations under the License.
 
 import codecs
+import collections
+import concurrent.futures
 import csv
 import datetime
+import disk_usage
 import glob
 import glob
 import http.client
 import json
+import metrics
 import os
+import progress
 import re
 import ssl
-import subprocess
 import sys
 import traceback
 import tracemalloc
 import threading
+import time
+import urllib.parse
+import upload_manifest
 import vogon
+import yt_retry
 from oauth2client.service_account import ServiceAccountCredentials
 
-from third_party.retry import retry
-
 HTTPS_PORT_NUMBER = 443
+REMOVE_MAX_WORKERS = 8
+REMOVE_REQUESTS_PER_SECOND = 10
+REMOVE_LOG_EVERY = 50
 ssl._create_default_https_context = ssl._create_unverified_context
+# Base URL of the Google APIs, which benchmarks point to a local mock, e.g.
+# VOGON_GOOGLEAPIS_URL=http://localhost:8181
+GOOGLEAPIS_URL = os.environ.get('VOGON_GOOGLEAPIS_URL',
+                                'https://www.googleapis.com')
 
 
-def get_latest_uploaded_videos(project_dir):
-  # gets latest video upload file
-  yt_logs_dir = os.path.join("projects", project_dir, "youtube", "*.txt")
-  list_of_files = glob.glob(yt_logs_dir)
-  if not list_of_files:
-    return []
-  latest_file = max(list_of_files, key=os.path.getctime)
+def googleapis_connection():
+  """Returns a connection to the Google APIs at GOOGLEAPIS_URL."""
+  url = urllib.parse.urlsplit(GOOGLEAPIS_URL)
+  if url.scheme == 'http':
+    return http.client.HTTPConnection(url.hostname, url.port or 80)
+  return http.client.HTTPSConnection(url.hostname,
+                                     url.port or HTTPS_PORT_NUMBER)
 
-  # extracts videos from file
-  content = ""
-  with open(latest_file,'r') as f:
-    content = f.readlines()
-    f.close()
-  videos = {}
-  for row in content:
-    if len(row.split(",")) != 2:
-      continue
-    row_number = row.split(",")[0]
-    row_number = row_number.replace("output_video_row_","").replace(".mp4","")
-    yt_id = row.split(",")[1]
-    videos[row_number] = yt_id.replace("\n","")
-
-  # returns videos dict
-  return videos
 
 def read_credentials():
     f = open('credentials/webserver_client_secret.json', 'r')
@@ -71,6 +68,11 @@ def read_credentials():
     return credentials
 
 
+def client_id():
+  """Returns the OAuth client the YouTube calls are made with."""
+  return read_credentials()['installed']['client_id']
+
+
 def get_device_code():
   credentials = read_credentials()
   data = {
@@ -98,8 +100,7 @@ def check_device_authorization(device_code):
     'grant_type': 'http://oauth.net/grant_type/device/1.0'
   }
 
-  http_client = http.client.HTTPSConnection('www.googleapis.com',
-                                            HTTPS_PORT_NUMBER)
+  http_client = googleapis_connection()
 
   http_client.request('POST', '/oauth2/v4/token', body=json.dumps(data))
 
@@ -119,8 +120,7 @@ def refresh_access_token(refresh_token):
     'grant_type': 'refresh_token'
   }
 
-  http_client = http.client.HTTPSConnection('www.googleapis.com',
-                                            HTTPS_PORT_NUMBER)
+  http_client = googleapis_connection()
 
   http_client.request('POST', '/oauth2/v4/token', body=json.dumps(data))
   response = http_client.getresponse()
@@ -135,8 +135,7 @@ def list_channels(access_token):
         'Authorization': ('Bearer %s' % access_token)
     }
 
-    http_client = http.client.HTTPSConnection('www.googleapis.com',
-                                              HTTPS_PORT_NUMBER)
+    http_client = googleapis_connection()
     http_client.request('GET', '/youtube/v3/channels?mine=true&part=snippet',
                         headers=headers)
     response = http_client.getresponse()
@@ -154,7 +153,10 @@ def start_video_upload(request_json):
     request_json['description'],
     request_json['channel_id'],)
 
-  thread = threading.Thread(target=upload_videos, args=thread_args)
+  thread = threading.Thread(
+      target=progress.run_job,
+      args=(request_json['project_id'], progress.YOUTUBE, upload_videos) +
+      thread_args)
   thread.start()
 
 
@@ -167,14 +169,39 @@ def upload_videos(refresh_token,
 
   try:
     config = vogon.load_config('projects/{}/config.json'.format(project_id))
+    manifest = upload_manifest.UploadManifest(project_id)
+    guard = yt_retry.guard_for(client_id())
+    log = lambda msg: write_log('[RUNNING]', msg, project_id, gen_id)
 
-    with codecs.open('projects/{}/feed.csv'.format(project_id), 'r',  errors='backslashreplace') as feed:
+    written = (upload_manifest.manifest_path(project_id),
+               'projects/{}/youtube/{}.log'.format(project_id, gen_id))
+    with disk_usage.tracking(*written), codecs.open('projects/{}/feed.csv'.format(project_id), 'r',  errors='backslashreplace') as feed, manifest:
       reader = csv.DictReader((l.replace('\0', '') for l in feed))
       for row_number, row in enumerate(reader, start=1):
 
         video_path = 'projects/{}/output/output_video_row_{}.mp4'.format(
             project_id, row_number)
 
+        # skips outputs already uploaded to this channel by a previous run
+        output_hash = upload_manifest.file_hash(video_path)
+        video_id = manifest.find_uploaded_video(channel_id, output_hash)
+        metrics.CACHE_REQUESTS.inc(cache='uploaded_video',
+                                   result='miss' if video_id is None else 'hit')
+        if video_id is not None:
+          if manifest.video_id_for_row(channel_id, row_number) != video_id:
+            manifest.record_upload(row_number,
+                                   os.path.basename(video_path),
+                                   output_hash,
+                                   channel_id,
+                                   video_id,
+                                   gen_id)
+          write_log('[RUNNING]',
+                    ('Video %s already uploaded. YT video ID is '
+                     '%s' % (video_path, video_id)),
+                    project_id,
+                    gen_id)
+          continue
+
         title = vogon.replace_vars(config['video_title'], row)
         description = vogon.replace_vars(config['video_description'], row)
 
@@ -185,11 +212,17 @@ def upload_videos(refresh_token,
         write_log('[RUNNING]', 'Uploading video %s' % video_path,
                   project_id,
                   gen_id)
-        video_resource = upload_video(new_access_token,
-                                      gen_id,
-                                      video_path,
-                                      project_id,
-                                      channel_id)
+        video_resource = guard.call('videos.insert',
+                                    upload_video,
+                                    new_access_token,
+                                    gen_id,
+                                    video_path,
+                                    project_id,
+                                    channel_id,
+                                    manifest=manifest,
+                                    row_number=row_number,
+                                    output_hash=output_hash,
+                                    log=log)
 
         write_log('[RUNNING]',
                   ('Video %s uploaded. YT video ID is '
@@ -200,10 +233,13 @@ def upload_videos(refresh_token,
                   'Writing metadata for video %s' % video_path,
                   project_id,
                   gen_id)
-        write_video_metadata(new_access_token,
-                             video_resource,
-                             title,
-                             description)
+        guard.call('videos.update',
+                   write_video_metadata,
+                   new_access_token,
+                   video_resource,
+                   title,
+                   description,
+                   log=log)
         write_log('[RUNNING]', 'Metadata written', project_id, gen_id)
       feed.close()
     write_log('[DONE]', 'All videos uploaded!', project_id, gen_id)
@@ -211,7 +247,8 @@ def upload_videos(refresh_token,
     write_log('[ERROR]', 'An error occurred - %s' % e, project_id, gen_id)
 
 
-def upload_video(access_token, gen_id, filepath, project_id, channel_id):
+def upload_video(access_token, gen_id, filepath, project_id, channel_id,
+                 manifest=None, row_number=None, output_hash=None):
   headers = {
     'Authorization': ('Bearer %s' % access_token),
     'Content-Type': 'application/octet-stream'
@@ -219,24 +256,34 @@ def upload_video(access_token, gen_id, filepath, project_id, channel_id):
 
   video_file = open(filepath, 'rb')
 
-  http_client = http.client.HTTPSConnection('www.googleapis.com',
-                                            HTTPS_PORT_NUMBER)
+  start = time.monotonic()
+  http_client = googleapis_connection()
   http_client.request('POST', '/upload/youtube/v3/videos?part=snippet',
                       headers=headers,
                       body=video_file)
   yt_response = http_client.getresponse()
-  video_resource = json.loads(yt_response.read())
+  yt_content = yt_response.read()
+  retry_after = yt_response.getheader('Retry-After')
   http_client.close()
-  video_file.close()
+  metrics.UPLOAD_SECONDS.observe(time.monotonic() - start,
+                                 status=yt_response.status)
   if yt_response.status == 200:
-    persist_uploaded_video_resource(os.path.basename(filepath),
-                                    gen_id,
-                                    video_resource,
-                                    project_id,
-                                    channel_id)
+    metrics.UPLOAD_BYTES.inc(video_file.tell())
+  video_file.close()
+  if yt_response.status != 200:
+    raise yt_retry.ApiError.from_response(yt_response.status, yt_content,
+                                          retry_after)
+  video_resource = json.loads(yt_content)
+  persist_uploaded_video_resource(os.path.basename(filepath),
+                                  gen_id,
+                                  video_resource,
+                                  project_id,
+                                  channel_id,
+                                  manifest=manifest,
+                                  row_number=row_number,
+                                  output_hash=output_hash)
   return video_resource
 
-@retry(Exception, retries=10)
 def write_video_metadata(access_token, video_resource, title, description):
   headers = {
     'Authorization': ('Bearer %s' % access_token),
@@ -255,110 +302,220 @@ def write_video_metadata(access_token, video_resource, title, description):
     }
   })
 
-  http_client = http.client.HTTPSConnection('www.googleapis.com',
-                                            HTTPS_PORT_NUMBER)
+  http_client = googleapis_connection()
   http_client.request('PUT', '/youtube/v3/videos?part=snippet,status',
                       headers=headers, body=body)
 
   yt_response = http_client.getresponse()
-  rs = json.loads(yt_response.read())
-  if 'error' in rs and "errors" in rs['error'] and len(rs['error']['errors']):
-      error = rs['error']['errors'][0]
-      msg = "%s - %s"%(error["reason"], error["message"])
-      http_client.close()
-      raise Exception("Error uploading video: %s" % msg)
-  print(rs)
+  yt_content = yt_response.read()
   http_client.close()
+  if yt_response.status != 200:
+    raise yt_retry.ApiError.from_response(
+        yt_response.status, yt_content, yt_response.getheader('Retry-After'))
+  print(json.loads(yt_content))
 
 
 def persist_uploaded_video_resource(filename,
                                     gen_id,
                                     video_resource,
                                     project_id,
-                                    channel_id):
-  dir_path = 'projects/{project_id}/youtube/'.format(project_id=project_id)
-
-  if not os.path.exists(dir_path):
-    os.makedirs(dir_path)
-    break_line = ""
+                                    channel_id,
+                                    manifest=None,
+                                    row_number=None,
+                                    output_hash=None):
+  """Records an uploaded video on the project's upload manifest."""
+  if row_number is None:
+    row_number = upload_manifest.row_number_from_filename(filename)
+  if output_hash is None:
+    output_hash = upload_manifest.file_hash(
+        'projects/{}/output/{}'.format(project_id, filename))
+
+  if manifest is None:
+    with upload_manifest.UploadManifest(project_id) as own_manifest:
+      own_manifest.record_upload(row_number, filename, output_hash,
+                                 channel_id, video_resource['id'], gen_id)
   else:
-    break_line = "\n"
-
-  file_path = '{dir_path}/{channel_id}_{gen_id}.txt'.format(
-    dir_path=dir_path,
-    channel_id=channel_id,
-    gen_id=gen_id)
-
-  uploaded_videos_file = open(file_path, 'a')
-  uploaded_videos_file.write('{}{},{}'.format(break_line,
-                                              filename,
-                                              video_resource['id']))
-  uploaded_videos_file.close()
+    manifest.record_upload(row_number, filename, output_hash, channel_id,
+                           video_resource['id'], gen_id)
+
+
+class TokenBucket(object):
+  """Thread safe token bucket limiting how often an API is called."""
+
+  def __init__(self, rate, capacity=None):
+    self.rate = float(rate)
+    self.capacity = float(capacity if capacity is not None else rate)
+    self.tokens = self.capacity
+    self.last_refill = time.monotonic()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    """Blocks until a token is available and takes it."""
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        wait = (1 - self.tokens) / self.rate
+      time.sleep(wait)
+
+
+class AccessToken(object):
+  """Access token shared by worker threads, refreshed only when it expires."""
+
+  def __init__(self, refresh_token):
+    self.refresh_token = refresh_token
+    self.lock = threading.Lock()
+    self.value = None
+    self.refresh(None)
+
+  def refresh(self, expired_value):
+    with self.lock:
+      # another worker may have refreshed it already
+      if self.value == expired_value:
+        _,refresh_token_response = refresh_access_token(self.refresh_token)
+        self.value = json.loads(refresh_token_response)['access_token']
+      return self.value
 
 
 def remove_uploaded_videos(request_json):
+  """Starts removing the videos of a project's channel on a thread."""
+  thread_args = (
+    request_json['refresh_token'],
+    request_json['project_id'],
+    request_json['channel_id'],
+    request_json.get('max_workers', REMOVE_MAX_WORKERS),
+    request_json.get('requests_per_second', REMOVE_REQUESTS_PER_SECOND),)
+
+  thread = threading.Thread(
+      target=progress.run_job,
+      args=(request_json['project_id'], progress.YOUTUBE, remove_videos) +
+      thread_args)
+  thread.start()
 
-  gen_id = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-  refresh_token = request_json['refresh_token']
-  project_id = request_json['project_id']
-  channel_id = request_json['channel_id']
-
-  write_log('[STARTED]', 'Removing videos', project_id, gen_id)
-
-  pathname = 'projects/{project_id}/youtube/{channel_id}_*.txt'.format(
-    project_id=project_id,
-    channel_id=channel_id
-  )
-
-  uploaded_videos_file_paths = glob.glob(pathname)
-
-  error_occurred = False
-
-  for uploaded_video_file_path in uploaded_videos_file_paths:
-    reader = open(uploaded_video_file_path, 'r')
-    lines = reader.readlines()
-    reader.close()
 
-    for line in lines:
-      if len(line.split(',')) > 1:
-        yt_video_id = line.split(',')[1]
-        write_log('[RUNNING]',
-                  'Removing video {}'.format(yt_video_id),
+def remove_videos(refresh_token,
                   project_id,
-                  gen_id)
-
-        _,refresh_token_response = refresh_access_token(refresh_token)
-        new_access_token = json.loads(refresh_token_response)['access_token']
-        yt_status, yt_response = remove_video(new_access_token, yt_video_id)
-
-        # checks is video was available
-        video_found = True
-        rs = ''
-        if yt_response and yt_response != 'None':
-            rs = json.loads(yt_response)
-            if 'error' in rs and 'errors' in rs['error']:
-              reasons = [r['reason'] for r in rs['error']['errors']]
-              print("REASONS: %s"%reasons)
-              if 'videoNotFound' in reasons:
-                video_found = False
-
-        if yt_status != 204 and video_found:
-          log_message = 'Error when removing video {} - {}'.format(
-              yt_video_id, rs)
-          write_log('[ERROR]', log_message, project_id, gen_id)
-
-
-          error_occurred = True
-          break
-
-    if not error_occurred:
-      os.remove(uploaded_video_file_path)
+                  channel_id,
+                  max_workers=REMOVE_MAX_WORKERS,
+                  requests_per_second=REMOVE_REQUESTS_PER_SECOND):
+  """Removes every video still uploaded to a channel by the project.
+
+  Deletions run on a bounded pool of threads, rate limited by a token bucket.
+  The outcome of each video is recorded in the upload manifest as it arrives,
+  and videos that failed stay pending, so running this again only retries
+  them.
+
+  Returns:
+    A dict with the number of videos per removal outcome.
+  """
+  gen_id = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+  outcomes = {
+    upload_manifest.REMOVAL_REMOVED: 0,
+    upload_manifest.REMOVAL_NOT_FOUND: 0,
+    upload_manifest.REMOVAL_FAILED: 0
+  }
 
-  if not error_occurred:
+  write_log('[STARTED]', 'Removing videos', project_id, gen_id)
+  try:
+    with upload_manifest.UploadManifest(project_id) as manifest:
+      video_ids = manifest.uploaded_video_ids(channel_id)
+      total = len(video_ids)
+      write_log('[RUNNING]',
+                '{} videos to remove'.format(total),
+                project_id,
+                gen_id)
+
+      access_token = AccessToken(refresh_token)
+      bucket = TokenBucket(requests_per_second)
+      guard = yt_retry.guard_for(client_id())
+      log = lambda msg: write_log('[RUNNING]', msg, project_id, gen_id)
+      with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        futures = {}
+        for yt_video_id in video_ids:
+          future = executor.submit(remove_single_video,
+                                   access_token,
+                                   bucket,
+                                   yt_video_id,
+                                   guard,
+                                   log)
+          futures[future] = yt_video_id
+
+        done = 0
+        for future in concurrent.futures.as_completed(futures):
+          yt_video_id = futures[future]
+          try:
+            outcome, detail = future.result()
+          except Exception as e:  # pylint: disable=broad-except
+            outcome, detail = upload_manifest.REMOVAL_FAILED, '%s' % e
+          manifest.record_removal(channel_id, yt_video_id, outcome, gen_id,
+                                  detail)
+          outcomes[outcome] += 1
+          done += 1
+
+          if outcome == upload_manifest.REMOVAL_FAILED:
+            log_message = 'Error when removing video {} - {}'.format(
+                yt_video_id, detail)
+            write_log('[RUNNING]', log_message, project_id, gen_id)
+          if (done % REMOVE_LOG_EVERY == 0 or done == total or
+              outcome == upload_manifest.REMOVAL_FAILED):
+            write_log('[RUNNING]',
+                      'Removed {} of {} videos ({} failed)'.format(
+                          done - outcomes[upload_manifest.REMOVAL_FAILED],
+                          total,
+                          outcomes[upload_manifest.REMOVAL_FAILED]),
+                      project_id,
+                      gen_id)
+  except Exception as e:
+    write_log('[ERROR]', 'An error occurred - %s' % e, project_id, gen_id)
+    return outcomes
+
+  if outcomes[upload_manifest.REMOVAL_FAILED]:
+    write_log('[ERROR]',
+              ('{} videos could not be removed, run the removal again to '
+               'retry them'.format(outcomes[upload_manifest.REMOVAL_FAILED])),
+              project_id,
+              gen_id)
+  else:
     write_log('[Done]',
             'All videos removed!',
             project_id,
             gen_id)
+  return outcomes
+
+
+def remove_single_video(access_token, bucket, yt_video_id, guard=None,
+                        log=None):
+  """Removes a video, refreshing the access token once if it expired.
+
+  Returns:
+    A tuple with the removal outcome and the API error, if it failed.
+  """
+  def rate_limited_remove(token):
+    bucket.acquire()
+    return remove_video(token, yt_video_id)
+
+  token = access_token.value
+  for attempt in range(2):
+    try:
+      if guard is None:
+        rate_limited_remove(token)
+      else:
+        guard.call('videos.delete', rate_limited_remove, token, log=log)
+      return upload_manifest.REMOVAL_REMOVED, ''
+    except yt_retry.ApiError as e:
+      # checks is video was available
+      if e.reason == 'videoNotFound':
+        return upload_manifest.REMOVAL_NOT_FOUND, ''
+      if e.category != yt_retry.AUTH_ERROR or attempt:
+        return upload_manifest.REMOVAL_FAILED, '%s' % e
+      token = access_token.refresh(token)
+    except yt_retry.CircuitOpenError as e:
+      return upload_manifest.REMOVAL_FAILED, '%s' % e
 
 
 def remove_video(access_token, video_id):
@@ -368,14 +525,17 @@ def remove_video(access_token, video_id):
   video_id = video_id.replace("\n","")
   video_uri = '/youtube/v3/videos?id={}'.format(video_id)
   print(video_uri)
-  http_client = http.client.HTTPSConnection('www.googleapis.com',
-                                            HTTPS_PORT_NUMBER)
+  http_client = googleapis_connection()
 
   http_client.request('DELETE', video_uri, headers=headers)
   response = http_client.getresponse()
   response_status = response.status
   response_content = response.read()
+  retry_after = response.getheader('Retry-After')
   http_client.close()
+  if response_status != 204:
+    raise yt_retry.ApiError.from_response(response_status, response_content,
+                                          retry_after)
   return response_status, response_content
 
 
@@ -397,6 +557,8 @@ def write_log(status, message, project_id, gen_id):
     message=message.replace('\n', ''))
   log_file.write(msg)
   log_file.close()
+  progress.publish(project_id, progress.YOUTUBE,
+                   vogon.started_at_from_gen_id(gen_id), msg.rstrip('\n'))
   if msg[:4] == "[ERR":
       print(msg)
       print(sys.exc_info())
@@ -404,9 +566,19 @@ def write_log(status, message, project_id, gen_id):
 
 
 def read_log(project_id, lines):
+  state = progress.latest(project_id, progress.YOUTUBE)
+  if state is not None and lines == 1:
+    return state['current_state']
+
+  # jobs from before the server started are only found in their logs
   log_files = glob.glob('projects/{}/youtube/*.log'.format(project_id))
   log_files.sort(reverse=True)
 
   if log_files:
-    return subprocess.check_output(['tail', '-%s' % lines, log_files[0]])
+    if lines == 1:
+      return progress.last_line(log_files[0])
+    with open(log_files[0], 'r') as log_file:
+      last_lines = ''.join(collections.deque(log_file, lines))
+      log_file.close()
+    return last_lines
   return 'No log files found'
@@ -0,0 +1,375 @@
+# vim: set fileencoding=utf-8 :
+
+# Copyright 2019 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Retries, quota accounting and circuit breaking for YouTube API calls.
+
+Calls go through the ApiGuard of the OAuth client they are made with, which
+classifies failures by the reason YouTube reports, retries the transient
+ones with jittered exponential backoff (or after the Retry-After the API
+asks for), counts the quota units spent per day, and opens a circuit breaker
+that pauses every caller when the API keeps failing or the quota is
+exhausted.
+
+YouTube counts quota per Cloud project, that is per client, whatever Vogon
+project makes the calls, so every project shares the guard of the client.
+The quota spent is saved in projects/.youtube, where all the server's
+processes add to it; breakers are kept by each process.
+"""
+
+import datetime
+import fcntl
+import http.client
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+# Failure categories
+QUOTA_EXCEEDED = 'quota_exceeded'
+RATE_LIMITED = 'rate_limited'
+BACKEND_ERROR = 'backend_error'
+AUTH_ERROR = 'auth_error'
+NETWORK_ERROR = 'network_error'
+CLIENT_ERROR = 'client_error'
+
+RETRYABLE_CATEGORIES = (RATE_LIMITED, BACKEND_ERROR, NETWORK_ERROR)
+
+QUOTA_REASONS = ('quotaExceeded', 'dailyLimitExceeded', 'uploadLimitExceeded')
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+BACKEND_REASONS = ('backendError', 'internalError', 'serviceUnavailable')
+AUTH_REASONS = ('authError', 'unauthorized', 'invalidCredentials')
+
+# https://developers.google.com/youtube/v3/determine_quota_cost
+QUOTA_COSTS = {
+  'channels.list': 1,
+  'videos.insert': 1600,
+  'videos.update': 50,
+  'videos.delete': 50,
+}
+DAILY_QUOTA_UNITS = 10000
+QUOTA_DIR = os.path.join('projects', '.youtube')
+QUOTA_WARNING_RATIO = 0.8
+
+MAX_RETRIES = 6
+BASE_DELAY = 1.0
+MAX_DELAY = 64.0
+# consecutive failures that open the breaker, and for how long it stays open
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_COOLDOWN = 60.0
+# callers fail at once instead of waiting for breakers open longer than this
+MAX_PAUSE = 15 * 60.0
+
+metrics_lock = threading.Lock()
+METRICS = {
+  'api_calls': {},
+  'api_errors': {},
+  'api_retries': 0,
+  'breaker_trips': 0,
+}
+
+
+def count_metric(name, key=None, amount=1):
+  with metrics_lock:
+    if key is None:
+      METRICS[name] += amount
+    else:
+      METRICS[name][key] = METRICS[name].get(key, 0) + amount
+
+
+def get_metrics():
+  """Returns a snapshot of the counters, quota use and breaker states."""
+  with metrics_lock:
+    snapshot = json.loads(json.dumps(METRICS))
+  with guards_lock:
+    guards = list(GUARDS.values())
+  snapshot['quota_units'] = {}
+  snapshot['breakers'] = {}
+  for guard in guards:
+    snapshot['quota_units'][guard.client_id] = guard.quota.spent_today()
+    snapshot['breakers'][guard.client_id] = guard.breaker.state()
+  return snapshot
+
+
+def quota_day():
+  """YouTube quotas reset at midnight Pacific Time."""
+  try:
+    import zoneinfo
+    now = datetime.datetime.now(zoneinfo.ZoneInfo('America/Los_Angeles'))
+  except Exception:  # pylint: disable=broad-except
+    now = datetime.datetime.utcnow() - datetime.timedelta(hours=8)
+  return now.strftime('%Y-%m-%d')
+
+
+def seconds_to_quota_reset():
+  try:
+    import zoneinfo
+    now = datetime.datetime.now(zoneinfo.ZoneInfo('America/Los_Angeles'))
+  except Exception:  # pylint: disable=broad-except
+    now = datetime.datetime.utcnow() - datetime.timedelta(hours=8)
+  midnight = (now + datetime.timedelta(days=1)).replace(
+      hour=0, minute=0, second=0, microsecond=0)
+  return (midnight - now).total_seconds()
+
+
+def classify(status, reason):
+  """Maps an HTTP status and YouTube error reason to a failure category."""
+  if reason in QUOTA_REASONS:
+    return QUOTA_EXCEEDED
+  if reason in RATE_LIMIT_REASONS or status == 429:
+    return RATE_LIMITED
+  if reason in BACKEND_REASONS or (status is not None and status >= 500):
+    return BACKEND_ERROR
+  if reason in AUTH_REASONS or status == 401:
+    return AUTH_ERROR
+  if status is None:
+    return NETWORK_ERROR
+  return CLIENT_ERROR
+
+
+class ApiError(Exception):
+  """A failed YouTube API call, with the reason reported by the API."""
+
+  def __init__(self, status, reason, message, retry_after=None):
+    self.status = status
+    self.reason = reason
+    self.message = message
+    self.retry_after = retry_after
+    self.category = classify(status, reason)
+    super(ApiError, self).__init__('%s - %s' % (reason, message))
+
+  @classmethod
+  def from_response(cls, status, content, retry_after=None):
+    """Builds the error of a response, as sent by the API."""
+    reason = 'http_%s' % status
+    message = content
+    try:
+      rs = json.loads(content)
+      error = rs['error']
+      message = error.get('message', message)
+      if error.get('errors'):
+        reason = error['errors'][0].get('reason', reason)
+    except Exception:  # pylint: disable=broad-except
+      pass
+    if isinstance(message, bytes):
+      message = message.decode('utf-8', 'backslashreplace')
+    try:
+      retry_after = float(retry_after) if retry_after else None
+    except ValueError:
+      retry_after = None
+    return cls(status, reason, message, retry_after)
+
+  @classmethod
+  def from_exception(cls, e):
+    if isinstance(e, (OSError, http.client.HTTPException)):
+      return cls(None, type(e).__name__, '%s' % e)
+    return None
+
+
+class CircuitOpenError(Exception):
+  """Raised when a call waits on a breaker that will stay open too long."""
+
+
+class CircuitBreaker(object):
+  """Stops calls to a failing API for a while, shared by all callers."""
+
+  def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD,
+               cooldown=BREAKER_COOLDOWN):
+    self.name = name
+    self.failure_threshold = failure_threshold
+    self.cooldown = cooldown
+    self.failures = 0
+    self.open_until = 0
+    self.open_reason = None
+    self.lock = threading.Lock()
+
+  def state(self):
+    with self.lock:
+      if time.monotonic() < self.open_until:
+        return 'open'
+      if self.open_reason is not None:
+        return 'half_open'
+      return 'closed'
+
+  def wait(self, max_pause=MAX_PAUSE, log=None):
+    """Blocks the caller while the breaker is open."""
+    with self.lock:
+      remaining = self.open_until - time.monotonic()
+      reason = self.open_reason
+    if remaining <= 0:
+      return
+    if remaining > max_pause:
+      raise CircuitOpenError(
+          'YouTube API paused for %s (%s), %d minutes left' %
+          (self.name, reason, remaining / 60))
+    emit(log, 'YouTube API paused for %.0f seconds (%s)' % (remaining, reason))
+    time.sleep(remaining)
+
+  def record_success(self):
+    with self.lock:
+      if self.open_reason is not None:
+        logging.info('Circuit breaker for %s closed', self.name)
+      self.failures = 0
+      self.open_reason = None
+
+  def record_failure(self, error, log=None):
+    """Counts a failure, opening the breaker when the API is unhealthy."""
+    open_for = 0
+    with self.lock:
+      if error.category == QUOTA_EXCEEDED:
+        open_for = seconds_to_quota_reset()
+      elif error.category in RETRYABLE_CATEGORIES:
+        self.failures += 1
+        # a half open breaker opens again on its first failure
+        if (self.failures >= self.failure_threshold or
+            self.open_reason is not None):
+          open_for = max(self.cooldown, error.retry_after or 0)
+      if open_for:
+        self.open_until = time.monotonic() + open_for
+        self.open_reason = error.reason
+        self.failures = 0
+    if open_for:
+      count_metric('breaker_trips')
+      emit(log, 'Circuit breaker for %s opened for %.0f seconds (%s)' %
+           (self.name, open_for, error.reason))
+
+
+class QuotaTracker(object):
+  """Counts the quota units a client spends per day, saved to a file.
+
+  The file is read and written under a lock file, so every process of the
+  server adds to the same count.
+  """
+
+  def __init__(self, client_id, daily_limit=DAILY_QUOTA_UNITS):
+    name = re.sub(r'[^\w.-]+', '_', client_id)
+    self.file_path = os.path.join(QUOTA_DIR, 'quota_%s.json' % name)
+    self.daily_limit = daily_limit
+    self.lock = threading.Lock()
+
+  def load(self):
+    try:
+      with open(self.file_path, 'r') as f:
+        spent = json.load(f)
+        f.close()
+      return spent
+    except (IOError, ValueError):
+      return {}
+
+  def spent_today(self):
+    return self.load().get(quota_day(), 0)
+
+  def spend(self, units, log=None):
+    day = quota_day()
+    os.makedirs(QUOTA_DIR, exist_ok=True)
+    with self.lock, open(self.file_path + '.lock', 'a') as lock_file:
+      fcntl.flock(lock_file, fcntl.LOCK_EX)
+      before = self.load().get(day, 0)
+      temp_path = '%s.%d.%d.tmp' % (self.file_path, os.getpid(),
+                                    threading.get_ident())
+      with open(temp_path, 'w') as f:
+        json.dump({day: before + units}, f)
+        f.close()
+      os.replace(temp_path, self.file_path)
+    warning_units = self.daily_limit * QUOTA_WARNING_RATIO
+    if before < warning_units <= before + units:
+      emit(log, 'Spent %s of %s YouTube quota units today' %
+           (before + units, self.daily_limit))
+
+
+class ApiGuard(object):
+  """Retry policy, breaker and quota of the YouTube calls of a client."""
+
+  def __init__(self, client_id, max_retries=MAX_RETRIES,
+               base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+    self.client_id = client_id
+    self.max_retries = max_retries
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    self.breaker = CircuitBreaker(client_id)
+    self.quota = QuotaTracker(client_id)
+
+  def backoff(self, attempt, retry_after=None):
+    """Full jitter backoff, never shorter than what the API asked for."""
+    delay = random.uniform(0, min(self.max_delay,
+                                  self.base_delay * 2 ** attempt))
+    if retry_after:
+      delay = max(delay, retry_after)
+    return delay
+
+  def call(self, operation, func, *args, **kwargs):
+    """Calls func, retrying its transient YouTube failures.
+
+    Args:
+      operation: the API method called, such as 'videos.insert', used to
+        count quota units and metrics.
+      func: function calling the API, raising ApiError when it fails.
+      log: optional keyword argument, a function receiving a message for
+        each retry and breaker change.
+
+    Returns:
+      What func returns.
+
+    Raises:
+      ApiError: if the failure is not transient or retries ran out.
+      CircuitOpenError: if the breaker stays open longer than MAX_PAUSE.
+    """
+    log = kwargs.pop('log', None)
+    attempt = 0
+    while True:
+      self.breaker.wait(log=log)
+      count_metric('api_calls', operation)
+      self.quota.spend(QUOTA_COSTS.get(operation, 1), log=log)
+      try:
+        result = func(*args, **kwargs)
+      except Exception as e:  # pylint: disable=broad-except
+        error = e if isinstance(e, ApiError) else ApiError.from_exception(e)
+        if error is None:
+          raise
+        count_metric('api_errors', error.reason)
+        self.breaker.record_failure(error, log=log)
+        if (error.category not in RETRYABLE_CATEGORIES or
+            attempt >= self.max_retries):
+          raise error
+        delay = self.backoff(attempt, error.retry_after)
+        count_metric('api_retries')
+        emit(log, '%s failed with %s, retrying in %.1f seconds' %
+             (operation, error.reason, delay))
+        time.sleep(delay)
+        attempt += 1
+      else:
+        self.breaker.record_success()
+        return result
+
+
+guards_lock = threading.Lock()
+GUARDS = {}
+
+
+def guard_for(client_id):
+  """Returns the ApiGuard shared by every YouTube call of an OAuth client."""
+  with guards_lock:
+    if client_id not in GUARDS:
+      GUARDS[client_id] = ApiGuard(client_id)
+    return GUARDS[client_id]
+
+
+def emit(log, msg):
+  logging.warning(msg)
+  if log is not None:
+    log(msg)